@@ -23,10 +23,30 @@ timeout = 7200
 proc_name = "$package"
 workers = 2
 PDIRfile = "/run/gunicorn/$package.PDIR"
-raw_env = ["APP_SETTINGS=config-${package}.py"]
+metrics_dir = "/run/gunicorn/${package}_metrics"
+raw_env = ["APP_SETTINGS=config-${package}.py", "PROMETHEUS_MULTIPROC_DIR=" + metrics_dir]
 accesslog = "/var/log/gunicorn/${package}_access.log"
 errorlog = "/var/log/gunicorn/${package}_error.log"
 loglevel = "info"
+
+
+def on_starting(server):
+    import os
+    import shutil
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_worker_init(worker):
+    # drain and recover spooled ingestion jobs without waiting for a request
+    from unified.apis import ingest_spool
+    if ingest_spool is not None:
+        ingest_spool.start()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
 EOF
 
 echo "Running: systemctl start gunicorn.$package.socket"
@@ -13,10 +13,15 @@ import logging
 import json
 import lzma
 import os
+import re
 import time
 import random
+import threading
 
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import islice, zip_longest
 
 import requests
 
@@ -27,6 +32,43 @@ logger = logging.getLogger('reporting-ingest')
 
 DEBUG = True
 TIMEOUT = 10  #timeout of request.get
+UPLOAD_TIMEOUT = 600  # seconds waiting for a response of an ingestion
+CURSOR_HEADER = "X-Next-Cursor"
+
+
+def decode(raw, schema=''):
+    """Decompress an object of messages and keep those of schema if it is given
+
+    It runs in a process of the pipeline, returns the body to be uploaded, number
+    of messages and seconds spent.
+    """
+    start = time.perf_counter()
+    data = json.loads(lzma.decompress(raw).decode("utf-8"))
+    if schema:
+        data = [item for item in data if item["schema"] == schema]
+    return json.dumps(data).encode("utf-8"), len(data), time.perf_counter() - start
+
+
+class Stage:
+    """Throughput of a stage of the pipeline"""
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.size = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, size, seconds):
+        with self._lock:
+            self.count += 1
+            self.size += size
+            self.busy += seconds
+
+    def summary(self, wall):
+        wall = wall or 1
+        return "%s: %d objects, %.1f MB in %.1fs busy, %.2f objects/s, %.2f MB/s" % (
+            self.name, self.count, self.size / 1e6, self.busy,
+            self.count / wall, self.size / 1e6 / wall)
 
 
 class Ingester:
@@ -54,11 +96,37 @@ class Ingester:
         self.prefix = conf['AWS'].get('PREFIX', '')
         self.substring = conf['AWS'].get('SUBSTRING', '')
 
+        # Concurrency of stages of batch: fetching from object store, decoding
+        # and uploading to API server, and objects in the pipeline at most
+        pipeline = conf.get('PIPELINE', {})
+        self.fetchers = pipeline.get('FETCHERS', 4)
+        self.decoders = pipeline.get('DECODERS', os.cpu_count() or 1)
+        self.uploaders = pipeline.get('UPLOADERS', 2)
+        self.upload_timeout = pipeline.get('UPLOAD_TIMEOUT', UPLOAD_TIMEOUT)
+        self.in_flight = pipeline.get('IN_FLIGHT', 2 * (self.fetchers + self.decoders + self.uploaders))
+
+        # Objects are listed by partitions, prefixes PARTITION_DEPTH levels below
+        # prefix (collector/topic/partition), each from its watermark: the last
+        # name up to which all objects have been ingested
+        self.partition_depth = conf['AWS'].get('PARTITION_DEPTH', 3)
+        self.watermarks = conf['AWS'].get('WATERMARKS') or \
+            "%s.watermarks.json" % re.sub(r'[^\w.-]+', '_', self.endpoint.split('://')[-1]).strip('_')
+        self.listed = {}
+        # names accepted by a server ingesting asynchronously in this run
+        self.spooled = set()
+
+        self._store_args = (store_id, store_secret, store_url, bucket)
+        self._local = threading.local()
         try:
-            self.aws = Namespace(store_id, store_secret, store_url, bucket)
+            self.aws = Namespace(*self._store_args)
         except Exception:
             raise ConnectionError("Cannot connect object store.")
 
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.uploaders)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         logger.debug('Ingest from store prefix %s into %s', self.prefix, self.endpoint)
 
     def _make_request(self, query):
@@ -74,14 +142,18 @@ class Ingester:
     @staticmethod
     def _verify_exist(rst):
         """Check the response for verifying existence"""
-        if not rst:
+        if rst is None:
             return False
 
-        if rst.status_code == 204:
-            # ingested successfully will receive 204 not 200
+        if rst.status_code in (202, 204):
+            # ingested successfully will receive 204 not 200, or 202 when
+            # the server ingests asynchronously
             return True
         elif rst.status_code == 200:
             return len(rst.json()) > 0
+        elif rst.status_code == 409:
+            # duplicate of an ingested input
+            return True
 
         logger.error("HTTP error %d", rst.status_code)
         return False
@@ -92,17 +164,27 @@ class Ingester:
         rst = self._make_request(query)
         return self._verify_exist(rst)
 
-    def _put(self, name, data):
-        return requests.put("%s/ingest?name=%s" % (self.endpoint, name),
-                            headers={
-                                "content-type": "application/json",
-                                "x-ersa-auth-token": self.token},
-                            data=json.dumps(data))
+    def _upload(self, name, body, encoding=None):
+        headers = {"content-type": "application/json",
+                   "x-ersa-auth-token": self.token}
+        if encoding:
+            headers["content-encoding"] = encoding
+        return self.session.put("%s/ingest" % self.endpoint,
+                                params={"name": name},
+                                headers=headers,
+                                data=body,
+                                timeout=(TIMEOUT, self.upload_timeout))
 
     def fetch(self, name):
         logger.debug("Retrieve and decompress %s from AWS", name)
         return json.loads(lzma.decompress(self.aws.get(name)).decode("utf-8"))
 
+    def _store(self):
+        """Connection to object store of the current thread"""
+        if not hasattr(self._local, 'aws'):
+            self._local.aws = Namespace(*self._store_args)
+        return self._local.aws
+
     def get_latest_input(self):
         """Get the latest input from database
 
@@ -120,15 +202,20 @@ class Ingester:
         return ''
 
     def list_ingested(self):
-        """List the ingested messages files in input table of database through API server"""
-        page = 1
+        """List the ingested messages files in input table of database through API server
+
+        Pages are walked by cursor (keyset pagination) to avoid counting and
+        skipping rows of a large input table.
+        """
+        cursor = ''
         names = []
         SIZE = 5000   # page size
 
         while True:
-            url = "%s/input?count=%d&page=%s" % (self.endpoint, SIZE, page)
+            url = "%s/input" % self.endpoint
+            params = {"count": SIZE, "after": cursor}
             try:
-                batch = requests.get(url, headers={"x-ersa-auth-token": self.token}, timeout=TIMEOUT)
+                batch = requests.get(url, params=params, headers={"x-ersa-auth-token": self.token}, timeout=TIMEOUT)
             except requests.ConnectTimeout:
                 logger.warning('Query to DB for input timed out. url=%s', url)
                 raise RuntimeError('Cannot connect to DB')
@@ -142,17 +229,157 @@ class Ingester:
                 # new code always has status_code == 200 but json can be empty list
                 records = batch.json()
                 if len(records) > 0:
-                    names += [item["name"] for item in batch.json()]
-                    logger.debug("%d pages loaded", page)
-                    page += 1
-                    if len(records) < SIZE:
+                    names += [item["name"] for item in records]
+                    logger.debug("%d names loaded", len(names))
+                    cursor = batch.headers.get(CURSOR_HEADER)
+                    if len(records) < SIZE or not cursor:
                         break
                 else:
                     break
 
         return names
 
+    def list_missing(self, names):
+        """Filter names to those not ingested by the API server
+
+        Returns None if the server cannot do it.
+        """
+        url = "%s/input/missing" % self.endpoint
+        try:
+            rst = requests.post(url, json=names, headers={"x-ersa-auth-token": self.token}, timeout=TIMEOUT)
+        except requests.ConnectTimeout:
+            logger.warning('Query to DB for missing input timed out. url=%s', url)
+            raise RuntimeError('Cannot connect to DB')
+        if rst.status_code in (404, 405):
+            return None
+        elif rst.status_code != 200:
+            raise IOError("HTTP %s" % rst.status_code)
+        return rst.json()
+
+    def find_missing(self, names):
+        """Set of names not ingested by the API server, asked in chunks"""
+        SIZE = 5000   # chunk size
+        missing = set()
+        for start in range(0, len(names), SIZE):
+            chunk = self.list_missing(names[start:start + SIZE])
+            if chunk is None:
+                return set(names) - set(self.list_ingested())
+            missing.update(chunk)
+        return missing
+
+    def load_watermarks(self):
+        """Load watermarks of partitions saved by previous runs"""
+        try:
+            with open(self.watermarks, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_watermarks(self, watermarks):
+        tmp = "%s.tmp" % self.watermarks
+        with open(tmp, 'w') as f:
+            json.dump(watermarks, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.watermarks)
+
+    def _partitions(self):
+        """Discover partitions under prefix level by level
+
+        :return tuple, partitions and names of objects found above them
+        """
+        partitions, loose = [self.prefix], []
+        for _ in range(self.partition_depth):
+            level = []
+            for prefix in partitions:
+                for item in self.aws.list(prefix=prefix, folder_only=True):
+                    (level if item.name.endswith("/") else loose).append(item.name)
+            partitions = level
+        return partitions, loose
+
+    def partition_of(self, name):
+        """Partition of a name, the prefix PARTITION_DEPTH levels below prefix
+
+        Names above partitions are in the partition of prefix.
+        """
+        folders = name[len(self.prefix):].split("/")[:-1]
+        return self.prefix + "".join(folder + "/" for folder in folders[:self.partition_depth])
+
+    def interleave(self, names):
+        """Order names by partitions in turn, names of a partition in order"""
+        partitions = OrderedDict()
+        for name in sorted(names):
+            partitions.setdefault(self.partition_of(name), []).append(name)
+        return [name for names in zip_longest(*partitions.values()) for name in names if name is not None]
+
+    def _wanted(self, name):
+        return not name.endswith("/") and (not self.substring or self.substring in name)
+
+    def _list_partition(self, partition, marker):
+        return [item.name for item in self._store().list(prefix=partition, marker=marker)
+                if self._wanted(item.name)]
+
+    def _list_objects(self):
+        """Names of archived packages of messages in object store after watermarks
+
+        Partitions are listed concurrently, names listed are kept in listed
+        for advancing watermarks after they are ingested.
+        """
+        watermarks = self.load_watermarks()
+        partitions, loose = self._partitions()
+        logger.debug("Listing %d partitions", len(partitions))
+        with concurrent.futures.ThreadPoolExecutor(self.fetchers) as pool:
+            listings = pool.map(lambda partition: self._list_partition(partition, watermarks.get(partition, '')),
+                                partitions)
+            self.listed = dict(zip(partitions, listings))
+
+        yield from (name for name in loose if self._wanted(name))
+        for names in self.listed.values():
+            yield from names
+
+    def advance_watermarks(self, errors):
+        """Move watermarks of listed partitions to their last names before any not ingested
+
+        A name is ingested when the API server has recorded it in input table.
+        Names spooled in this run stay above watermarks, as their ingestion can
+        still fail and remove the record, until a later run finds them recorded.
+        """
+        stop = set(name for name, _, _ in errors) | self.spooled
+        watermarks = self.load_watermarks()
+        for partition, names in self.listed.items():
+            names = sorted(names)
+            missing = self.find_missing(names)
+            for name in names:
+                if name in stop or name in missing:
+                    break
+                watermarks[partition] = name
+        self.save_watermarks(watermarks)
+
     def _prepare_batch_list(self):
+        """Find json.xz in AWS which have not been ingested
+
+        Object names are sent in chunks to the API server which returns those
+        not in input table. For servers without that, inputs are all listed.
+        """
+        SIZE = 5000   # chunk size
+        logger.debug("Get list of archived packages of messages from object store")
+        todo = []
+        count = 0
+        objects = self._list_objects()
+        while True:
+            chunk = list(islice(objects, SIZE))
+            if not chunk:
+                break
+            missing = self.list_missing(chunk)
+            if missing is None:
+                return self._prepare_batch_list_by_ingested()
+            count += len(chunk)
+            todo.extend(missing)
+
+        logger.info("%s objects, %s already ingested, %s todo",
+                    count, count - len(todo), len(todo))
+
+        return todo
+
+    def _prepare_batch_list_by_ingested(self):
         """Query input table and process json.xz in AWS which have not been ingested"""
         # The list can be very long if prefix is not used
         logger.debug("Getting list of archived packages of messages from database through API")
@@ -160,13 +387,7 @@ class Ingester:
         ingested = set(ingested)
 
         logger.debug("Get list of archived packages of messages from object store")
-        all_items = [item.name for item in self.aws.list(prefix=self.prefix)
-                     if not item.name.endswith("/")]
-
-        if self.substring:
-            all_items = [item for item in all_items if self.substring in item]
-
-        all_items = set(all_items)
+        all_items = set(self._list_objects())
 
         todo = list(all_items - ingested)
 
@@ -179,30 +400,149 @@ class Ingester:
         # end point is defined in config json file
         # As individual job is registered in input, set comparison should be avoid when numbers are too high
         logger.debug("Preparing list")
+        self.spooled = set()
         todo = self._prepare_batch_list()
-        for name in todo:
-            logger.debug(name)
-            data = self.fetch(name)
-            if self.schema:
-                data = [item for item in data if item["schema"] == self.schema]
+        errors = self.pipeline(todo)
+        self.advance_watermarks(errors)
+        return errors
 
-            tracking_name = name
+    def pipeline(self, names):
+        """Ingest objects of names through concurrent stages
 
-            success = self._verify_exist(self._put(tracking_name, data))
-            if not success:
-                logger.error("%s was not ingested", name)
+        Objects are fetched by a thread pool, decoded by a process pool and
+        uploaded by a thread pool. Without a schema to filter messages, objects
+        are uploaded as they are, compressed by xz. A new object is fetched only when there
+        are less than in_flight objects in the pipeline. Errors are logged
+        in the order of names at the end with the throughput of each stage.
 
-    def _log_put(self, tracking_name, data):
-        success = self._verify_exist(self._put(tracking_name, data))
-        if not success:
-            logger.error("%s was not ingested", tracking_name)
+        Objects of a partition are uploaded one at a time in name order, as
+        the server ingests snapshots of a host in time order. After one of
+        them fails, the rest of its partition is not uploaded in this run.
+
+        :return list of (name, stage, error) of failed objects
+        """
+        stages = {name: Stage(name) for name in ('fetch', 'decode', 'upload')}
+        errors = {}
+        slots = threading.BoundedSemaphore(self.in_flight)
+        start = time.perf_counter()
+        names = self.interleave(names)
+
+        # indexes of names waiting to be uploaded by partitions, their bodies
+        # when ready, partitions uploading and those with a failure
+        queues = {}
+        for index, name in enumerate(names):
+            queues.setdefault(self.partition_of(name), deque()).append(index)
+        ready = {}
+        uploading = set()
+        blocked = set()
+        lock = threading.RLock()
+
+        def failed(index, name, stage, error):
+            errors[index] = (name, stage, error)
+            slots.release()
+
+        def dispatch(partition):
+            """Upload the next object of a partition when it is ready and none is uploading."""
+            with lock:
+                queue = queues[partition]
+                while queue and queue[0] in ready and partition not in uploading:
+                    index = queue.popleft()
+                    name, body, encoding = ready.pop(index)
+                    if body is None:
+                        blocked.add(partition)
+                    elif partition in blocked:
+                        failed(index, name, 'upload', "an earlier object of %s was not ingested" % partition)
+                    else:
+                        uploading.add(partition)
+                        upload_pool.submit(upload, name, body, encoding).add_done_callback(
+                            partial(uploaded, index, name, partition))
+
+        def prepared(index, name, body, encoding=None):
+            """Queue the body of an object for upload, None when it has failed."""
+            partition = self.partition_of(name)
+            with lock:
+                ready[index] = (name, body, encoding)
+            dispatch(partition)
+
+        def fetch(name):
+            begin = time.perf_counter()
+            raw = self._store().get(name)
+            stages['fetch'].add(len(raw), time.perf_counter() - begin)
+            return raw
+
+        def upload(name, body, encoding=None):
+            begin = time.perf_counter()
+            rst = self._upload(name, body, encoding)
+            stages['upload'].add(len(body), time.perf_counter() - begin)
+            if not self._verify_exist(rst):
+                raise IOError("HTTP %s" % (rst.status_code if rst is not None else 'no response'))
+            if rst.status_code == 202:
+                self.spooled.add(name)
+
+        def fetched(index, name, future):
+            try:
+                raw = future.result()
+                if self.schema:
+                    decode_pool.submit(decode, raw, self.schema).add_done_callback(partial(decoded, index, name))
+                else:
+                    prepared(index, name, raw, 'xz')
+            except Exception as err:
+                failed(index, name, 'fetch', err)
+                prepared(index, name, None)
+
+        def decoded(index, name, future):
+            try:
+                body, count, seconds = future.result()
+                stages['decode'].add(len(body), seconds)
+                logger.debug("%s has %d messages", name, count)
+                prepared(index, name, body)
+            except Exception as err:
+                failed(index, name, 'decode', err)
+                prepared(index, name, None)
+
+        def uploaded(index, name, partition, future):
+            try:
+                future.result()
+            except Exception as err:
+                with lock:
+                    blocked.add(partition)
+                failed(index, name, 'upload', err)
+            else:
+                slots.release()
+            with lock:
+                uploading.discard(partition)
+            dispatch(partition)
+
+        with concurrent.futures.ThreadPoolExecutor(self.fetchers) as fetch_pool, \
+                concurrent.futures.ProcessPoolExecutor(self.decoders) as decode_pool, \
+                concurrent.futures.ThreadPoolExecutor(self.uploaders) as upload_pool:
+            for index, name in enumerate(names):
+                slots.acquire()
+                logger.debug(name)
+                fetch_pool.submit(fetch, name).add_done_callback(partial(fetched, index, name))
+            # wait for the pipeline to be drained
+            for _ in range(self.in_flight):
+                slots.acquire()
+
+        wall = time.perf_counter() - start
+        for stage in stages.values():
+            logger.info(stage.summary(wall))
+        for index in sorted(errors):
+            name, stage, error = errors[index]
+            logger.error("%s was not ingested: %s failed. %s", name, stage, error)
+        logger.info("%d objects ingested, %d failed in %.1fs", len(names) - len(errors), len(errors), wall)
+
+        return [errors[index] for index in sorted(errors)]
 
     def put_single_xz(self, xz_name, input_name):
         # This deal with local files for debug purpose, it will ingest each message separately in a xz file
-        with lzma.LZMAFile(xz_name) as f:
-            data = json.loads(f.read().decode("utf-8"))
+        # The file is sent compressed as it is
+        with open(xz_name, 'rb') as f:
+            body = f.read()
 
-        self._log_put(input_name, data)
+        success = self._verify_exist(self._upload(input_name, body, 'xz'))
+        if not success:
+            logger.error("%s was not ingested", input_name)
 
     def put_local_xz(self, xz_name, input_name, check=False):
         # By default not check if exist as it can be very slow
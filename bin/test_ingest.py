@@ -1,3 +1,9 @@
+import os
+import json
+import lzma
+import shutil
+import tempfile
+import time
 import unittest
 from unittest.mock import Mock, patch
 import requests
@@ -37,3 +43,150 @@ class IngestTestCase(unittest.TestCase):
             result = ingester.list_ingested()
             self.assertIsInstance(result, list)
             self.assertEqual(len(result), 2)
+
+    @patch('ingest.Namespace', return_value=None)
+    def test_list_ingested_follows_cursor(self, mock_aws):
+        conf = read_conf('example-config.json')
+        ingester = Ingester(conf)
+
+        full = Mock(status_code=200, headers={'X-Next-Cursor': 'next'})
+        full.json.return_value = [{'name': str(i)} for i in range(5000)]
+        last = Mock(status_code=200, headers={})
+        last.json.return_value = [{'name': 'last'}]
+        with patch('requests.get', side_effect=[full, last]) as mock_get:
+            result = ingester.list_ingested()
+            self.assertEqual(len(result), 5001)
+            self.assertEqual(mock_get.call_args_list[0][1]['params']['after'], '')
+            self.assertEqual(mock_get.call_args_list[1][1]['params']['after'], 'next')
+
+    @patch('ingest.Namespace', return_value=None)
+    def test_prepare_batch_list_by_missing(self, mock_aws):
+        conf = read_conf('example-config.json')
+        ingester = Ingester(conf)
+        ingester.substring = ''
+        ingester.partition_depth = 0
+        ingester.watermarks = 'missing.watermarks.json'
+        ingester.aws = Mock()
+        ingester.aws.list.return_value = [Mock() for _ in range(3)]
+        for item, name in zip(ingester.aws.list.return_value, ('a', 'b/', 'c')):
+            item.name = name
+        ingester._store = Mock(return_value=ingester.aws)
+
+        missing = Mock(status_code=200)
+        missing.json.return_value = ['c']
+        with patch('requests.post', return_value=missing) as mock_post:
+            self.assertEqual(ingester._prepare_batch_list(), ['c'])
+            self.assertEqual(mock_post.call_args[1]['json'], ['a', 'c'])
+
+        with patch('requests.post', return_value=Mock(status_code=404)), \
+                patch.object(ingester, 'list_ingested', return_value=['a']):
+            self.assertEqual(ingester._prepare_batch_list(), ['c'])
+
+    @patch('ingest.Namespace', return_value=None)
+    def test_pipeline(self, mock_aws):
+        conf = read_conf('example-config.json')
+        conf['PIPELINE'] = {'FETCHERS': 2, 'DECODERS': 2, 'UPLOADERS': 2, 'IN_FLIGHT': 3}
+        ingester = Ingester(conf)
+        ingester.schema = 'a'
+        ingester.prefix = 'p/'
+        ingester.partition_depth = 1
+        objects = {'p/%d/%d' % (i % 2, i): lzma.compress(json.dumps([{'schema': 'a', 'data': i}, {'schema': 'b'}]).encode())
+                   for i in range(10)}
+        objects['p/1/5'] = b'broken'
+        ingester._store = Mock(return_value=Mock(get=objects.get))
+        uploaded = {}
+        order = []
+        active = set()
+
+        def upload(name, body, encoding=None):
+            partition = ingester.partition_of(name)
+            self.assertNotIn(partition, active)
+            active.add(partition)
+            time.sleep(0.01)
+            active.discard(partition)
+            if encoding == 'xz':
+                body = lzma.decompress(body)
+            uploaded[name] = json.loads(body.decode())
+            order.append(name)
+            return Mock(status_code={'p/0/6': 500, 'p/1/3': 202}.get(name, 204))
+
+        ingester._upload = upload
+        errors = ingester.pipeline(sorted(objects, reverse=True))
+        # the rest of a partition is not uploaded after a failure
+        self.assertEqual(sorted((name, stage) for name, stage, _ in errors),
+                         [('p/0/6', 'upload'), ('p/0/8', 'upload'), ('p/1/5', 'decode'),
+                          ('p/1/7', 'upload'), ('p/1/9', 'upload')])
+        self.assertEqual(sorted(uploaded), ['p/0/0', 'p/0/2', 'p/0/4', 'p/0/6', 'p/1/1', 'p/1/3'])
+        for partition in ('p/0/', 'p/1/'):
+            names = [name for name in order if name.startswith(partition)]
+            self.assertEqual(names, sorted(names))
+        self.assertEqual(ingester.spooled, {'p/1/3'})
+        self.assertEqual(uploaded['p/0/2'], [{'schema': 'a', 'data': 2}])
+
+        # objects are uploaded compressed as they are without a schema filter
+        ingester.schema = ''
+        uploaded.clear()
+        del objects['p/1/5']
+        errors = ingester.pipeline(sorted(objects))
+        self.assertEqual([(name, stage) for name, stage, _ in errors], [('p/0/6', 'upload'), ('p/0/8', 'upload')])
+        self.assertEqual(uploaded['p/1/3'], [{'schema': 'a', 'data': 3}, {'schema': 'b'}])
+
+    @patch('ingest.Namespace', return_value=None)
+    def test_interleave(self, mock_aws):
+        ingester = Ingester(read_conf('example-config.json'))
+        ingester.prefix = 'p/'
+        ingester.partition_depth = 2
+        self.assertEqual(ingester.partition_of('p/t/0/a/1'), 'p/t/0/')
+        self.assertEqual(ingester.partition_of('p/1'), 'p/')
+        self.assertEqual(ingester.interleave(['p/t/1/2', 'p/t/0/2', 'p/t/1/1', 'p/t/0/1', 'p/t/0/3']),
+                         ['p/t/0/1', 'p/t/1/1', 'p/t/0/2', 'p/t/1/2', 'p/t/0/3'])
+
+    @patch('ingest.Namespace', return_value=None)
+    def test_watermarks(self, mock_aws):
+        conf = read_conf('example-config.json')
+        ingester = Ingester(conf)
+        ingester.substring = ''
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        ingester.watermarks = os.path.join(path, 'watermarks.json')
+        ingester.save_watermarks({'p/t/0/': 'p/t/0/2'})
+
+        def keys(*names):
+            items = [Mock() for _ in names]
+            for item, name in zip(items, names):
+                item.name = name
+            return items
+
+        folders = {'p/': keys('p/t/'), 'p/t/': keys('p/t/0/', 'p/t/1/'), 'p/t/0/': [], 'p/t/1/': []}
+        objects = {'p/t/0/': keys('p/t/0/3', 'p/t/0/4'), 'p/t/1/': keys('p/t/1/1', 'p/t/1/2')}
+
+        def listing(prefix='', marker='', folder_only=False):
+            if folder_only:
+                return folders[prefix]
+            return [item for item in objects[prefix] if item.name > marker]
+
+        ingester.prefix = 'p/'
+        ingester.partition_depth = 2
+        ingester.aws = Mock(list=Mock(side_effect=listing))
+        ingester._store = Mock(return_value=ingester.aws)
+        self.assertEqual(sorted(ingester._list_objects()), ['p/t/0/3', 'p/t/0/4', 'p/t/1/1', 'p/t/1/2'])
+
+        missing = Mock(status_code=200)
+        missing.json.return_value = ['p/t/1/2']
+        with patch('requests.post', return_value=missing):
+            ingester.advance_watermarks([('p/t/1/2', 'upload', 'failed')])
+        self.assertEqual(ingester.load_watermarks(), {'p/t/0/': 'p/t/0/4', 'p/t/1/': 'p/t/1/1'})
+
+        # a spooled name is not passed until it is recorded, nor one not recorded
+        ingester.spooled = {'p/t/0/3'}
+        missing.json.return_value = ['p/t/1/1']
+        ingester.save_watermarks({})
+        with patch('requests.post', return_value=missing):
+            ingester.advance_watermarks([])
+        self.assertEqual(ingester.load_watermarks(), {})
+
+        ingester.spooled = set()
+        missing.json.return_value = []
+        with patch('requests.post', return_value=missing):
+            ingester.advance_watermarks([])
+        self.assertEqual(ingester.load_watermarks(), {'p/t/0/': 'p/t/0/4', 'p/t/1/': 'p/t/1/2'})
@@ -10,6 +10,7 @@ setup(name="ersa-reporting",
       version="2.2.0",
       install_requires=["flask>=0.10.1", "flask-restful", "flask-cors",
                         "flask-sqlalchemy", "psycopg2", "requests", "arrow",
+                        "prometheus_client",
                         "python-keystoneclient", "python-novaclient"],
       py_modules=["nectar", "utils"],
       packages=["unified", "unified.apis", "unified.models"],
@@ -1,8 +1,10 @@
 import os
 import sys
+import time
 import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy as SA
+from sqlalchemy.pool import QueuePool
 
 if 'APP_SETTINGS' not in os.environ:
     sys.exit('Missing APP_SETTINGS environment variable')
@@ -15,6 +17,19 @@ app = Flask("app")
 app.config.from_envvar('APP_SETTINGS')
 
 
+class TimedQueuePool(QueuePool):
+    """QueuePool which reports seconds waited for each checkout to on_checkout"""
+    on_checkout = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.on_checkout is not None:
+                self.on_checkout(time.perf_counter() - start)
+
+
 class SQLAlchemy(SA):
     """Apply pessimistic database connection checking provided by sqlalchemy, see:
         https://docs.sqlalchemy.org/en/latest/core/pooling.html#pool-disconnects-pessimistic
@@ -24,6 +39,7 @@ class SQLAlchemy(SA):
     def apply_pool_defaults(self, app, options):
         SA.apply_pool_defaults(self, app, options)
         options["pool_pre_ping"] = True
+        options["poolclass"] = TimedQueuePool
 
 
 db = SQLAlchemy(app)
@@ -1,4 +1,12 @@
+import io
+import os
+import gzip
+import json
+import lzma
+import time
 import uuid
+import base64
+import tempfile
 import requests
 
 import logging
@@ -7,25 +15,55 @@ import logging.handlers
 import flask_restful
 
 from functools import wraps
-from flask import request
+from inspect import getattr_static
+from itertools import islice
+from collections import namedtuple, Counter
+from flask import request, Response, stream_with_context
+from flask import json as flask_json
 from flask_cors import CORS
-from flask_restful import Resource, reqparse
+from flask_restful import Resource, reqparse, unpack
+from flask_restful.representations.json import output_json
+from sqlalchemy import and_, or_, tuple_, inspect, text, bindparam, String
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from sqlalchemy.orm.attributes import QueryableAttribute
 from sqlalchemy.orm.relationships import RelationshipProperty
 
-from .. import db, app
-from ..models import Input
+from .. import db, app, TimedQueuePool
+from ..models import Input, IngestJob, YIELD_PER, STRIP_ID, CLIENT_GENERATED_IDS
+from .cache import TTLCache, ResultCache, MemoryBackend, DiskBackend, SingleFlight
+from . import profiling, metrics
+from .spool import Spool
+from .resolver import Resolver, DimensionCache, bulk_insert
+from .loader import CopyLoader
+
+# Response header of the cursor of the next page in keyset pagination
+CURSOR_HEADER = "X-Next-Cursor"
+# Newline delimited JSON for streaming large collections
+NDJSON = "application/x-ndjson"
 
 restapi = flask_restful.Api(app)
-cors = CORS(app)
+cors = CORS(app, expose_headers=[CURSOR_HEADER, "Server-Timing"])
+
+
+@restapi.representation("application/json")
+def timed_output_json(data, code, headers=None):
+    """Serialise data to JSON as flask_restful does and time it."""
+    with profiling.timed("serialise"):
+        return output_json(data, code, headers)
+
 
 QUERY_PARSER = reqparse.RequestParser()
 QUERY_PARSER.add_argument("filter", action="append", help="Filter")
-QUERY_PARSER.add_argument("order", help="Ordering", default="id")
+QUERY_PARSER.add_argument("order", help="Ordering, default_order of the resource if not given")
 QUERY_PARSER.add_argument("page", type=int, default=1, help="Page #")
 QUERY_PARSER.add_argument("count",
                           type=int,
                           default=1000,
                           help="Items per page")
+QUERY_PARSER.add_argument("after",
+                          help="Cursor of the next page, empty for the first")
+QUERY_PARSER.add_argument("fields",
+                          help="Comma separated names of returned attributes")
 
 # All defalut time range arguments
 RANGE_PARSER = reqparse.RequestParser()
@@ -35,6 +73,15 @@ RANGE_PARSER.add_argument("end", type=int, default=0)
 INPUT_PARSER = reqparse.RequestParser()
 INPUT_PARSER.add_argument("name", location="args", required=True)
 
+# Maximum number of candidate names in a request of missing inputs
+MISSING_BATCH = 10000
+MISSING_QUERY = text("""
+    SELECT candidate.name
+      FROM unnest(:names) WITH ORDINALITY AS candidate(name, position)
+     WHERE NOT EXISTS (SELECT 1 FROM input WHERE input.name = candidate.name)
+     ORDER BY candidate.position
+""").bindparams(bindparam("names", type_=ARRAY(String)))
+
 
 PACKAGE = ''
 if "ERSA_REPORTING_PACKAGE" in app.config:
@@ -47,6 +94,29 @@ if "ERSA_AUTH_TOKEN" in app.config:
 if AUTH_TOKEN is not None:
     AUTH_TOKEN = AUTH_TOKEN.lower()
 
+# Remote token validation: validated tokens are cached with their allowed
+# endpoints for AUTH_CACHE_TTL seconds, rejected ones for AUTH_CACHE_NEGATIVE_TTL
+AUTH_URL = "https://reporting.ersa.edu.au/auth"
+if "AUTH_URL" in app.config:
+    AUTH_URL = app.config["AUTH_URL"]
+
+AUTH_CACHE_TTL = 300
+if "AUTH_CACHE_TTL" in app.config:
+    AUTH_CACHE_TTL = app.config["AUTH_CACHE_TTL"]
+
+AUTH_CACHE_NEGATIVE_TTL = 30
+if "AUTH_CACHE_NEGATIVE_TTL" in app.config:
+    AUTH_CACHE_NEGATIVE_TTL = app.config["AUTH_CACHE_NEGATIVE_TTL"]
+
+AUTH_CACHE_SIZE = 1000
+if "AUTH_CACHE_SIZE" in app.config:
+    AUTH_CACHE_SIZE = app.config["AUTH_CACHE_SIZE"]
+
+AUTH_TIMEOUT = 10
+
+auth_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+auth_session = requests.Session()
+
 UUID_NAMESPACE = uuid.UUID("aeb7cf1c-a842-4592-82e9-55d2dad00150")
 
 if "LOG_DIR" in app.config:
@@ -70,6 +140,84 @@ LOG_FORMATTER = logging.Formatter(LOG_FORMAT, SAN_MS_DATE)
 
 top_logger = logging.getLogger(__name__)
 
+# Cache of RangeQuery results: None (disabled), "memory" (per process)
+# or "disk" (shared by processes through RESULT_CACHE_DIR)
+RESULT_CACHE = None
+if "RESULT_CACHE" in app.config:
+    RESULT_CACHE = app.config["RESULT_CACHE"]
+
+RESULT_CACHE_TTL = 300
+if "RESULT_CACHE_TTL" in app.config:
+    RESULT_CACHE_TTL = app.config["RESULT_CACHE_TTL"]
+
+# Results of ranges entirely in the past live longer, an ingest of a snapshot
+# in their ranges evicts them, but only in its own worker with memory cache
+RESULT_CACHE_PAST_TTL = 3600
+if "RESULT_CACHE_PAST_TTL" in app.config:
+    RESULT_CACHE_PAST_TTL = app.config["RESULT_CACHE_PAST_TTL"]
+
+RESULT_CACHE_SIZE = 1000
+if "RESULT_CACHE_SIZE" in app.config:
+    RESULT_CACHE_SIZE = app.config["RESULT_CACHE_SIZE"]
+
+if "RESULT_CACHE_DIR" in app.config:
+    RESULT_CACHE_DIR = app.config["RESULT_CACHE_DIR"]
+else:
+    RESULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ersa-reporting-cache", PACKAGE)
+
+MISSING = object()
+result_cache = None
+if RESULT_CACHE == "memory":
+    result_cache = ResultCache(MemoryBackend(RESULT_CACHE_SIZE, RESULT_CACHE_TTL), RESULT_CACHE_TTL,
+                               RESULT_CACHE_PAST_TTL)
+elif RESULT_CACHE == "disk":
+    result_cache = ResultCache(DiskBackend(RESULT_CACHE_DIR), RESULT_CACHE_TTL, RESULT_CACHE_PAST_TTL)
+
+# Identical concurrent queries are coalesced in a process, and across processes
+# through lock files when their results are shared by the disk cache
+if RESULT_CACHE == "disk":
+    single_flight = SingleFlight(os.path.join(RESULT_CACHE_DIR, "locks"))
+else:
+    single_flight = SingleFlight()
+
+# Requests taking at least SLOW_REQUEST_MS milliseconds are logged with their
+# slowest SQL statements, None to disable
+SLOW_REQUEST_MS = 5000
+if "SLOW_REQUEST_MS" in app.config:
+    SLOW_REQUEST_MS = app.config["SLOW_REQUEST_MS"]
+
+profiling.init_app(app, SLOW_REQUEST_MS)
+metrics.init_app(app, TimedQueuePool)
+
+# Asynchronous ingestion: bodies are saved in SPOOL_DIR and ingested by
+# SPOOL_WORKERS threads of each process, PUT /ingest returns 202 at once.
+# SPOOL_DIR is required as accepted bodies are only there until ingested
+ASYNC_INGEST = False
+if "ASYNC_INGEST" in app.config:
+    ASYNC_INGEST = app.config["ASYNC_INGEST"]
+
+SPOOL_DIR = None
+if "SPOOL_DIR" in app.config:
+    SPOOL_DIR = app.config["SPOOL_DIR"]
+
+SPOOL_WORKERS = 1
+if "SPOOL_WORKERS" in app.config:
+    SPOOL_WORKERS = app.config["SPOOL_WORKERS"]
+
+# Messages whose dimensions are resolved together in ingestion
+INGEST_BATCH = 100
+if "INGEST_BATCH" in app.config:
+    INGEST_BATCH = app.config["INGEST_BATCH"]
+
+# Ids of dimensions kept by each process for ingestion, per model
+DIMENSION_CACHE_SIZE = 10000
+if "DIMENSION_CACHE_SIZE" in app.config:
+    DIMENSION_CACHE_SIZE = app.config["DIMENSION_CACHE_SIZE"]
+
+DIMENSION_CACHE_TTL = 3600
+if "DIMENSION_CACHE_TTL" in app.config:
+    DIMENSION_CACHE_TTL = app.config["DIMENSION_CACHE_TTL"]
+
 
 # Logger is created by the calling module with the calling module's name as log name
 # All other modules use this log
@@ -89,6 +237,11 @@ def identifier(content):
     return str(uuid.uuid5(UUID_NAMESPACE, str(content)))
 
 
+def dimension_id(model, key):
+    """Generate the id of a dimension from its model and key."""
+    return identifier((model.__tablename__, key))
+
+
 def is_uuid(id):
     """Verify if a string is an UUID"""
     try:
@@ -173,6 +326,32 @@ def constant_time_compare(val1, val2):
     return result == 0
 
 
+def allowed_endpoints(token):
+    """Get names of endpoints a token is allowed to access.
+
+    Answers of the external reporting-auth service are cached: a rejected
+    token gets an empty set which lives shorter than a validated one.
+    Failures of the service itself are not cached.
+    """
+    endpoints = auth_cache.get(token)
+    if endpoints is not None:
+        return endpoints
+
+    auth_response = auth_session.get(AUTH_URL, params={"secret": token},
+                                     timeout=AUTH_TIMEOUT)
+    if auth_response.status_code == 200:
+        endpoints = frozenset(endpoint["name"]
+                              for endpoint in auth_response.json()["endpoints"])
+        auth_cache.set(token, endpoints)
+    elif 400 <= auth_response.status_code < 500:
+        endpoints = frozenset()
+        auth_cache.set(token, endpoints, ttl=AUTH_CACHE_NEGATIVE_TTL)
+    else:
+        top_logger.error("Auth service responded with HTTP %d" % auth_response.status_code)
+        endpoints = frozenset()
+    return endpoints
+
+
 def require_auth(func):
     """
     Authenticate via the external reporting-auth service.
@@ -192,18 +371,12 @@ def require_auth(func):
         except:     # noqa: E722
             return "", 403
 
-        if AUTH_TOKEN is not None:
-            if constant_time_compare(token, AUTH_TOKEN):
-                success = True
-        else:
-            auth_response = requests.get(
-                "https://reporting.ersa.edu.au/auth?secret=%s" % token)
-            if auth_response.status_code == 200:
-                auth_data = auth_response.json()
-                for endpoint in auth_data["endpoints"]:
-                    if endpoint["name"] == PACKAGE:
-                        success = True
-                        break
+        with profiling.timed("auth"):
+            if AUTH_TOKEN is not None:
+                if constant_time_compare(token, AUTH_TOKEN):
+                    success = True
+            else:
+                success = PACKAGE in allowed_endpoints(token)
 
         if success:
             return func(*args, **kwargs)
@@ -249,24 +422,215 @@ def name_or_id(model, name):
         return None
 
 
-def do_query(model):
-    """Perform a query with request-specified filtering and ordering."""
-    args = QUERY_PARSER.parse_args()
+def order_columns(model, order_specs):
+    """Parse ordering into a list of (column, descending) tuples.
+
+    Primary key columns are appended when not present to make the
+    ordering unique, which keyset pagination depends on.
+    """
+    order = []
+    for order_spec in order_specs.split(","):
+        if not order_spec.startswith("-"):
+            order.append((name_or_id(model, order_spec), False))
+        else:
+            order.append((name_or_id(model, order_spec[1:]), True))
+    ordered = set(column.key for column, _ in order)
+    for column in inspect(model).primary_key:
+        if column.key not in ordered:
+            order.append((getattr(model, column.key), False))
+    return order
+
+
+class QueryArgumentError(ValueError):
+    """An argument of a query which cannot be used, an error of the request"""
+
+
+class CursorError(QueryArgumentError):
+    """A cursor of keyset pagination which cannot be used"""
+
+
+class FieldError(QueryArgumentError):
+    """A requested field which is not a column of the model"""
+
+
+class SerialisationError(RuntimeError):
+    """Selected rows cannot be serialised by json() of their model"""
+
+
+def encode_cursor(values):
+    """Encode values of ordering columns into an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps(list(values), default=str).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into values of ordering columns."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise CursorError("Malformed cursor")
+    if not isinstance(values, list):
+        raise CursorError("Malformed cursor")
+    return values
+
+
+def seek_filter(order, values):
+    """Build a predicate of rows after values in the order.
+
+    Columns in the same direction are compared as a row: (a, b) > (x, y),
+    otherwise the comparison is expanded column by column.
+    """
+    if len(values) != len(order):
+        raise CursorError("Cursor does not match ordering")
+    columns = [column for column, _ in order]
+    descending = set(desc for _, desc in order)
+    if len(descending) == 1:
+        if descending.pop():
+            return tuple_(*columns) < tuple_(*values)
+        return tuple_(*columns) > tuple_(*values)
+
+    clauses = []
+    for i, (column, desc) in enumerate(order):
+        equals = [c == v for c, v in zip(columns[:i], values[:i])]
+        after = column < values[i] if desc else column > values[i]
+        clauses.append(and_(*(equals + [after])))
+    return or_(*clauses)
+
+
+def row_type(model, keys):
+    """Create a light tuple type of columns of a model to be passed to its json().
+
+    Other attributes are looked up in the model: class attributes are
+    returned and methods are bound to the row, relationships are missing.
+    """
+    base = namedtuple(model.__name__ + "Row", keys)
+
+    def __getattr__(self, name):
+        value = getattr_static(model, name)
+        if isinstance(value, QueryableAttribute):
+            raise AttributeError("%s is not a column of %s" % (name, model.__name__))
+        if isinstance(value, classmethod):
+            return getattr(model, name)
+        if hasattr(value, "__get__"):
+            return value.__get__(self, type(self))
+        return value
+
+    return type(base.__name__, (base, ), {"__slots__": (), "__getattr__": __getattr__})
+
+
+def projection(model, fields=None):
+    """Get columns to be selected and a function to serialise selected values.
+
+    With fields, only those columns are selected and their values are
+    returned with keys as they are named in json(), i.e. without _id.
+    Otherwise all columns are selected and values are passed to json() of
+    the model in a light tuple, without building mapped objects, unless
+    json() needs more than columns, e.g. relationships.
+    """
+    if fields:
+        names = fields.split(",")
+        columns = [name_or_id(model, name) for name in names]
+        if any(column is None for column in columns):
+            raise FieldError("Unknown field in %s" % fields)
+        keys = [STRIP_ID.sub("", name) for name in names]
+        return columns, lambda values: dict(zip(keys, values))
+
+    keys = [attr.key for attr in inspect(model).column_attrs]
+    row = row_type(model, keys)
+    try:
+        model.json(row(*[None] * len(keys)))
+    except Exception:
+        return [model], lambda values: values[0].json()
+    return [getattr(model, key) for key in keys], \
+        lambda values: model.json(row(*values))
+
+
+def serialise_rows(serialise, rows):
+    """Serialise selected rows, a failure is an error of the server not of the query."""
+    try:
+        return [serialise(row) for row in rows]
+    except Exception as e:
+        raise SerialisationError(str(e)) from e
+
+
+def build_query(model, args, default_order="id"):
+    """Build a query with request-specified filtering and ordering."""
     query = model.query
     # filter
     if args["filter"]:
         for query_filter in args["filter"]:
             query = dynamic_query(model, query, query_filter)
     # order
-    order = []
-    for order_spec in args["order"].split(","):
-        if not order_spec.startswith("-"):
-            order.append(name_or_id(model, order_spec))
-        else:
-            order.append(name_or_id(model, order_spec[1:]).desc())
-    query = query.order_by(*order)
+    order = order_columns(model, args["order"] or default_order)
+    query = query.order_by(*[column.desc() if desc else column
+                             for column, desc in order])
+    return query, order
+
+
+def do_query(model, default_order="id"):
+    """Perform a query with request-specified filtering and ordering.
+
+    Returns a page of serialised items and the cursor of the next page. Keyset
+    pagination is used when argument after is given (empty for the first
+    page): it seeks from the cursor instead of counting and skipping rows.
+    Cursor is None when there is no more page or in offset pagination.
+    """
+    args = QUERY_PARSER.parse_args()
+    query, order = build_query(model, args, default_order)
+    columns, serialise = projection(model, args["fields"])
+    query = query.with_entities(*columns).only_return_tuples(True)
     # execute
-    return query.paginate(args["page"], per_page=args["count"], error_out=False).items
+    if args["after"] is None:
+        rows = query.paginate(args["page"], per_page=args["count"], error_out=False).items
+        return serialise_rows(serialise, rows), None
+
+    if args["after"]:
+        query = query.filter(seek_filter(order, decode_cursor(args["after"])))
+    rows = query.add_columns(*[column for column, _ in order]).\
+        limit(args["count"]).all()
+
+    cursor = None
+    if rows and len(rows) == args["count"]:
+        cursor = encode_cursor(rows[-1][len(columns):])
+    return serialise_rows(serialise, [row[:len(columns)] for row in rows]), cursor
+
+
+def stream_query(model, default_order="id"):
+    """Perform a query like do_query but fetch items through a server side cursor.
+
+    The page is limited by count and started from page or after, but no
+    cursor of the next page is available until the stream ends.
+    """
+    args = QUERY_PARSER.parse_args()
+    query, order = build_query(model, args, default_order)
+    columns, serialise = projection(model, args["fields"])
+    query = query.with_entities(*columns).only_return_tuples(True)
+    if args["after"]:
+        query = query.filter(seek_filter(order, decode_cursor(args["after"])))
+    elif args["after"] is None:
+        query = query.offset((args["page"] - 1) * args["count"])
+    return (serialise(row) for row in query.limit(args["count"]).yield_per(YIELD_PER))
+
+
+def wants_ndjson():
+    """Check if a request asks for streamed newline delimited JSON."""
+    if request.args.get("format") == "ndjson":
+        return True
+    return request.accept_mimetypes.best == NDJSON
+
+
+def ndjson_response(items):
+    """Stream items as newline delimited JSON while they are generated.
+
+    As the status has been sent, an error in the middle ends the stream early.
+    """
+    def generate():
+        try:
+            for item in items:
+                yield flask_json.dumps(item) + "\n"
+        except Exception as e:
+            top_logger.error("Streaming failed. Detail: %s" % str(e))
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
 
 
 def instance_method(model, method, id, default=[], **kwargs):
@@ -284,12 +648,18 @@ def instance_method(model, method, id, default=[], **kwargs):
 
 class QueryResource(Resource):
     """Generic Query"""
+    cursor = None
+    # ordering of requests without one
+    default_order = "id"
 
     def get_raw(self):
         """Query"""
         try:
             top_logger.debug("Query: %s" % self.query_class.query)
-            return do_query(self.query_class)
+            items, self.cursor = do_query(self.query_class, self.default_order)
+            return items
+        except (QueryArgumentError, SerialisationError):
+            raise
         except Exception as e:
             top_logger.error("Query %s failed. Detail: %s" % (self.query_class.query, str(e)))
             return []
@@ -297,7 +667,15 @@ class QueryResource(Resource):
     @require_auth
     def get(self):
         """Query"""
-        return [item.json() for item in self.get_raw()]
+        try:
+            if wants_ndjson():
+                return ndjson_response(stream_query(self.query_class, self.default_order))
+            items = self.get_raw()
+        except QueryArgumentError as e:
+            return {"message": str(e)}, 400
+        if self.cursor:
+            return items, 200, {CURSOR_HEADER: self.cursor}
+        return items
 
     @require_auth
     def post(self):
@@ -315,34 +693,359 @@ class RangeQuery(Resource):
        are populated with necessary attributes either in a list or an object (dict).
 
        Use QueryResource for filtering snapshots or other simple collections.
+
+       Concurrent identical queries are computed once and shared. Results are
+       also cached when RESULT_CACHE is configured. Set cacheable to False for
+       queries which are cheap or not only depend on snapshots.
     """
     default = []
     arg_parser = RANGE_PARSER
+    cacheable = True
+
+    def _stream(self, **kwargs):
+        """Items to be streamed as newline delimited JSON.
+
+        By default they are taken from the result of _get. Override it with
+        a generator to avoid building the whole result in memory.
+        """
+        rslt = self._get(**kwargs)
+        if isinstance(rslt, list):
+            yield from rslt
+        else:
+            yield rslt
 
     @require_auth
     def get(self, **kwargs):
         """Get method"""
         kwargs.update(self.arg_parser.parse_args())
+        if wants_ndjson():
+            return ndjson_response(self._stream(**kwargs))
+
+        if not self.cacheable:
+            try:
+                return self._get(**kwargs)
+            except Exception as e:
+                top_logger.error("Query of summary failed. Detail: %s" % str(e))
+                return self.default
+
+        start, end = kwargs.get("start", 0), kwargs.get("end", 0)
+        args = request.args.to_dict(flat=False)
+        args.update(kwargs)
+        key = ResultCache.key(request.path, args)
+        if result_cache is not None:
+            rslt = result_cache.get(key, start, end, MISSING)
+            if rslt is not MISSING:
+                return rslt
+
         try:
-            return self._get(**kwargs)
+            return single_flight.do(key, lambda: self._cached_get(key, start, end, **kwargs))
         except Exception as e:
             top_logger.error("Query of summary failed. Detail: %s" % str(e))
             return self.default
 
+    def _cached_get(self, key, start, end, **kwargs):
+        """Get the result of a query computed by another caller or compute it."""
+        if result_cache is not None:
+            rslt = result_cache.get(key, start, end, MISSING)
+            if rslt is not MISSING:
+                return rslt
+
+        generation = result_cache.generation() if result_cache is not None else None
+        rslt = self._get(**kwargs)
+        if result_cache is not None:
+            try:
+                result_cache.set(key, start, end, rslt, generation)
+            except Exception as e:
+                top_logger.error("Caching result of %s failed. Detail: %s" % (request.path, str(e)))
+        return rslt
+
 
 def record_input():
-    """Record the name of an ingestion."""
+    """Record the name of an ingestion and return it, None if it has been recorded.
+
+    The unique index of name is checked at once rather than at commit, the
+    record is rolled back with the session if the ingestion fails.
+    """
     args = INPUT_PARSER.parse_args()
-    add(Input(name=args["name"]))
+    statement = insert(Input.__table__).values(name=args["name"]) \
+        .on_conflict_do_nothing(index_elements=["name"]) \
+        .returning(Input.__table__.c.id)
+    if db.session.execute(statement, mapper=Input).first() is None:
+        return None
+    return args["name"]
+
+
+def duplicate_input():
+    """Response to an ingestion which has been recorded."""
+    return {"message": "%s has been ingested" % request.args.get("name")}, 409
+
+
+def forget_input(name):
+    """Remove the record of an ingestion which failed so it can be retried."""
+    rollback()
+    Input.query.filter_by(name=name).delete()
+    commit()
+
+
+def run_ingest_job(status, body):
+    """Ingest the body of a spooled job by the resource it was sent to.
+
+    The job is recorded in the transaction of the ingestion, so a job
+    recovered after its ingestion committed is skipped.
+    """
+    with app.test_request_context(status["path"], method="PUT", data=body,
+                                  content_type="application/json",
+                                  headers={"Content-Encoding": status.get("encoding", "")},
+                                  query_string={"name": status["name"]}):
+        app.preprocess_request()
+        if status.get("recovered"):
+            recorded = Input.query.filter_by(name=status["name"]).first()
+            ingested = IngestJob.query.get(status["job"])
+            rollback()
+            # forgotten after it failed or ingested before the crash
+            if recorded is None or ingested is not None:
+                top_logger.warning("Recovered ingestion job %s of %s is skipped" % (status["job"], status["name"]))
+                return
+        resource = app.view_functions[status["endpoint"]].view_class()
+        try:
+            db.session.add(IngestJob(id=status["job"], name=status["name"]))
+            data, code, _ = unpack(resource.run())
+            if code >= 400:
+                raise RuntimeError("Ingestion returned %d: %s" % (code, data))
+        except Exception:
+            forget_input(status["name"])
+            raise
+
+
+ingest_spool = None
+dimension_cache = None
+if DIMENSION_CACHE_SIZE:
+    dimension_cache = DimensionCache(DIMENSION_CACHE_SIZE, DIMENSION_CACHE_TTL)
+
+
+def prewarm_dimensions(dimensions):
+    """Load ids of dimensions, a dict of models and their key columns, into dimension cache."""
+    for model, columns in dimensions.items():
+        try:
+            dimension_cache.prewarm(model, columns)
+        except Exception as e:
+            top_logger.error("Prewarming cache of %s failed. Detail: %s" % (model.__name__, str(e)))
+            rollback()
+
+
+if ASYNC_INGEST:
+    if SPOOL_DIR is None:
+        raise RuntimeError("SPOOL_DIR has to be set for ASYNC_INGEST")
+    ingest_spool = Spool(SPOOL_DIR, run_ingest_job, workers=SPOOL_WORKERS)
+    # workers are started in the process serving requests, not a forking master:
+    # by post_worker_init of gunicorn, see bin/gconf_generator.sh, or else by
+    # the first request
+    app.before_first_request(ingest_spool.start)
+
+
+# Content-Encoding of ingested messages and how to decompress a stream of them
+DECODERS = {
+    "": lambda stream: stream,
+    "identity": lambda stream: stream,
+    "gzip": lambda stream: gzip.GzipFile(fileobj=stream),
+    "xz": lzma.LZMAFile,
+}
+
+
+# Characters read from an ingestion body at a time
+CHUNK_SIZE = 1 << 16
+WHITESPACE = " \t\n\r"
+
+
+def text_stream(stream, encoding=""):
+    """Text of a binary stream compressed by encoding."""
+    return io.TextIOWrapper(DECODERS[encoding](stream), encoding="utf-8")
+
+
+def iter_messages(stream, schemas=None, chunk_size=CHUNK_SIZE):
+    """Parse a JSON array of messages from a text stream one message at a time.
+
+    Messages whose schemas are not in schemas are skipped when it is given.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+    expect = "["
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Messages end unexpectedly")
+            buffer, pos = stream.read(chunk_size), 0
+            eof = not buffer
+            continue
+
+        char = buffer[pos]
+        if expect == "[":
+            if char != "[":
+                raise ValueError("Messages have to be in an array")
+            pos, expect = pos + 1, "first"
+        elif char == "]" and expect in ("first", ","):
+            return
+        elif expect == ",":
+            if char != ",":
+                raise ValueError("Messages have to be separated by comma")
+            pos, expect = pos + 1, "message"
+        else:
+            try:
+                message, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+                # the message is incomplete, read at least as much as buffered
+                chunk = stream.read(max(chunk_size, len(buffer) - pos))
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            if not isinstance(message, dict):
+                raise ValueError("Message has to be an object")
+            pos, expect = end, ","
+            if schemas is None or message.get("schema") in schemas:
+                yield message
+
+
+def content_encoding():
+    return request.headers.get("Content-Encoding", "").strip().lower()
+
+
+class IngestRejected(Exception):
+    """Messages which cannot be ingested into data recorded, e.g. a late snapshot
+
+    Raised by ingest(), nothing of the ingestion is kept and it is answered
+    with 422, so the input can be sent again once it can be ingested.
+    """
 
 
 class BaseIngestResource(Resource):
-    """Base Ingestion"""
+    """Base Ingestion
+
+    Messages can be sent compressed with Content-Encoding gzip or xz. They
+    are parsed one by one while ingest() iterates messages().
+    """
+    # keys in data of a message which are timestamps of snapshots
+    ts_keys = ("timestamp", )
+    # schemas of messages to ingest, None for all
+    schemas = None
+    # models of dimensions whose ids are cached across requests and their key columns
+    dimensions = {}
+    _resolver = None
+    # numbers of messages iterated by schema and their snapshots
+    tally = None
+    _snapshots = None
+
+    def messages(self):
+        """Iterate messages in request body, it can be done once.
+
+        Schemas and snapshots of messages are recorded while iterating.
+        """
+        self.tally = Counter()
+        self._snapshots = set()
+        for message in iter_messages(text_stream(request.stream, content_encoding()), self.schemas):
+            self.tally[message.get("schema", "none")] += 1
+            if self._snapshots is not None:
+                try:
+                    timestamps = self.timestamps(message)
+                except (KeyError, TypeError, ValueError):
+                    timestamps = None
+                if timestamps is None:
+                    self._snapshots = None
+                else:
+                    self._snapshots.update(timestamps)
+            yield message
+
+    def message_batches(self, size=None):
+        """Iterate lists of messages in request body, see messages()."""
+        messages = self.messages()
+        while True:
+            batch = list(islice(messages, size or INGEST_BATCH))
+            if not batch:
+                return
+            yield batch
+
+    def resolver(self):
+        """Create the Resolver of this ingestion, using cached ids of dimensions."""
+        self._resolver = Resolver(dimension_cache, self.dimensions,
+                                  dimension_id if CLIENT_GENERATED_IDS else None)
+        return self._resolver
+
+    def timestamps(self, message):
+        """Get timestamps of snapshots in a message, None if unknown."""
+        data = message.get("data", {})
+        found = [data[key] for key in self.ts_keys if key in data]
+        if not found:
+            return None
+        return [int(ts) for ts in found]
+
+    def snapshots(self):
+        """Get timestamps of snapshots in ingested messages, None if unknown."""
+        return self._snapshots
 
     @require_auth
     def put(self):
-        record_input()
-        return self.ingest()
+        if content_encoding() not in DECODERS:
+            return {"message": "Content-Encoding has to be one of %s" % ", ".join(filter(None, DECODERS))}, 415
+        if ingest_spool is not None:
+            return self.submit()
+        if record_input() is None:
+            return duplicate_input()
+        return self.run()
+
+    def submit(self):
+        """Validate messages and save them in the spool to be ingested later."""
+        name = record_input()
+        if name is None:
+            return duplicate_input()
+
+        body = request.get_data()
+        count = 0
+        try:
+            for message in iter_messages(text_stream(io.BytesIO(body), content_encoding())):
+                if "data" not in message:
+                    raise ValueError("Message has no data")
+                count += 1
+        except (OSError, EOFError, ValueError, lzma.LZMAError) as e:
+            rollback()
+            return {"message": "Body has to be a list of messages: %s" % str(e)}, 400
+        commit()
+        try:
+            status = ingest_spool.submit(body, name=name, encoding=content_encoding(),
+                                         endpoint=request.endpoint, path=request.path,
+                                         messages=count)
+        except Exception as e:
+            top_logger.error("Spooling %s failed. Detail: %s" % (name, str(e)))
+            forget_input(name)
+            return {"message": "Cannot save messages"}, 503
+        return status, 202, {"Location": "%s/%s" % (request.path, status["job"])}
+
+    def run(self):
+        """Ingest messages in request and evict cached results they change."""
+        start = time.perf_counter()
+        try:
+            rslt = self.ingest()
+        except IngestRejected as e:
+            rollback()
+            top_logger.warning("Ingestion of %s is rejected: %s" % (request.args.get("name"), str(e)))
+            return {"message": str(e)}, 422
+        except Exception:
+            # a cached id may be of a row gone
+            if dimension_cache is not None and self.dimensions:
+                dimension_cache.clear(self.dimensions)
+            raise
+        if self._resolver is not None:
+            self._resolver.publish()
+        metrics.observe_ingest(self.tally or {}, time.perf_counter() - start)
+        if result_cache is not None:
+            try:
+                result_cache.evict(self.snapshots())
+            except Exception as e:
+                top_logger.error("Evicting cached results failed. Detail: %s" % str(e))
+                result_cache.evict()
+        return rslt
 
 
 class InputResource(QueryResource):
@@ -352,11 +1055,40 @@ class InputResource(QueryResource):
     @require_auth
     def put(self):
         """Record a processed input."""
-        record_input()
+        if record_input() is None:
+            return duplicate_input()
         commit()
         return "", 204
 
 
+class MissingInputResource(Resource):
+    """Names of inputs which have not been recorded"""
+
+    @require_auth
+    def post(self):
+        """Filter a JSON list of candidate names to those not in input table."""
+        names = request.get_json(force=True, silent=True)
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            return {"message": "Body has to be a list of names"}, 400
+        if len(names) > MISSING_BATCH:
+            return {"message": "At most %d names in a request" % MISSING_BATCH}, 413
+        if not names:
+            return []
+        rows = db.session.execute(MISSING_QUERY, {"names": names}, mapper=Input)
+        return [row[0] for row in rows]
+
+
+class IngestJobResource(Resource):
+    """Status of an asynchronous ingestion job"""
+
+    @require_auth
+    def get(self, job):
+        status = ingest_spool.status(job) if ingest_spool is not None else None
+        if status is None:
+            return {"message": "Unknown job"}, 404
+        return status
+
+
 class PingResource(Resource):
     """Basic liveness test."""
 
@@ -365,9 +1097,21 @@ class PingResource(Resource):
         return "pong"
 
 
+class MetricsResource(Resource):
+    """Metrics in Prometheus text format."""
+
+    def get(self):
+        return metrics.generate()
+
+
 def configure(resources):
     restapi.add_resource(PingResource, "/ping")
+    restapi.add_resource(MetricsResource, "/metrics")
     restapi.add_resource(InputResource, "/input")
+    restapi.add_resource(MissingInputResource, "/input/missing")
+    restapi.add_resource(IngestJobResource, "/ingest/<string:job>")
 
     for (endpoint, cls) in resources.items():
         restapi.add_resource(cls, endpoint)
+        if dimension_cache is not None and getattr(cls, "dimensions", None):
+            app.before_first_request(lambda dimensions=cls.dimensions: prewarm_dimensions(dimensions))
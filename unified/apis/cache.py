@@ -0,0 +1,318 @@
+import os
+import json
+import fcntl
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A bounded, thread safe LRU cache whose entries expire.
+
+    Every entry has its own life time which defaults to ttl of the cache.
+    When the cache is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        """Get the value of key if it is not expired."""
+        with self._lock:
+            try:
+                expire, value = self._data[key]
+            except KeyError:
+                return default
+            if expire <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Set key to value which lives ttl seconds, default is ttl of the cache."""
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """Get a list of (key, value) of entries not expired."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (expire, value) in self._data.items()
+                    if expire > now]
+
+    def pop(self, key, default=None):
+        """Remove key and return its value."""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+
+def covers(start, end, ts):
+    """Check if a time range, in which 0 means open, covers a timestamp."""
+    return (start <= 0 or ts >= start) and (end <= 0 or ts < end)
+
+
+class MemoryBackend(object):
+    """Result cache in memory of a process"""
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def bump(self):
+        self._generation += 1
+
+    def get(self, key, start, end, default=None):
+        item = self._cache.get(key)
+        return default if item is None else item[2]
+
+    def set(self, key, start, end, value, ttl):
+        self._cache.set(key, (start, end, value), ttl)
+
+    def delete(self, key, start, end):
+        self._cache.pop(key)
+
+    def evict(self, timestamps):
+        """Remove entries whose time ranges cover any of timestamps."""
+        for key, (start, end, _) in self._cache.items():
+            if any(covers(start, end, ts) for ts in timestamps):
+                self._cache.pop(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class DiskBackend(object):
+    """Result cache in a directory shared by processes
+
+    An entry is a JSON file named by its time range and key, so eviction
+    only needs to list the directory. The generation of ingests is a token
+    in file generation, replaced by every ingest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _name(self, key, start, end):
+        return os.path.join(self.path, "%d_%d_%s.json" % (start, end, key))
+
+    def generation(self):
+        try:
+            with open(os.path.join(self.path, "generation")) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def bump(self):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp, os.path.join(self.path, "generation"))
+
+    def _entries(self):
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            start, end, key = name[:-5].split("_", 2)
+            yield os.path.join(self.path, name), int(start), int(end), key
+
+    def get(self, key, start, end, default=None):
+        path = self._name(key, start, end)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return default
+        if entry["expire"] is not None and entry["expire"] <= time.time():
+            self._remove(path)
+            return default
+        return entry["value"]
+
+    def set(self, key, start, end, value, ttl):
+        expire = time.time() + ttl
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"expire": expire, "value": value}, f)
+        os.replace(tmp, self._name(key, start, end))
+
+    def delete(self, key, start, end):
+        self._remove(self._name(key, start, end))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self, timestamps):
+        """Remove entries whose time ranges cover any of timestamps."""
+        for path, start, end, _ in list(self._entries()):
+            if any(covers(start, end, ts) for ts in timestamps):
+                self._remove(path)
+
+    def clear(self):
+        for path, _, _, _ in list(self._entries()):
+            self._remove(path)
+
+
+class ResultCache(object):
+    """Cache of query results keyed by request path and arguments
+
+    Results live ttl seconds, or past_ttl when their time ranges are
+    entirely in the past, unless an ingest of a snapshot in their ranges
+    evicts them earlier. Every ingest bumps the generation of the backend:
+    a result computed while an ingest commits is not kept.
+    """
+
+    def __init__(self, backend, ttl=300, past_ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.past_ttl = ttl if past_ttl is None else past_ttl
+
+    @staticmethod
+    def key(path, args):
+        """Generate a key from path and arguments."""
+        content = json.dumps([path, sorted(args.items())], default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def get(self, key, start, end, default=None):
+        return self.backend.get(key, start, end, default)
+
+    def generation(self):
+        """Get the generation of ingests, read it before computing a result to be set."""
+        return self.backend.generation()
+
+    def set(self, key, start, end, value, generation=None):
+        """Keep a result unless an ingest has run since generation, return if it is kept.
+
+        The generation is checked again after writing as an ingest evicting
+        results may have run in the mean time.
+        """
+        if generation is not None and generation != self.backend.generation():
+            return False
+        ttl = self.ttl
+        if 0 < end <= time.time():
+            ttl = self.past_ttl
+        self.backend.set(key, start, end, value, ttl)
+        if generation is not None and generation != self.backend.generation():
+            self.backend.delete(key, start, end)
+            return False
+        return True
+
+    def evict(self, timestamps=None):
+        """Remove results covering any of timestamps, all when timestamps is None.
+
+        The generation is bumped first so results being computed are not kept.
+        """
+        self.backend.bump()
+        if timestamps is None:
+            self.backend.clear()
+        else:
+            self.backend.evict(timestamps)
+
+
+class _Call(object):
+    """A call in flight"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key into one
+
+    The first caller of a key runs the function, others calling in the mean
+    time wait and share its return value or exception. With lock_dir, callers
+    in different processes are serialised by lock files, which are removed
+    by the last holder: the function should check a store shared by the
+    processes before doing expensive work.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self, key):
+        if not self.lock_dir:
+            yield
+            return
+        path = os.path.join(self.lock_dir, "%s.lock" % key)
+        while True:
+            with open(path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+                if not current:
+                    # removed by its last holder, lock the file there now
+                    continue
+                try:
+                    yield
+                finally:
+                    # removed while locked so waiters on it lock a new one
+                    os.remove(path)
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                return
+
+    def do(self, key, fn):
+        """Call fn or wait for the call in flight of key, return its value."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            with self._file_lock(key):
+                call.value = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
@@ -1,7 +1,5 @@
-from functools import lru_cache
-
-from . import app, configure, request
-from . import get_or_create, commit
+from . import app, configure
+from . import commit
 from . import BaseIngestResource, QueryResource
 
 from ..models.cinder import (
@@ -38,55 +36,61 @@ class VolumeAttachmentResource(QueryResource):
 
 
 class IngestResource(BaseIngestResource):
+    dimensions = {AvailabilityZone: ("name", ), VolumeStatus: ("name", )}
+
     def ingest(self):
         """Data ingest"""
+        resolver = self.resolver()
 
-        @lru_cache(maxsize=100000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
-
-        for message in request.get_json(force=True):
-            data = message["data"]
-
-            snapshot = cache(Snapshot, ts=data["timestamp"])
+        for messages in self.message_batches():
+            for message in messages:
+                data = message["data"]
+                resolver.add(Snapshot, ts=data["timestamp"])
 
-            if "volumes" in data:
-                for metadata in data["volumes"]:
-                    az = None
+                for metadata in data.get("volumes", []):
                     if "availability_zone" in metadata:
-                        az = cache(AvailabilityZone,
-                                   name=metadata["availability_zone"])
-
-                    volume = cache(
-                        Volume,
-                        openstack_id=metadata["id"],
-                        availability_zone=az,
-                        owner=metadata["user_id"],
-                        tenant=metadata["os-vol-tenant-attr:tenant_id"])
-
-                    status = cache(VolumeStatus, name=metadata["status"])
-
-                    cache(VolumeState,
-                          name=metadata["name"],
-                          size=metadata["size"],
-                          status=status,
-                          snapshot=snapshot,
-                          volume=volume)
+                        resolver.add(AvailabilityZone, name=metadata["availability_zone"])
+                    resolver.add(VolumeStatus, name=metadata["status"])
+
+                for metadata in data.get("volume_snapshots", []):
+                    resolver.add(VolumeSnapshot, {
+                        "name": metadata["name"],
+                        "description": metadata["description"],
+                        "size": metadata["size"],
+                        "source": metadata["volume_id"]
+                    }, openstack_id=metadata["id"])
+            resolver.resolve()
+
+            for message in messages:
+                for metadata in message["data"].get("volumes", []):
+                    az_id = None
+                    if "availability_zone" in metadata:
+                        az_id = resolver.id(AvailabilityZone, name=metadata["availability_zone"])
+                    resolver.add(Volume, {
+                        "availability_zone_id": az_id,
+                        "owner": metadata["user_id"],
+                        "tenant": metadata["os-vol-tenant-attr:tenant_id"]
+                    }, openstack_id=metadata["id"])
+            resolver.resolve()
+
+            for message in messages:
+                data = message["data"]
+                snapshot_id = resolver.id(Snapshot, ts=data["timestamp"])
+                for metadata in data.get("volumes", []):
+                    volume_id = resolver.id(Volume, openstack_id=metadata["id"])
+                    resolver.add(VolumeState,
+                                 name=metadata["name"],
+                                 size=metadata["size"],
+                                 status_id=resolver.id(VolumeStatus, name=metadata["status"]),
+                                 snapshot_id=snapshot_id,
+                                 volume_id=volume_id)
 
                     for instance in metadata["attachments"]:
-                        cache(VolumeAttachment,
-                              instance=instance["server_id"],
-                              volume=volume,
-                              snapshot=snapshot)
-
-            if "volume_snapshots" in data:
-                for metadata in data["volume_snapshots"]:
-                    cache(VolumeSnapshot,
-                          openstack_id=metadata["id"],
-                          name=metadata["name"],
-                          description=metadata["description"],
-                          size=metadata["size"],
-                          source=metadata["volume_id"])
+                        resolver.add(VolumeAttachment,
+                                     instance=instance["server_id"],
+                                     volume_id=volume_id,
+                                     snapshot_id=snapshot_id)
+            resolver.resolve()
 
         commit()
 
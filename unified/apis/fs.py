@@ -1,5 +1,5 @@
-from . import app, configure, request
-from . import get_or_create, add, commit
+from . import app, configure
+from . import commit, CopyLoader
 from . import QueryResource, BaseIngestResource
 
 from ..models.fs import (
@@ -32,44 +32,61 @@ class UsageResource(QueryResource):
 
 
 class IngestResource(BaseIngestResource):
+    dimensions = {
+        Host: ("name", ), Owner: ("name", ), Project: ("name", ), Filesystem: ("name", "host_id")
+    }
+
     def ingest(self):
         """Ingest usage."""
-
-        for message in request.get_json(force=True):
-            inserts = []
-
-            data = message["data"]
-            host = get_or_create(Host, name=data["hostname"])
-
-            metadata = data["fs"]
-            filesystem = get_or_create(Filesystem,
-                                       name=metadata["name"],
-                                       host=host)
-
-            snapshot = get_or_create(Snapshot,
-                                     ts=data["timestamp"],
-                                     filesystem=filesystem,
-                                     bavail=metadata["bavail"],
-                                     bfree=metadata["bfree"],
-                                     blocks=metadata["blocks"],
-                                     bsize=metadata["bsize"],
-                                     favail=metadata["favail"],
-                                     ffree=metadata["ffree"],
-                                     files=metadata["files"],
-                                     frsize=metadata["frsize"])
-
-            for who, details in data["usage"].items():
-                who = who.split("/")
-                owner = get_or_create(Owner, name=who[0])
-                project = get_or_create(Project, name=who[1])
-
-                add(Usage(owner=owner,
-                          project=project,
-                          snapshot=snapshot,
-                          blocks=details["blocks"],
-                          bytes=details["bytes"],
-                          files=details["files"]))
-
+        resolver = self.resolver()
+        usages = CopyLoader(Usage, ("owner_id", "project_id", "snapshot_id", "blocks", "bytes", "files"))
+
+        for messages in self.message_batches():
+            for message in messages:
+                data = message["data"]
+                resolver.add(Host, name=data["hostname"])
+                for who in data["usage"]:
+                    who = who.split("/")
+                    resolver.add(Owner, name=who[0])
+                    resolver.add(Project, name=who[1])
+            resolver.resolve()
+
+            for message in messages:
+                data = message["data"]
+                resolver.add(Filesystem, name=data["fs"]["name"],
+                             host_id=resolver.id(Host, name=data["hostname"]))
+            resolver.resolve()
+
+            snapshots = []
+            for message in messages:
+                data = message["data"]
+                metadata = data["fs"]
+                filesystem_id = resolver.id(Filesystem, name=metadata["name"],
+                                            host_id=resolver.id(Host, name=data["hostname"]))
+                snapshot = {
+                    "ts": data["timestamp"],
+                    "filesystem_id": filesystem_id,
+                    "bavail": metadata["bavail"],
+                    "bfree": metadata["bfree"],
+                    "blocks": metadata["blocks"],
+                    "bsize": metadata["bsize"],
+                    "favail": metadata["favail"],
+                    "ffree": metadata["ffree"],
+                    "files": metadata["files"],
+                    "frsize": metadata["frsize"]
+                }
+                resolver.add(Snapshot, **snapshot)
+                snapshots.append(snapshot)
+            resolver.resolve()
+
+            for message, snapshot in zip(messages, snapshots):
+                snapshot_id = resolver.id(Snapshot, **snapshot)
+                for who, details in message["data"]["usage"].items():
+                    who = who.split("/")
+                    usages.add(resolver.id(Owner, name=who[0]), resolver.id(Project, name=who[1]),
+                               snapshot_id, details["blocks"], details["bytes"], details["files"])
+
+        usages.flush()
         commit()
 
         return "", 204
@@ -2,13 +2,12 @@ import re
 import uuid
 import arrow
 
-from functools import lru_cache
-
-from . import app, configure, request, instance_method
-from . import get_or_create, commit, add
+from . import app, configure, instance_method
+from . import commit, CopyLoader
 from . import QueryResource, BaseIngestResource, RangeQuery
 
-from ..models.hcp import Snapshot, Allocation, Tenant, Namespace, Usage
+from ..models import DAILY_ROLLUP_RECORD
+from ..models.hcp import Snapshot, Allocation, Tenant, Namespace, Usage, DailyUsage
 
 ALPHA_PREFIX = re.compile("^[A-Za-z]+")
 
@@ -39,6 +38,11 @@ class TenantList(RangeQuery):
                                start_ts=kwargs['start'],
                                end_ts=kwargs['end'])
 
+    def _stream(self, id='', **kwargs):
+        return instance_method(Tenant, 'iter_list', id,
+                               start_ts=kwargs['start'],
+                               end_ts=kwargs['end'])
+
 
 class NamespaceResource(QueryResource):
     query_class = Namespace
@@ -50,6 +54,11 @@ class NamespaceList(RangeQuery):
                                start_ts=kwargs['start'],
                                end_ts=kwargs['end'])
 
+    def _stream(self, id='', **kwargs):
+        return instance_method(Namespace, 'iter_list', id,
+                               start_ts=kwargs['start'],
+                               end_ts=kwargs['end'])
+
 
 class UsageResource(QueryResource):
     query_class = Usage
@@ -74,94 +83,99 @@ def extract_allocation(name):
 
 
 class IngestResource(BaseIngestResource):
+    dimensions = {
+        Allocation: ("allocation", ), Tenant: ("name", "allocation_id"),
+        Namespace: ("name", "tenant_id", "allocation_id")
+    }
+
     def ingest(self):
         """Ingest usage."""
 
         timestamps = set()
-
-        @lru_cache(maxsize=10000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
-
-        for message in request.get_json(force=True):
-            data = message["data"]
-
-            timestamp = data["timestamp"]
-            if timestamp in timestamps:
-                continue
-            else:
-                timestamps.add(timestamp)
-
-            snapshot = cache(Snapshot, ts=timestamp)
-
-            for tenant_name, namespaces in data.items():
-                if not isinstance(namespaces, list):
+        resolver = self.resolver()
+        usages = CopyLoader(Usage, (
+            "snapshot_id", "namespace_id", "start_time", "end_time", "ingested_bytes", "raw_bytes",
+            "reads", "writes", "deletes", "objects", "bytes_in", "bytes_out", "metadata_only_objects",
+            "metadata_only_bytes", "tiered_objects", "tiered_bytes"))
+
+        def allocation_id(name):
+            allocation = extract_allocation(name)
+            if allocation:
+                return resolver.id(Allocation, allocation=allocation)
+            return None
+
+        def namespace_name(details):
+            if "namespaceName" in details:
+                return details["namespaceName"]
+            return "__total__"
+
+        for batch in self.message_batches():
+            messages = []
+            for message in batch:
+                timestamp = message["data"]["timestamp"]
+                if timestamp in timestamps:
                     continue
-
-                allocation = None
-                allocation_id = extract_allocation(tenant_name)
-                if allocation_id:
-                    allocation = cache(Allocation, allocation=allocation_id)
-
-                tenant = cache(Tenant, name=tenant_name, allocation=allocation)
-
+                timestamps.add(timestamp)
+                messages.append(message)
+
+            tenants = []
+            for message in messages:
+                data = message["data"]
+                resolver.add(Snapshot, ts=data["timestamp"])
+                for tenant_name, namespaces in data.items():
+                    if not isinstance(namespaces, list):
+                        continue
+                    tenants.append((data["timestamp"], tenant_name, namespaces))
+                    for name in [tenant_name] + [namespace_name(details) for details in namespaces]:
+                        allocation = extract_allocation(name)
+                        if allocation:
+                            resolver.add(Allocation, allocation=allocation)
+            resolver.resolve()
+
+            for _, tenant_name, _ in tenants:
+                resolver.add(Tenant, name=tenant_name, allocation_id=allocation_id(tenant_name))
+            resolver.resolve()
+
+            for _, tenant_name, namespaces in tenants:
+                tenant_id = resolver.id(Tenant, name=tenant_name, allocation_id=allocation_id(tenant_name))
                 for details in namespaces:
-                    if "namespaceName" in details:
-                        namespace_name = details["namespaceName"]
-                    else:
-                        namespace_name = "__total__"
-
-                    allocation = None
-                    allocation_id = extract_allocation(namespace_name)
-                    if allocation_id:
-                        allocation = cache(Allocation,
-                                           allocation=allocation_id)
-
-                    namespace = cache(Namespace,
-                                      name=namespace_name,
-                                      tenant=tenant,
-                                      allocation=allocation)
-
-                    start_time = arrow.get(details["startTime"]).timestamp
-                    end_time = arrow.get(details["endTime"]).timestamp
-
-                    usage = {
-                        "snapshot": snapshot,
-                        "namespace": namespace,
-                        "start_time": start_time,
-                        "end_time": end_time,
-                        "ingested_bytes": details["ingestedVolume"],
-                        "raw_bytes": details["storageCapacityUsed"],
-                        "reads": details["reads"],
-                        "writes": details["writes"],
-                        "deletes": details["deletes"],
-                        "objects": details["objectCount"],
-                        "bytes_in": details["bytesIn"],
-                        "bytes_out": details["bytesOut"]
-                    }
-
-                    if "metadataOnlyObjects" in details:
-                        usage["metadata_only_objects"] = details["metadataOnlyObjects"]
-                    else:
-                        usage["metadata_only_objects"] = 0
-
-                    if "metadataOnlyBytes" in details:
-                        usage["metadata_only_bytes"] = details["metadataOnlyBytes"],
-                    else:
-                        usage["metadata_only_bytes"] = 0
-
-                    if "tieredObjects" in details:
-                        usage["tiered_objects"] = details["tieredObjects"],
-                    else:
-                        usage["tiered_objects"] = 0
-
-                    if "tieredBytes" in details:
-                        usage["tiered_bytes"] = details["tieredBytes"]
-                    else:
-                        usage["tiered_bytes"] = 0
-
-                    add(Usage(**usage))
-
+                    name = namespace_name(details)
+                    resolver.add(Namespace, name=name, tenant_id=tenant_id,
+                                 allocation_id=allocation_id(name))
+            resolver.resolve()
+
+            daily = []
+            for timestamp, tenant_name, namespaces in tenants:
+                tenant_id = resolver.id(Tenant, name=tenant_name, allocation_id=allocation_id(tenant_name))
+                for details in namespaces:
+                    name = namespace_name(details)
+                    namespace_id = resolver.id(Namespace, name=name, tenant_id=tenant_id,
+                                               allocation_id=allocation_id(name))
+                    values = (
+                        details["ingestedVolume"],
+                        details["storageCapacityUsed"],
+                        details["reads"],
+                        details["writes"],
+                        details["deletes"],
+                        details["objectCount"],
+                        details["bytesIn"],
+                        details["bytesOut"],
+                        details.get("metadataOnlyObjects", 0),
+                        details.get("metadataOnlyBytes", 0),
+                        details.get("tieredObjects", 0),
+                        details.get("tieredBytes", 0))
+                    usages.add(
+                        resolver.id(Snapshot, ts=timestamp),
+                        namespace_id,
+                        arrow.get(details["startTime"]).timestamp,
+                        arrow.get(details["endTime"]).timestamp,
+                        *values)
+                    daily.append(dict(zip([column for column, _ in DailyUsage.VALUES], values),
+                                      ts=timestamp, namespace_id=namespace_id))
+            if DAILY_ROLLUP_RECORD:
+                DailyUsage.record(daily)
+
+        usages.flush()
         commit()
 
         return "", 204
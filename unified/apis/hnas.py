@@ -1,12 +1,13 @@
 import uuid
-from functools import lru_cache
 
-from . import app, configure, request, instance_method
-from . import add, get_or_create, commit
+from . import app, configure, instance_method
+from . import commit, CopyLoader
 from . import QueryResource, BaseIngestResource, RangeQuery
 
+from ..models import DAILY_ROLLUP_RECORD
 from ..models.hnas import (
-    Snapshot, Owner, Filesystem, VirtualVolume, FilesystemUsage, VirtualVolumeUsage)
+    Snapshot, Owner, Filesystem, VirtualVolume, FilesystemUsage, VirtualVolumeUsage,
+    DailyFilesystemUsage)
 
 
 class SnapshotResource(QueryResource):
@@ -35,6 +36,11 @@ class FilesystemList(RangeQuery):
                                start_ts=kwargs['start'],
                                end_ts=kwargs['end'])
 
+    def _stream(self, id='', **kwargs):
+        return instance_method(Filesystem, 'iter_list', id,
+                               start_ts=kwargs['start'],
+                               end_ts=kwargs['end'])
+
 
 class VirtualVolumeResource(QueryResource):
     query_class = VirtualVolume
@@ -73,59 +79,68 @@ class VirtualVolumeUsageSummary(RangeQuery):
 
 
 class IngestResource(BaseIngestResource):
+    schemas = ("hnas.filesystems", )
+    dimensions = {Filesystem: ("name", ), Owner: ("name", ), VirtualVolume: ("name", "filesystem_id")}
+
     def ingest(self):
         """Ingest usage."""
-
-        @lru_cache(maxsize=1000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
-
-        for message in request.get_json(force=True):
-            if not message["schema"] == "hnas.filesystems":
-                continue
-
-            data = message["data"]
-
-            snapshot = cache(Snapshot, ts=data["timestamp"])
-
-            for name, details in data["filesystems"].items():
-                fs = cache(Filesystem, name=name)
-                fs_usage = {
-                    "filesystem": fs,
-                    "snapshot": snapshot,
-                    "capacity": details["capacity"],
-                    "free": details["free"],
-                    "live_usage": details["live-fs-used"],
-                    "snapshot_usage": details["snapshot-used"]
-                }
-
-                add(FilesystemUsage(**fs_usage))
-
-                if "virtual_volumes" in details:
-                    for vusage in details["virtual_volumes"]:
-                        name = vusage["volume-name"]
-                        if name.startswith("/"):
-                            name = name[1:]
-
-                        vivol = cache(VirtualVolume,
-                                      name=name,
-                                      filesystem=fs)
-
-                        vivol_usage = {
-                            "snapshot": snapshot,
-                            "virtual_volume": vivol,
-                            "files": vusage["file-count"],
-                            "usage": vusage["usage"],
-                            "quota": vusage["usage-limit"]
-                        }
-
+        resolver = self.resolver()
+        fs_usages = CopyLoader(FilesystemUsage, ("filesystem_id", "snapshot_id", "capacity", "free",
+                                                 "live_usage", "snapshot_usage"))
+        vivol_usages = CopyLoader(VirtualVolumeUsage, ("snapshot_id", "virtual_volume_id", "owner_id",
+                                                       "files", "usage", "quota"))
+
+        def volume_name(vusage):
+            name = vusage["volume-name"]
+            return name[1:] if name.startswith("/") else name
+
+        for messages in self.message_batches():
+            for message in messages:
+                data = message["data"]
+                resolver.add(Snapshot, ts=data["timestamp"])
+                for name, details in data["filesystems"].items():
+                    resolver.add(Filesystem, name=name)
+                    for vusage in details.get("virtual_volumes", []):
                         if len(vusage["user-group-account"]) > 0:
-                            owner = cache(Owner,
-                                          name=vusage["user-group-account"])
-                            vivol_usage["owner"] = owner
-
-                        add(VirtualVolumeUsage(**vivol_usage))
-
+                            resolver.add(Owner, name=vusage["user-group-account"])
+            resolver.resolve()
+
+            for message in messages:
+                for name, details in message["data"]["filesystems"].items():
+                    fs_id = resolver.id(Filesystem, name=name)
+                    for vusage in details.get("virtual_volumes", []):
+                        resolver.add(VirtualVolume, name=volume_name(vusage), filesystem_id=fs_id)
+            resolver.resolve()
+
+            daily = []
+            for message in messages:
+                data = message["data"]
+                snapshot_id = resolver.id(Snapshot, ts=data["timestamp"])
+
+                for name, details in data["filesystems"].items():
+                    fs_id = resolver.id(Filesystem, name=name)
+                    fs_usages.add(fs_id, snapshot_id, details["capacity"], details["free"],
+                                  details["live-fs-used"], details["snapshot-used"])
+                    daily.append({"ts": data["timestamp"], "filesystem_id": fs_id,
+                                  "capacity": details["capacity"], "free": details["free"],
+                                  "live_usage": details["live-fs-used"],
+                                  "snapshot_usage": details["snapshot-used"]})
+
+                    for vusage in details.get("virtual_volumes", []):
+                        owner_id = None
+                        if len(vusage["user-group-account"]) > 0:
+                            owner_id = resolver.id(Owner, name=vusage["user-group-account"])
+
+                        vivol_usages.add(snapshot_id,
+                                         resolver.id(VirtualVolume, name=volume_name(vusage),
+                                                     filesystem_id=fs_id),
+                                         owner_id, vusage["file-count"], vusage["usage"],
+                                         vusage["usage-limit"])
+            if DAILY_ROLLUP_RECORD:
+                DailyFilesystemUsage.record(daily)
+
+        fs_usages.flush()
+        vivol_usages.flush()
         commit()
 
         return "", 204
@@ -1,5 +1,5 @@
-from . import app, configure, request, instance_method
-from . import get_or_create, commit
+from . import app, configure, instance_method
+from . import commit
 from . import QueryResource, BaseIngestResource, RangeQuery
 
 from ..models.hpc import Queue, Host, Owner, Allocation, Job
@@ -63,6 +63,9 @@ class JobList(RangeQuery):
     def _get(self, **kwargs):
         return Job.list(start_ts=kwargs['start'], end_ts=kwargs['end'])
 
+    def _stream(self, **kwargs):
+        return Job.iter_list(start_ts=kwargs['start'], end_ts=kwargs['end'])
+
 
 class JobSummary(RangeQuery):
     def _get(self, **kwargs):
@@ -70,35 +73,47 @@ class JobSummary(RangeQuery):
 
 
 class IngestResource(BaseIngestResource):
-    def ingest(self):
-        """Ingest jobs."""
-
-        messages = [message
-                    for message in request.get_json(force=True)
-                    if message["data"].get("state") == "exited"]
-
-        for message in messages:
-            data = message["data"]
+    dimensions = {Queue: ("name", ), Owner: ("name", ), Host: ("name", )}
 
-            queue = get_or_create(Queue, name=data["queue"])
-            owner = get_or_create(Owner, name=data["owner"])
+    def timestamps(self, message):
+        """Jobs are queried by when they ended."""
+        if message["data"].get("state") == "exited":
+            return [int(message["data"]["end"])]
+        return []
 
-            job = get_or_create(Job, job_id=data["jobid"])
-            job.name = data["jobname"]
-            job.queue = queue
-            job.owner = owner
-            job.start = data["start"]
-            job.end = data["end"]
-
-            total_cores = 0
-
-            for hostname, slots in data["exec_host"].items():
-                host = get_or_create(Host, name=hostname)
-                get_or_create(Allocation, job=job, host=host, cores=len(slots))
-                total_cores += len(slots)
-
-            job.cores = total_cores
-            job.cpu_seconds = total_cores * (data["end"] - data["start"])
+    def ingest(self):
+        """Ingest jobs."""
+        resolver = self.resolver()
+
+        for batch in self.message_batches():
+            jobs = [message["data"] for message in batch if message["data"].get("state") == "exited"]
+
+            for data in jobs:
+                resolver.add(Queue, name=data["queue"])
+                resolver.add(Owner, name=data["owner"])
+                for hostname in data["exec_host"]:
+                    resolver.add(Host, name=hostname)
+            resolver.resolve()
+
+            for data in jobs:
+                total_cores = sum(len(slots) for slots in data["exec_host"].values())
+                resolver.add(Job, {
+                    "name": data["jobname"],
+                    "queue_id": resolver.id(Queue, name=data["queue"]),
+                    "owner_id": resolver.id(Owner, name=data["owner"]),
+                    "start": data["start"],
+                    "end": data["end"],
+                    "cores": total_cores,
+                    "cpu_seconds": total_cores * (data["end"] - data["start"])
+                }, job_id=data["jobid"])
+            resolver.resolve()
+
+            for data in jobs:
+                job_id = resolver.id(Job, job_id=data["jobid"])
+                for hostname, slots in data["exec_host"].items():
+                    resolver.add(Allocation, job_id=job_id,
+                                 host_id=resolver.id(Host, name=hostname), cores=len(slots))
+            resolver.resolve()
 
         commit()
 
@@ -1,7 +1,5 @@
-from functools import lru_cache
-
-from . import app, configure, request
-from . import get_or_create, commit
+from . import app, configure
+from . import commit
 from . import QueryResource, BaseIngestResource
 
 from nectar import get_domain
@@ -46,57 +44,76 @@ class SnapshotResource(QueryResource):
 
 
 class IngestResource(BaseIngestResource):
+    dimensions = {Account: ("openstack_id", ), Domain: ("name", ), AccountReference: ("value", "domain_id")}
+
     def ingest(self):
         """Ingest data."""
-
-        @lru_cache(maxsize=10000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
-
-        for message in request.get_json(force=True):
-            data = message["data"]
-
-            snapshot = cache(Snapshot, ts=data["timestamp"])
-
-            for account_detail in data["users"]:
-                account = cache(Account, openstack_id=account_detail["id"])
-
-                if not account_detail["email"]:
-                    continue
-
-                # Fix broken emails containing ";"
-                email = account_detail["email"].split(";")[0]
-
-                domain_name = get_domain(email)
-                domain = cache(Domain,
-                               name=domain_name) if domain_name else None
-
-                reference = cache(AccountReference, value=email, domain=domain)
-                cache(AccountReferenceMapping,
-                      account=account,
-                      reference=reference,
-                      snapshot=snapshot)
-
-            for tenant_detail in data["tenants"]:
-                tenant = cache(Tenant, openstack_id=tenant_detail["id"])
-                tenant.name = tenant_detail["name"]
-                tenant.description = tenant_detail["description"]
-
-                if "allocation_id" in tenant_detail:
-                    try:
-                        tenant.allocation = int(tenant_detail["allocation_id"])
-                    except ValueError:
-                        pass
-
-                if "users" not in tenant_detail:
-                    continue
-
-                for member in tenant_detail["users"]:
-                    account = cache(Account, openstack_id=member["id"])
-                    cache(Membership,
-                          account=account,
-                          tenant=tenant,
-                          snapshot=snapshot)
+        resolver = self.resolver()
+
+        def email(account_detail):
+            # Fix broken emails containing ";"
+            return account_detail["email"].split(";")[0]
+
+        for messages in self.message_batches():
+            for message in messages:
+                data = message["data"]
+                resolver.add(Snapshot, ts=data["timestamp"])
+
+                for account_detail in data["users"]:
+                    resolver.add(Account, openstack_id=account_detail["id"])
+                    if account_detail["email"]:
+                        domain_name = get_domain(email(account_detail))
+                        if domain_name:
+                            resolver.add(Domain, name=domain_name)
+
+                for tenant_detail in data["tenants"]:
+                    update = {
+                        "name": tenant_detail["name"],
+                        "description": tenant_detail["description"]
+                    }
+                    if "allocation_id" in tenant_detail:
+                        try:
+                            update["allocation"] = int(tenant_detail["allocation_id"])
+                        except ValueError:
+                            pass
+                    resolver.add(Tenant, update, openstack_id=tenant_detail["id"])
+
+                    for member in tenant_detail.get("users", []):
+                        resolver.add(Account, openstack_id=member["id"])
+            resolver.resolve()
+
+            for message in messages:
+                for account_detail in message["data"]["users"]:
+                    if account_detail["email"]:
+                        domain_name = get_domain(email(account_detail))
+                        resolver.add(AccountReference, value=email(account_detail),
+                                     domain_id=resolver.id(Domain, name=domain_name) if domain_name else None)
+            resolver.resolve()
+
+            for message in messages:
+                data = message["data"]
+                snapshot_id = resolver.id(Snapshot, ts=data["timestamp"])
+
+                for account_detail in data["users"]:
+                    if not account_detail["email"]:
+                        continue
+                    domain_name = get_domain(email(account_detail))
+                    reference_id = resolver.id(
+                        AccountReference, value=email(account_detail),
+                        domain_id=resolver.id(Domain, name=domain_name) if domain_name else None)
+                    resolver.add(AccountReferenceMapping,
+                                 account_id=resolver.id(Account, openstack_id=account_detail["id"]),
+                                 reference_id=reference_id,
+                                 snapshot_id=snapshot_id)
+
+                for tenant_detail in data["tenants"]:
+                    tenant_id = resolver.id(Tenant, openstack_id=tenant_detail["id"])
+                    for member in tenant_detail.get("users", []):
+                        resolver.add(Membership,
+                                     account_id=resolver.id(Account, openstack_id=member["id"]),
+                                     tenant_id=tenant_id,
+                                     snapshot_id=snapshot_id)
+            resolver.resolve()
 
         commit()
 
@@ -0,0 +1,71 @@
+"""Bulk loading of fact rows with COPY
+
+Rows of usage and state tables are written as tab separated text and
+copied into the database in chunks, ids of rows are generated here so
+nothing has to be read back.
+"""
+import io
+import time
+import uuid
+
+from .. import db
+from .profiling import current_profile
+from .resolver import quote
+
+# Rows in one COPY at most
+COPY_SIZE = 10000
+
+ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_value(value):
+    """Text of a value in COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).translate(ESCAPES)
+
+
+class CopyLoader(object):
+    """Load rows of values of columns into the table of model
+
+    Rows are buffered and copied every chunk_size rows, the rest when
+    flush() is called.
+    """
+
+    def __init__(self, model, columns, chunk_size=COPY_SIZE):
+        self.model = model
+        self.table = model.__table__.name
+        self.columns = ("id", ) + tuple(columns)
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._buffer = io.StringIO()
+        self._pending = 0
+
+    def add(self, *values):
+        """Add a row of values in the order of columns."""
+        line = "\t".join(copy_value(value) for value in (uuid.uuid4(), ) + values)
+        self._buffer.write(line + "\n")
+        self._pending += 1
+        if self._pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Copy buffered rows."""
+        if not self._pending:
+            return
+        statement = "COPY %s (%s) FROM STDIN" % (quote(self.table), ", ".join(map(quote, self.columns)))
+        self._buffer.seek(0)
+        start = time.perf_counter()
+        cursor = db.session.connection(mapper=self.model).connection.cursor()
+        try:
+            cursor.copy_expert(statement, self._buffer)
+        finally:
+            cursor.close()
+        profile = current_profile()
+        if profile is not None:
+            profile.add_statement(statement, time.perf_counter() - start, self._pending)
+        self.count += self._pending
+        self._buffer = io.StringIO()
+        self._pending = 0
@@ -0,0 +1,90 @@
+"""Metrics of requests, database and ingestion in Prometheus text format
+
+When gunicorn runs more than one worker, set environment variable
+PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers so
+metrics are aggregated across them.
+"""
+import os
+import time
+
+from flask import Response, request
+from prometheus_client import (Counter, Histogram, CollectorRegistry, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest, multiprocess)
+
+from .profiling import current_profile
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", os.environ.get("prometheus_multiproc_dir"))
+
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, float("inf"))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float("inf"))
+INGEST_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+REQUESTS = Counter("ersa_requests_total", "Requests by resource",
+                   ["resource", "method", "status"])
+LATENCY = Histogram("ersa_request_duration_seconds", "Request latency by resource",
+                    ["resource", "method"])
+RESPONSE_SIZE = Histogram("ersa_response_size_bytes", "Response size by resource",
+                          ["resource"], buckets=SIZE_BUCKETS)
+STATEMENTS = Histogram("ersa_db_statements", "SQL statements per request by resource",
+                       ["resource"], buckets=COUNT_BUCKETS)
+DB_TIME = Histogram("ersa_db_duration_seconds", "Time spent in SQL statements per request by resource",
+                    ["resource"])
+POOL_WAIT = Histogram("ersa_db_pool_checkout_seconds", "Time waiting for a pooled database connection")
+INGEST_MESSAGES = Counter("ersa_ingest_messages_total", "Messages ingested by schema",
+                          ["resource", "schema"])
+INGEST_ROWS = Counter("ersa_ingest_rows_total", "Rows inserted by ingestion by schema",
+                      ["resource", "schema"])
+INGEST_DURATION = Histogram("ersa_ingest_duration_seconds", "Duration of ingestion by schema",
+                            ["resource", "schema"], buckets=INGEST_BUCKETS)
+
+
+def resource():
+    """Name of the resource serving the current request."""
+    return request.endpoint or "none"
+
+
+def observe_ingest(schemas, duration):
+    """Record an ingestion of numbers of messages by schema taken duration seconds.
+
+    Rows inserted cannot be told apart by schema, so they and the duration are
+    recorded under the schema of the messages or "mixed" if there are many.
+    """
+    name = resource()
+    for schema, count in schemas.items():
+        INGEST_MESSAGES.labels(name, schema).inc(count)
+    schema = next(iter(schemas)) if len(schemas) == 1 else "mixed"
+    INGEST_DURATION.labels(name, schema).observe(duration)
+    profile = current_profile()
+    if profile is not None:
+        INGEST_ROWS.labels(name, schema).inc(profile.rows)
+
+
+def generate():
+    """Response of metrics of all processes."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, pool_class=None):
+    """Record metrics of requests of app and connection checkouts of pool_class."""
+    if pool_class is not None:
+        pool_class.on_checkout = POOL_WAIT.observe
+
+    @app.after_request
+    def record_request(response):
+        profile = current_profile()
+        if profile is None:
+            return response
+        name = resource()
+        REQUESTS.labels(name, request.method, response.status_code).inc()
+        LATENCY.labels(name, request.method).observe(time.perf_counter() - profile.start)
+        STATEMENTS.labels(name).observe(profile.statements)
+        DB_TIME.labels(name).observe(profile.timings["db"])
+        size = response.calculate_content_length()
+        if size is not None:
+            RESPONSE_SIZE.labels(name).observe(size)
+        return response
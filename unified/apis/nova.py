@@ -1,5 +1,4 @@
 import uuid
-from functools import lru_cache
 
 from werkzeug.exceptions import NotFound
 
@@ -7,14 +6,16 @@ from flask_restful import reqparse
 from flask_sqlalchemy import BaseQuery
 
 from . import create_logger
-from . import app, configure, request, require_auth
-from . import db, get_or_create, add, commit, QUERY_PARSER, RANGE_PARSER
+from . import app, configure, require_auth
+from . import db, commit, CopyLoader, QUERY_PARSER, RANGE_PARSER
 from . import QueryResource, BaseIngestResource, RangeQuery
 
 from ..models.nova import (
     Snapshot, Image, Flavor, Hypervisor, AvailabilityZone, Tenant, Account,
-    Instance, InstanceStatus, InstanceState, Summary,
-    IPAddress, MACAddress, IPAddressMapping, MACAddressMapping
+    Instance, InstanceStatus, InstanceState, InstanceLifespan, Summary,
+    IPAddress, MACAddress, IPAddressMapping, MACAddressMapping,
+    IPAddressInterval, MACAddressInterval, IPAddressIntervalMapping, MACAddressIntervalMapping,
+    NOVA_ADDRESS_INTERVALS, NOVA_LIFESPAN_RECORD
 )
 
 logger = create_logger(__name__)
@@ -25,90 +26,154 @@ class SnapshotResource(QueryResource):
     query_class = Snapshot
 
 
+class AddressIntervals(object):
+    """Collect addresses of instances seen in snapshots and extend their intervals on flush"""
+
+    def __init__(self, model):
+        self.model = model
+        self._pairs = {}
+
+    def seen(self, ts):
+        """Record a snapshot, which may have no address at all."""
+        self._pairs.setdefault(ts, set())
+
+    def add(self, ts, instance_id, address_id):
+        self._pairs.setdefault(ts, set()).add((instance_id, address_id))
+
+    def flush(self):
+        for ts in sorted(self._pairs):
+            self.model.extend(ts, self._pairs[ts])
+        self._pairs = {}
+
+
 class IngestResource(BaseIngestResource):
+    dimensions = {
+        AvailabilityZone: ("name", ), Account: ("openstack_id", ), Tenant: ("openstack_id", ),
+        InstanceStatus: ("name", ), Image: ("openstack_id", ), Flavor: ("openstack_id", ),
+        MACAddress: ("address", ), IPAddress: ("address", "family"),
+        Hypervisor: ("name", "availability_zone_id")
+    }
+
     def ingest(self):
         """Ingest data."""
-
-        @lru_cache(maxsize=100000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
-
-        for message in request.get_json(force=True):
-            data = message["data"]
-
-            snapshot = cache(Snapshot, ts=data["timestamp"])
-
-            for flavor_detail in data["flavors"]:
-                flavor = cache(Flavor, openstack_id=flavor_detail["id"])
-                flavor.name = flavor_detail["name"]
-                flavor.vcpus = flavor_detail["vcpus"]
-                flavor.ram = flavor_detail["ram"]
-                flavor.disk = flavor_detail["disk"]
-                flavor.ephemeral = flavor_detail["OS-FLV-EXT-DATA:ephemeral"]
-                flavor.public = flavor_detail["os-flavor-access:is_public"]
-
-            for instance_detail in data["instances"]:
-                availability_zone_name = instance_detail[
-                    "OS-EXT-AZ:availability_zone"]
-                if not availability_zone_name:
-                    continue
-                availability_zone = cache(AvailabilityZone,
-                                          name=availability_zone_name)
-                if not availability_zone_name.startswith('sa'):
-                    logger.debug("Skip non-sa zone: %s" % availability_zone_name)
-                    continue
-
-                hypervisor_hostname = instance_detail[
-                    "OS-EXT-SRV-ATTR:hypervisor_hostname"]
-                if not hypervisor_hostname:
-                    continue
-
-                hypervisor = cache(Hypervisor,
-                                   name=hypervisor_hostname,
-                                   availability_zone=availability_zone)
-
-                flavor = cache(Flavor,
-                               openstack_id=instance_detail["flavor"]["id"])
-                account = cache(Account,
-                                openstack_id=instance_detail["user_id"])
-                tenant = cache(Tenant,
-                               openstack_id=instance_detail["tenant_id"])
-                status = cache(InstanceStatus,
-                               name=instance_detail["OS-EXT-STS:vm_state"])
-
-                if not isinstance(instance_detail["image"], dict):
-                    continue
-                image = cache(Image,
-                              openstack_id=instance_detail["image"]["id"])
-
-                instance = cache(Instance, openstack_id=instance_detail["id"])
-                instance.account = account
-                instance.tenant = tenant
-                instance.flavor = flavor
-                instance.availability_zone = availability_zone
-
-                add(InstanceState(snapshot=snapshot,
-                                  instance=instance,
-                                  image=image,
-                                  name=instance_detail["name"],
-                                  hypervisor=hypervisor,
-                                  status=status))
-
+        resolver = self.resolver()
+        states = CopyLoader(InstanceState, ("snapshot_id", "instance_id", "image_id", "name",
+                                            "hypervisor_id", "status_id"))
+        if NOVA_ADDRESS_INTERVALS:
+            macs = AddressIntervals(MACAddressInterval)
+            ips = AddressIntervals(IPAddressInterval)
+        else:
+            macs = CopyLoader(MACAddressMapping, ("snapshot_id", "instance_id", "address_id"))
+            ips = CopyLoader(IPAddressMapping, ("snapshot_id", "instance_id", "address_id"))
+
+        for messages in self.message_batches():
+            instances = []
+            for message in messages:
+                data = message["data"]
+                resolver.add(Snapshot, ts=data["timestamp"])
+                if NOVA_ADDRESS_INTERVALS:
+                    macs.seen(data["timestamp"])
+                    ips.seen(data["timestamp"])
+
+                for flavor_detail in data["flavors"]:
+                    resolver.add(Flavor, {
+                        "name": flavor_detail["name"],
+                        "vcpus": flavor_detail["vcpus"],
+                        "ram": flavor_detail["ram"],
+                        "disk": flavor_detail["disk"],
+                        "ephemeral": flavor_detail["OS-FLV-EXT-DATA:ephemeral"],
+                        "public": flavor_detail["os-flavor-access:is_public"]
+                    }, openstack_id=flavor_detail["id"])
+
+                for instance_detail in data["instances"]:
+                    availability_zone_name = instance_detail[
+                        "OS-EXT-AZ:availability_zone"]
+                    if not availability_zone_name:
+                        continue
+                    resolver.add(AvailabilityZone, name=availability_zone_name)
+                    if not availability_zone_name.startswith('sa'):
+                        logger.debug("Skip non-sa zone: %s" % availability_zone_name)
+                        continue
+
+                    if not instance_detail["OS-EXT-SRV-ATTR:hypervisor_hostname"]:
+                        continue
+
+                    resolver.add(Flavor, openstack_id=instance_detail["flavor"]["id"])
+                    resolver.add(Account, openstack_id=instance_detail["user_id"])
+                    resolver.add(Tenant, openstack_id=instance_detail["tenant_id"])
+                    resolver.add(InstanceStatus, name=instance_detail["OS-EXT-STS:vm_state"])
+
+                    if not isinstance(instance_detail["image"], dict):
+                        continue
+                    resolver.add(Image, openstack_id=instance_detail["image"]["id"])
+
+                    for network in instance_detail["addresses"].values():
+                        for address in network:
+                            resolver.add(MACAddress, address=address["OS-EXT-IPS-MAC:mac_addr"])
+                            resolver.add(IPAddress, address=address["addr"], family=address["version"])
+
+                    instances.append((data["timestamp"], instance_detail))
+            resolver.resolve()
+
+            for _, instance_detail in instances:
+                availability_zone_id = resolver.id(AvailabilityZone,
+                                                   name=instance_detail["OS-EXT-AZ:availability_zone"])
+                resolver.add(Hypervisor,
+                             name=instance_detail["OS-EXT-SRV-ATTR:hypervisor_hostname"],
+                             availability_zone_id=availability_zone_id)
+                resolver.add(Instance, {
+                    "account_id": resolver.id(Account, openstack_id=instance_detail["user_id"]),
+                    "tenant_id": resolver.id(Tenant, openstack_id=instance_detail["tenant_id"]),
+                    "flavor_id": resolver.id(Flavor, openstack_id=instance_detail["flavor"]["id"]),
+                    "availability_zone_id": availability_zone_id
+                }, openstack_id=instance_detail["id"])
+            resolver.resolve()
+
+            lifespans = {}
+            for ts, instance_detail in instances:
+                snapshot_id = resolver.id(Snapshot, ts=ts)
+                instance_id = resolver.id(Instance, openstack_id=instance_detail["id"])
+                availability_zone_id = resolver.id(AvailabilityZone,
+                                                   name=instance_detail["OS-EXT-AZ:availability_zone"])
+                state = {
+                    "name": instance_detail["name"],
+                    "image_id": resolver.id(Image, openstack_id=instance_detail["image"]["id"]),
+                    "status_id": resolver.id(InstanceStatus, name=instance_detail["OS-EXT-STS:vm_state"]),
+                    "hypervisor_id": resolver.id(Hypervisor,
+                                                 name=instance_detail["OS-EXT-SRV-ATTR:hypervisor_hostname"],
+                                                 availability_zone_id=availability_zone_id)
+                }
+                states.add(snapshot_id, instance_id, state["image_id"], state["name"],
+                           state["hypervisor_id"], state["status_id"])
+
+                if NOVA_LIFESPAN_RECORD:
+                    lifespan = lifespans.get(instance_id)
+                    if lifespan is None:
+                        lifespans[instance_id] = dict(state, instance_id=instance_id,
+                                                      first_seen_ts=ts, last_seen_ts=ts)
+                    else:
+                        lifespan["first_seen_ts"] = min(lifespan["first_seen_ts"], ts)
+                        if ts >= lifespan["last_seen_ts"]:
+                            lifespan.update(state, last_seen_ts=ts)
+
+                # intervals are extended by time of snapshots
+                snapshot = ts if NOVA_ADDRESS_INTERVALS else snapshot_id
                 for network in instance_detail["addresses"].values():
                     for address in network:
-                        mac = cache(MACAddress,
-                                    address=address["OS-EXT-IPS-MAC:mac_addr"])
-                        add(MACAddressMapping(snapshot=snapshot,
-                                              instance=instance,
-                                              address=mac))
-
-                        ip = cache(IPAddress,
-                                   address=address["addr"],
-                                   family=address["version"])
-                        add(IPAddressMapping(snapshot=snapshot,
-                                             instance=instance,
-                                             address=ip))
-
+                        macs.add(snapshot, instance_id,
+                                 resolver.id(MACAddress, address=address["OS-EXT-IPS-MAC:mac_addr"]))
+                        ips.add(snapshot, instance_id,
+                                resolver.id(IPAddress, address=address["addr"], family=address["version"]))
+
+            if NOVA_LIFESPAN_RECORD:
+                InstanceLifespan.record(list(lifespans.values()))
+            if NOVA_ADDRESS_INTERVALS:
+                macs.flush()
+                ips.flush()
+
+        states.flush()
+        macs.flush()
+        ips.flush()
         commit()
         return "", 204
 
@@ -169,6 +234,17 @@ class InstanceLatestState(RangeQuery):
         return rslt
 
 
+class InstanceLatestStates(RangeQuery):
+    """ Get the latest full information of all instances on sa nodes in a range
+
+        Every item is what InstanceLatestState returns for an instance.
+    """
+    def _get(self, **kwargs):
+        instance_ids = Summary(kwargs['start'], kwargs['end']).query
+        return Instance.latest_states(start_ts=kwargs['start'], end_ts=kwargs['end'],
+                                      instance_ids=instance_ids)
+
+
 class InstanceResource(QueryResource):
     """Instance Endpoint"""
     query_class = Instance
@@ -271,14 +347,60 @@ class SummaryResource(RangeQuery):
         return result
 
 
+# mappings expanded from intervals are walked in the order of their intervals
+# and snapshots, which is indexed unlike their computed ids
+MAPPING_ORDER = "interval,ts" if NOVA_ADDRESS_INTERVALS else "id"
+
+
 class IPAddressMappingResource(QueryResource):
     """IP Address Mapping Resource"""
-    query_class = IPAddressMapping
+    query_class = IPAddressIntervalMapping if NOVA_ADDRESS_INTERVALS else IPAddressMapping
+    default_order = MAPPING_ORDER
 
 
 class MACAddressMappingResource(QueryResource):
     """MAC Address Mapping Resource"""
-    query_class = MACAddressMapping
+    query_class = MACAddressIntervalMapping if NOVA_ADDRESS_INTERVALS else MACAddressMapping
+    default_order = MAPPING_ORDER
+
+
+AT_PARSER = reqparse.RequestParser()
+AT_PARSER.add_argument("ts", type=int, required=True)
+AT_PARSER.add_argument("instance")
+AT_PARSER.add_argument("address")
+
+
+class AddressMappingAt(RangeQuery):
+    """ Get addresses of instances in the latest snapshot at or before ts
+
+        Optionally only of an instance or an address by their internal ids.
+    """
+    arg_parser = AT_PARSER
+    cacheable = False
+    mapping_model = None
+    interval_model = None
+
+    def _get(self, **kwargs):
+        model = self.interval_model if NOVA_ADDRESS_INTERVALS else self.mapping_model
+        query = model.at(kwargs["ts"])
+        if kwargs["instance"]:
+            query = query.filter(model.instance_id == kwargs["instance"])
+        if kwargs["address"]:
+            query = query.filter(model.address_id == kwargs["address"])
+        return [{"instance": instance_id, "address": address_id}
+                for instance_id, address_id in query.with_entities(model.instance_id, model.address_id)]
+
+
+class IPAddressMappingAt(AddressMappingAt):
+    """IP addresses of instances at a time"""
+    mapping_model = IPAddressMapping
+    interval_model = IPAddressInterval
+
+
+class MACAddressMappingAt(AddressMappingAt):
+    """MAC addresses of instances at a time"""
+    mapping_model = MACAddressMapping
+    interval_model = MACAddressInterval
 
 
 def setup():
@@ -292,6 +414,7 @@ def setup():
         "/hypervisor": HypervisorResource,
         "/image": ImageResource,
         "/instance": InstanceResource,
+        "/instance/latest": InstanceLatestStates,
         "/instance/<id>/latest": InstanceLatestState,
         "/instance/status": InstanceStatusResource,
         "/instance/state": InstanceStateResource,
@@ -300,6 +423,8 @@ def setup():
         "/mac": MACAddressResource,
         "/ip/mapping": IPAddressMappingResource,
         "/mac/mapping": MACAddressMappingResource,
+        "/ip/mapping/at": IPAddressMappingAt,
+        "/mac/mapping/at": MACAddressMappingAt,
         "/ingest": IngestResource
     }
 
@@ -0,0 +1,117 @@
+"""Per-request profiling of SQL statements and Server-Timing header
+
+Statements executed in a request are counted and timed by cursor events of
+SQLAlchemy engines, rows inserted by them are counted too. Other phases of
+a request can be timed by timed().
+"""
+import time
+import heapq
+import logging
+
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Number of the slowest statements kept for logging slow requests
+SLOWEST = 5
+# Order of phases in Server-Timing header
+PHASES = ("db", "serialise", "auth")
+
+
+class Profile(object):
+    """Timings of a request in seconds"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.slowest = []
+
+    def add_statement(self, statement, duration, rows=0):
+        self.statements += 1
+        self.rows += rows
+        self.timings["db"] += duration
+        item = (duration, statement)
+        if len(self.slowest) < SLOWEST:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def server_timing(self, total):
+        """Value of Server-Timing header, durations are in milliseconds."""
+        metrics = ['db;dur=%.1f;desc="%d statements"' % (self.timings["db"] * 1000, self.statements)]
+        metrics.extend("%s;dur=%.1f" % (name, self.timings[name] * 1000) for name in PHASES[1:])
+        metrics.append("total;dur=%.1f" % (total * 1000))
+        return ", ".join(metrics)
+
+
+def current_profile():
+    """Get the profile of the current request, None when not in a request."""
+    if has_request_context():
+        return g.get("profile")
+    return None
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to a phase of the current request."""
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings[phase] += time.perf_counter() - start
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    starts = conn.info.get("query_start")
+    if profile is not None and starts:
+        rows = 0
+        if statement.lstrip()[:6].upper() == "INSERT" and cursor.rowcount > 0:
+            rows = cursor.rowcount
+        profile.add_statement(statement, time.perf_counter() - starts.pop(), rows)
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def init_app(app, slow_ms=None):
+    """Profile requests of app and log those taking at least slow_ms milliseconds."""
+
+    @app.before_request
+    def start_profile():
+        g.profile = Profile()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = current_profile()
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.start
+        response.headers["Server-Timing"] = profile.server_timing(total)
+        if slow_ms is not None and total * 1000 >= slow_ms:
+            slowest = "".join("\n  %.1fms %s" % (duration * 1000, " ".join(statement.split()))
+                              for duration, statement in sorted(profile.slowest, reverse=True))
+            logger.warning("Slow request %s %s: %.1fms, %d statements in %.1fms.%s" %
+                           (request.method, request.full_path, total * 1000, profile.statements,
+                            profile.timings["db"] * 1000, slowest))
+        return response
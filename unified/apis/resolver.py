@@ -0,0 +1,299 @@
+"""Bulk resolution of dimensions to their ids
+
+Ingestion used to get or create dimensions (hosts, owners, snapshots...)
+one by one. A Resolver collects the values of dimensions of a batch of
+messages first, then finds or creates each model with a few statements.
+Ids of dimensions can be kept by a DimensionCache shared by requests of a
+process, so most of them are known without asking the database.
+"""
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import text, bindparam, select, UniqueConstraint
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.types import NullType
+
+from .. import db
+from .cache import TTLCache
+
+# Rows in an INSERT statement at most
+INSERT_SIZE = 1000
+
+DIALECT = postgresql.dialect()
+quote = DIALECT.identifier_preparer.quote
+
+
+def column_type(column):
+    """Type of a column, foreign keys declared without type take the type of their targets."""
+    if isinstance(column.type, NullType) and column.foreign_keys:
+        return column_type(next(iter(column.foreign_keys)).column)
+    return column.type
+
+
+def array_type(column):
+    """SQL of the array type of a column."""
+    return "%s[]" % DIALECT.type_compiler.process(column_type(column))
+
+
+def unique_keys(model):
+    """Sets of columns of the table of model unique together, which ON CONFLICT detects."""
+    table = model.__table__
+    keys = [constraint.columns for constraint in table.constraints if isinstance(constraint, UniqueConstraint)]
+    keys += [index.columns for index in table.indexes
+             if index.unique and index.dialect_options["postgresql"]["where"] is None]
+    return [set(column.name for column in columns) for columns in keys]
+
+
+def chunks(items, size=INSERT_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_insert(model, rows, skip_conflicts=False, update_on=None):
+    """Insert rows, dicts of column values, into the table of model with multi-row INSERTs.
+
+    With skip_conflicts, rows conflicting with existing ones are skipped.
+    With update_on, columns of a unique key, rows conflicting on the key
+    update existing ones, the last of rows with the same key wins.
+    """
+    if update_on:
+        rows = {tuple(row.get(column) for column in update_on): row for row in rows}.values()
+    groups = defaultdict(list)
+    for row in rows:
+        groups[tuple(sorted(row))].append(row)
+    for columns, group in groups.items():
+        for chunk in chunks(group):
+            statement = insert(model.__table__).values(chunk)
+            if update_on:
+                statement = statement.on_conflict_do_update(
+                    index_elements=list(update_on),
+                    set_={column: statement.excluded[column] for column in columns
+                          if column not in update_on})
+            elif skip_conflicts:
+                statement = statement.on_conflict_do_nothing()
+            db.session.execute(statement, mapper=model)
+
+
+class DimensionCache(object):
+    """Ids of dimensions by model and key shared by requests of a process
+
+    Every model has its own LRU cache of maxsize entries living ttl seconds.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._caches = {}
+
+    def _cache(self, model):
+        cache = self._caches.get(model)
+        if cache is None:
+            cache = self._caches.setdefault(model, TTLCache(maxsize=self.maxsize, ttl=self.ttl))
+        return cache
+
+    def get(self, model, key):
+        return self._cache(model).get(key)
+
+    def update(self, model, ids):
+        """Add ids by key of model."""
+        cache = self._cache(model)
+        for key, id in ids.items():
+            cache.set(key, id)
+
+    def clear(self, models=None):
+        """Remove ids of models, all if models is None."""
+        for model in (self._caches.keys() if models is None else models):
+            self._cache(model).clear()
+
+    def prewarm(self, model, columns):
+        """Load ids of model keyed by columns, up to maxsize of them."""
+        table = model.__table__
+        statement = select([table.c.id] + [table.c[column] for column in columns]).limit(self.maxsize)
+        self.update(model, {Resolver.key(**dict(zip(columns, row[1:]))): row[0]
+                            for row in db.session.execute(statement, mapper=model)})
+
+
+class Resolver(object):
+    """Find or create dimensions in bulk and remember their ids
+
+    A dimension is identified by the values of its columns, for example
+    resolver.add(Filesystem, name="home", host_id=host_id). Once resolve()
+    is called, resolver.id(Filesystem, name="home", host_id=host_id) is its id.
+
+    Dimensions with an update, for example resolver.add(Flavor, {"vcpus": 2},
+    openstack_id="..."), are inserted or have their update applied. Columns
+    identifying them have to be unique together.
+
+    Ids of models in cached are looked up in cache first. Ids resolved from
+    the database are only added to cache by publish(), after they are
+    committed.
+
+    With identify, a function of a model and a key, ids of new dimensions are
+    generated by it when they are added, so they are inserted without being
+    read back. Inserts return ids of the rows they create, dimensions existing
+    with other ids, e.g. created before ids were generated, are read back.
+    Keys which are not unique, or have NULL, are looked up before inserting
+    so existing rows are not duplicated.
+    """
+
+    def __init__(self, cache=None, cached=(), identify=None):
+        self.cache = cache
+        self.cached = set(cached) if cache is not None else set()
+        self.identify = identify
+        self._pending = OrderedDict()
+        self._ids = defaultdict(dict)
+        self._resolved = defaultdict(dict)
+
+    @staticmethod
+    def key(**values):
+        return tuple(sorted(values.items()))
+
+    def add(self, model, update=None, **values):
+        """Add a dimension to be resolved, return its key."""
+        key = self.key(**values)
+        ids = self._ids[model]
+        if update is None and model in self.cached and key not in ids:
+            id = self.cache.get(model, key)
+            if id is not None:
+                ids[key] = id
+        if update is not None or key not in ids:
+            entries = self._pending.setdefault(model, OrderedDict())
+            if update is not None or key not in entries:
+                entries[key] = update
+            if self.identify is not None:
+                ids[key] = self.identify(model, key)
+        return key
+
+    def id(self, model, **values):
+        """Id of a resolved dimension."""
+        return self._ids[model][self.key(**values)]
+
+    def __getitem__(self, model_key):
+        model, key = model_key
+        return self._ids[model][key]
+
+    def resolve(self):
+        """Find or create dimensions added since the last call."""
+        for model, entries in self._pending.items():
+            groups = defaultdict(list)
+            for key, update in entries.items():
+                columns = tuple(column for column, _ in key)
+                groups[(columns, tuple(sorted(update)) if update else None)].append((key, update))
+            for (columns, updated), group in groups.items():
+                if updated:
+                    self._upsert(model, columns, group)
+                elif self.identify is not None:
+                    self._insert(model, [key for key, _ in group])
+                else:
+                    self._find_or_create(model, [key for key, _ in group])
+        self._pending.clear()
+
+    def publish(self):
+        """Add ids resolved from the database to cache."""
+        for model, ids in self._resolved.items():
+            if model in self.cached:
+                self.cache.update(model, ids)
+        self._resolved.clear()
+
+    def _upsert(self, model, columns, group):
+        table = model.__table__
+        ids = self._ids[model]
+        returned = set()
+        for chunk in chunks(group):
+            if self.identify is None:
+                rows = [dict(key, **update) for key, update in chunk]
+            else:
+                rows = [dict(key, id=ids[key], **update) for key, update in chunk]
+            statement = insert(table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=list(columns),
+                set_={column: statement.excluded[column] for column in chunk[0][1]})
+            if self.identify is None:
+                db.session.execute(statement, mapper=model)
+            else:
+                returned.update(str(row[0]) for row in
+                                db.session.execute(statement.returning(table.c.id), mapper=model))
+        if self.identify is None:
+            self._select(model, [key for key, _ in group])
+        else:
+            self._generated(model, [key for key, _ in group], returned)
+
+    def _insert(self, model, keys):
+        """Insert dimensions with their generated ids unless they exist."""
+        table = model.__table__
+        ids = self._ids[model]
+        columns = set(column for column, _ in keys[0])
+        unique = any(unique <= columns for unique in unique_keys(model))
+        lookup = [key for key in keys if not unique or any(value is None for _, value in key)]
+        if lookup:
+            found = self._select(model, lookup)
+            keys = [key for key in keys if key not in found]
+
+        returned = set()
+        for chunk in chunks(keys):
+            statement = insert(table).values([dict(key, id=ids[key]) for key in chunk])
+            statement = statement.on_conflict_do_nothing().returning(table.c.id)
+            returned.update(str(row[0]) for row in db.session.execute(statement, mapper=model))
+        self._generated(model, keys, returned)
+
+    def _generated(self, model, keys, returned):
+        """Keep generated ids of keys which were returned, read back the others."""
+        ids = self._ids[model]
+        self._resolved[model].update((key, ids[key]) for key in keys if ids[key] in returned)
+        existing = [key for key in keys if ids[key] not in returned]
+        if existing:
+            found = self._select(model, existing)
+            missing = [key for key in existing if key not in found]
+            if missing:
+                raise LookupError("Cannot resolve %d %s" % (len(missing), model.__name__))
+
+    def _find_or_create(self, model, keys):
+        found = self._select(model, keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            # others may have inserted some of them since, they are skipped if
+            # the columns are unique together
+            for chunk in chunks(missing):
+                statement = insert(model.__table__).values([dict(key) for key in chunk])
+                db.session.execute(statement.on_conflict_do_nothing(), mapper=model)
+            found = self._select(model, missing)
+            missing = [key for key in missing if key not in found]
+        if missing:
+            raise LookupError("Cannot resolve %d %s" % (len(missing), model.__name__))
+
+    def _select(self, model, keys):
+        """Find ids of keys, remember and return them."""
+        table = model.__table__
+        ids = self._ids[model]
+        found = {}
+        # NULL never equals, keys with NULL in different columns are queried apart
+        groups = defaultdict(list)
+        for key in keys:
+            groups[tuple(column for column, value in key if value is None)].append(key)
+
+        for nulls, group in groups.items():
+            columns = [column for column, _ in group[0] if column not in nulls]
+            conditions = ["t.%s IS NULL" % quote(column) for column in nulls]
+            if not columns:
+                # only one key can have all columns NULL
+                statement = text("SELECT 1, t.id FROM %s AS t WHERE %s LIMIT 1" %
+                                 (quote(table.name), " AND ".join(conditions)))
+            else:
+                conditions += ["t.{0} = k.{0}".format(quote(column)) for column in columns]
+                arrays = ", ".join("CAST(:k%d AS %s)" % (i, array_type(table.c[column]))
+                                   for i, column in enumerate(columns))
+                statement = text("SELECT k.position, t.id FROM unnest(%s) WITH ORDINALITY AS k(%s) "
+                                 "JOIN %s AS t ON %s" % (
+                                     arrays,
+                                     ", ".join([quote(column) for column in columns] + ["position"]),
+                                     quote(table.name),
+                                     " AND ".join(conditions)))
+                statement = statement.bindparams(*[
+                    bindparam("k%d" % i, [dict(key)[column] for key in group])
+                    for i, column in enumerate(columns)])
+            for position, id in db.session.execute(statement, mapper=model):
+                found[group[position - 1]] = id
+
+        ids.update(found)
+        self._resolved[model].update(found)
+        return found
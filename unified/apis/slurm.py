@@ -1,5 +1,5 @@
-from . import app, configure, request, instance_method
-from . import get_or_create, commit
+from . import app, configure, instance_method
+from . import commit, bulk_insert
 from . import Resource, QueryResource, BaseIngestResource, RangeQuery
 
 from ..models.slurm import Job
@@ -26,6 +26,9 @@ class JobList(RangeQuery):
     def _get(self, **kwargs):
         return Job.list(start_ts=kwargs['start'], end_ts=kwargs['end'])
 
+    def _stream(self, **kwargs):
+        return Job.iter_list(start_ts=kwargs['start'], end_ts=kwargs['end'])
+
 
 class JobSummary(RangeQuery):
     def _get(self, **kwargs):
@@ -33,15 +36,18 @@ class JobSummary(RangeQuery):
 
 
 class IngestResource(BaseIngestResource):
-    def ingest(self):
-        """Ingest jobs."""
+    schemas = ("hpc.slurm", )
 
-        messages = [message for message in request.get_json(force=True)
-                    if message["schema"] == "hpc.slurm"]
+    def timestamps(self, message):
+        """Jobs are queried by when they ended."""
+        return [int(job["end"]) for job in message["data"]["jobs"] if job.get("end")]
+
+    def ingest(self):
+        """Ingest jobs, those ingested already are updated."""
 
-        for message in messages:
-            for job in message["data"]["jobs"]:
-                get_or_create(Job, **job)
+        for messages in self.message_batches():
+            bulk_insert(Job, [job for message in messages for job in message["data"]["jobs"]],
+                        update_on=("job_id", "start"))
 
         commit()
 
@@ -0,0 +1,184 @@
+"""Durable local spool of ingestion jobs
+
+A job is a request body saved in pending directory with its status beside.
+Worker threads of every process sharing the spool claim a job by moving it
+into running directory and hold a lock on it while it is processed, so a job
+left in running directory by a dead process can be told apart and retried.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def write_json(path, content):
+    """Write content to path atomically."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp, path)
+
+
+class Spool(object):
+    """Jobs saved in path and processed by handler in worker threads
+
+    handler is called with the status and the body of a job. A job fails if
+    the handler raises an exception, its message is saved in the status.
+    A job recovered from a dead process has recovered in its status, the
+    handler may have completed it before the process died.
+    Statuses of finished jobs are kept for retention seconds.
+    """
+
+    def __init__(self, path, handler, workers=1, poll=5, retention=86400):
+        self.path = path
+        self.handler = handler
+        self.poll = poll
+        self.retention = retention
+        for name in (PENDING, RUNNING, "status"):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+        self._wakeup = threading.Event()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start worker threads, only once however often it is called."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for thread in self._threads:
+            thread.start()
+
+    def _body(self, state, job):
+        return os.path.join(self.path, state, "%s.json" % job)
+
+    def _status(self, job):
+        return os.path.join(self.path, "status", "%s.json" % job)
+
+    def status(self, job):
+        """Get the status of a job, None if it is unknown."""
+        try:
+            with open(self._status(job)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _update(self, current, **changes):
+        current.update(changes)
+        write_json(self._status(current["job"]), current)
+        return current
+
+    def submit(self, body, **info):
+        """Save body as a pending job with info in its status, return the status."""
+        job = str(uuid.uuid4())
+        status = dict(info, job=job, status=PENDING, submitted=time.time(),
+                      started=None, finished=None, error=None)
+        self._update(status)
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, PENDING), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._body(PENDING, job))
+        self._wakeup.set()
+        return status
+
+    def _pending(self):
+        """Pending jobs, the oldest first."""
+        jobs = []
+        for name in os.listdir(os.path.join(self.path, PENDING)):
+            if name.endswith(".json"):
+                try:
+                    jobs.append((os.path.getmtime(self._body(PENDING, name[:-5])), name[:-5]))
+                except FileNotFoundError:
+                    continue
+        return [job for _, job in sorted(jobs)]
+
+    def _claim(self):
+        """Move a pending job into running directory, return its id and locked file."""
+        for job in self._pending():
+            path = self._body(RUNNING, job)
+            try:
+                os.rename(self._body(PENDING, job), path)
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue    # claimed by another worker
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                claimed = os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+            except FileNotFoundError:
+                claimed = False
+            if claimed:
+                return job, f
+            f.close()   # moved back by recover() before it was locked
+        return None, None
+
+    def recover(self):
+        """Move jobs left running by dead processes back to pending."""
+        running = os.path.join(self.path, RUNNING)
+        for name in os.listdir(running):
+            path = os.path.join(running, name)
+            try:
+                with open(path, "rb") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    status = self.status(name[:-5])
+                    if status is not None:
+                        # the handler has to tell if the job has been done
+                        self._update(status, recovered=True)
+                    os.rename(path, os.path.join(self.path, PENDING, name))
+                    logger.warning("Ingestion job %s is retried", name[:-5])
+            except (BlockingIOError, FileNotFoundError):
+                continue
+
+    def prune(self):
+        """Remove statuses of jobs finished before retention."""
+        limit = time.time() - self.retention
+        for name in os.listdir(os.path.join(self.path, "status")):
+            status = self.status(name[:-5])
+            if status and status["finished"] and status["finished"] < limit:
+                try:
+                    os.remove(self._status(status["job"]))
+                except FileNotFoundError:
+                    pass
+
+    def run(self, job, f):
+        """Process a claimed job."""
+        status = self.status(job) or {"job": job}
+        self._update(status, status=RUNNING, started=time.time())
+        try:
+            self.handler(status, f.read())
+        except Exception as e:
+            logger.error("Ingestion job %s failed. Detail: %s" % (job, str(e)))
+            self._update(status, status=FAILED, finished=time.time(), error=str(e))
+        else:
+            self._update(status, status=DONE, finished=time.time())
+        finally:
+            os.remove(self._body(RUNNING, job))
+            f.close()
+
+    def _work(self):
+        while True:
+            try:
+                job, f = self._claim()
+                if job is None:
+                    self.recover()
+                    self.prune()
+                    self._wakeup.wait(self.poll)
+                    self._wakeup.clear()
+                else:
+                    self.run(job, f)
+            except Exception as e:
+                logger.error("Ingestion worker error. Detail: %s" % str(e))
+                time.sleep(self.poll)
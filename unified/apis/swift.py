@@ -1,12 +1,13 @@
 import string
 
-from functools import lru_cache, reduce
+from functools import reduce
 
-from . import app, configure, request
-from . import add, get_or_create, commit
+from . import app, configure
+from . import commit, CopyLoader
 from . import QueryResource, BaseIngestResource, RangeQuery
 
-from ..models.swift import Snapshot, Account, Usage
+from ..models import DAILY_ROLLUP_RECORD
+from ..models.swift import Snapshot, Account, Usage, DailyUsage
 
 
 class SnapshotResource(QueryResource):
@@ -22,31 +23,42 @@ class UsageResource(QueryResource):
 
 
 class IngestResource(BaseIngestResource):
-    def ingest(self):
-        @lru_cache(maxsize=100000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
-
-        for message in request.get_json(force=True):
-            data = message["data"]
+    dimensions = {Account: ("openstack_id", )}
 
-            snapshot = cache(Snapshot, ts=data["timestamp"])
+    def ingest(self):
+        resolver = self.resolver()
+        usages = CopyLoader(Usage, ("bytes", "containers", "objects", "quota", "account_id", "snapshot_id"))
 
+        def accounts(data):
             for key, value in data.items():
                 # Ugly hack until swift data pushed down into own dict.
                 valid = [c in string.hexdigits for c in key]
-                if not reduce(lambda x, y: x and y, valid):
-                    continue
-
-                account = cache(Account, openstack_id=key)
-
-                add(Usage(bytes=value["bytes"],
-                          containers=value["containers"],
-                          objects=value["objects"],
-                          quota=value["quota"],
-                          account=account,
-                          snapshot=snapshot))
-
+                if reduce(lambda x, y: x and y, valid):
+                    yield key, value
+
+        for messages in self.message_batches():
+            for message in messages:
+                data = message["data"]
+                resolver.add(Snapshot, ts=data["timestamp"])
+                for key, _ in accounts(data):
+                    resolver.add(Account, openstack_id=key)
+            resolver.resolve()
+
+            daily = []
+            for message in messages:
+                data = message["data"]
+                snapshot_id = resolver.id(Snapshot, ts=data["timestamp"])
+                for key, value in accounts(data):
+                    account_id = resolver.id(Account, openstack_id=key)
+                    usages.add(value["bytes"], value["containers"], value["objects"], value["quota"],
+                               account_id, snapshot_id)
+                    daily.append({"ts": data["timestamp"], "account_id": account_id,
+                                  "quota": value["quota"], "bytes": value["bytes"],
+                                  "containers": value["containers"], "objects": value["objects"]})
+            if DAILY_ROLLUP_RECORD:
+                DailyUsage.record(daily)
+
+        usages.flush()
         commit()
 
         return "", 204
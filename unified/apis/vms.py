@@ -1,25 +1,27 @@
 from utils import parse_date_string
 
-from . import app, configure, request, instance_method
-from . import get_or_create, commit
+from . import app, configure, instance_method
+from . import commit, bulk_insert
 from . import Resource, QueryResource, BaseIngestResource, RangeQuery
 
 from ..models.vms import Instance
 
 
 class IngestResource(BaseIngestResource):
-    def ingest(self):
-        """Ingest instances."""
-
-        messages = [message for message in request.get_json(force=True)
-                    if message["schema"] == "cloud.tango"]
+    schemas = ("cloud.tango", )
 
-        for message in messages:
-            for instance in message["data"]["instances"]:
-                # need to convert month from a sting like 2017-12-01 to timestamp
-                # to be consistant with other usage data
-                instance['month'] = parse_date_string(instance['month'], fmt='%Y-%m-%d')
-                get_or_create(Instance, **instance)
+    def ingest(self):
+        """Ingest instances, those reported already are updated."""
+
+        for messages in self.message_batches():
+            instances = []
+            for message in messages:
+                for instance in message["data"]["instances"]:
+                    # need to convert month from a sting like 2017-12-01 to timestamp
+                    # to be consistant with other usage data
+                    instance['month'] = parse_date_string(instance['month'], fmt='%Y-%m-%d')
+                    instances.append(instance)
+            bulk_insert(Instance, instances, update_on=("server_id", "month"))
 
         commit()
 
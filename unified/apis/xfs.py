@@ -1,12 +1,13 @@
-import io
-import uuid
-from functools import lru_cache
+from sqlalchemy.sql import func
 
-from . import app, configure, request, instance_method
-from . import db, get_or_create, commit
-from . import QueryResource, BaseIngestResource, RangeQuery
+from . import app, configure, instance_method, create_logger
+from . import commit, bulk_insert, CopyLoader
+from . import QueryResource, BaseIngestResource, RangeQuery, IngestRejected
 
-from ..models.xfs import Snapshot, Host, Filesystem, Owner, Usage
+from ..models import new_id, DAILY_ROLLUP_RECORD
+from ..models.xfs import Snapshot, Host, Filesystem, Owner, Usage, UsageDelta, DailyUsage, XFS_USAGE_DELTA
+
+logger = create_logger(__name__)
 
 
 class SnapshotResource(QueryResource):
@@ -34,61 +35,161 @@ class UsageResource(QueryResource):
     query_class = Usage
 
 
-class IngestResource(BaseIngestResource):
-    def ingest(self):
-        """Ingest usage."""
+class UsageDeltaResource(QueryResource):
+    """Usage Delta Endpoint"""
+    query_class = UsageDelta
+
+
+class UsageDeltas(object):
+    """Record usage of snapshots as changes of values of owners on filesystems
+
+    Snapshots of a host have to be added in time order, a snapshot not later
+    than the last recorded one of its host rejects the ingestion: changes
+    around it cannot be told from usage of snapshots after it.
+    """
+
+    def __init__(self):
+        self._ingesting = set()
+        self._open = {}
+        self._last = {}
+        self._new = {}
+        self._closed = {}
+
+    def _load(self, host_id):
+        self._open[host_id] = {
+            (row.owner_id, row.filesystem_id): {
+                "id": row.id, "soft": row.soft, "hard": row.hard, "usage": row.usage}
+            for row in UsageDelta.open_rows(host_id)}
+        self._last[host_id] = Snapshot.query.\
+            filter(Snapshot.host_id == host_id, ~Snapshot.id.in_(self._ingesting)).\
+            with_entities(func.max(Snapshot.ts)).scalar()
+
+    def ingesting(self, snapshot_ids):
+        """Exclude snapshots being ingested from those recorded."""
+        self._ingesting.update(snapshot_ids)
+
+    def add(self, host_id, ts, usages):
+        """Add usages of a snapshot, a dict of (soft, hard, usage) by (owner_id, filesystem_id)."""
+        if host_id not in self._open:
+            self._load(host_id)
+        last = self._last[host_id]
+        if last is not None and ts <= last:
+            raise IngestRejected("Snapshot at %d of host %s is not later than %d recorded" % (ts, host_id, last))
+
+        current = self._open[host_id]
+        for key, row in list(current.items()):
+            if usages.get(key) != (row["soft"], row["hard"], row["usage"]):
+                if row["id"] in self._new:
+                    row["to_ts"] = last
+                else:
+                    self._closed[row["id"]] = last
+                del current[key]
+        for (owner_id, filesystem_id), (soft, hard, usage) in usages.items():
+            if (owner_id, filesystem_id) not in current:
+                row = {"id": new_id(), "owner_id": owner_id, "filesystem_id": filesystem_id,
+                       "soft": soft, "hard": hard, "usage": usage, "from_ts": ts, "to_ts": None}
+                self._new[row["id"]] = current[(owner_id, filesystem_id)] = row
+        self._last[host_id] = ts
+
+    def flush(self):
+        """Write changes, rows are closed before new ones are opened."""
+        UsageDelta.close(self._closed)
+        bulk_insert(UsageDelta, list(self._new.values()))
+        self._closed = {}
+        self._new = {}
 
-        @lru_cache(maxsize=10000)
-        def cache(model, **kwargs):
-            return get_or_create(model, **kwargs)
 
-        # This one is experimentally optimised for performance.
-        # Internally creates a TSV and copies it straight
-        # into the database.
-        # Probably not necessary though.
-
-        tsv = io.StringIO()
-
-        for ingest_pass in [1, 2]:
-            for message in request.get_json(force=True):
-                if message["schema"] != "xfs.quota.report":
-                    continue
+class IngestResource(BaseIngestResource):
+    schemas = ("xfs.quota.report", )
+    dimensions = {Host: ("name", ), Owner: ("name", ), Filesystem: ("name", "host_id")}
 
+    def ingest(self):
+        """Ingest usage."""
+        resolver = self.resolver()
+        if XFS_USAGE_DELTA:
+            deltas = UsageDeltas()
+        else:
+            usage = CopyLoader(Usage, ("soft", "hard", "usage", "owner_id", "snapshot_id", "filesystem_id"))
+
+        for messages in self.message_batches():
+            for message in messages:
                 data = message["data"]
-
-                host = cache(Host, name=data["hostname"])
-                snapshot = cache(Snapshot,
-                                 ts=data["timestamp"],
-                                 host=host,
-                                 message=message["id"])
-
+                resolver.add(Host, name=data["hostname"])
                 for entry in data["filesystems"]:
-                    filesystem = cache(Filesystem,
-                                       name=entry["filesystem"],
-                                       host=host)
-
                     for record in entry["quota"]:
-                        owner = cache(Owner, name=record["username"])
-
-                        if ingest_pass == 2:
-                            columns = [
-                                uuid.uuid4(), record["soft"], record["hard"],
-                                record["used"], owner.id, snapshot.id,
-                                filesystem.id
-                            ]
+                        resolver.add(Owner, name=record["username"])
+            resolver.resolve()
 
-                            tsv.write("\t".join([str(c) for c in columns]) + "\n")
+            for message in messages:
+                data = message["data"]
+                host_id = resolver.id(Host, name=data["hostname"])
+                resolver.add(Snapshot, ts=data["timestamp"], host_id=host_id, message=message["id"])
+                for entry in data["filesystems"]:
+                    resolver.add(Filesystem, name=entry["filesystem"], host_id=host_id)
+            resolver.resolve()
 
-            if ingest_pass == 2:
-                tsv.seek(0)
+            if XFS_USAGE_DELTA:
+                self.record_deltas(deltas, resolver, messages)
+            if DAILY_ROLLUP_RECORD:
+                DailyUsage.record(self.daily_usage(resolver, messages))
+            if XFS_USAGE_DELTA:
+                continue
 
-                cursor = db.session.connection().connection.cursor()
-                cursor.copy_from(tsv, "usage")
+            for message in messages:
+                data = message["data"]
+                host_id = resolver.id(Host, name=data["hostname"])
+                snapshot_id = resolver.id(Snapshot, ts=data["timestamp"], host_id=host_id,
+                                          message=message["id"])
+                for entry in data["filesystems"]:
+                    filesystem_id = resolver.id(Filesystem, name=entry["filesystem"], host_id=host_id)
+                    for record in entry["quota"]:
+                        usage.add(record["soft"], record["hard"], record["used"],
+                                  resolver.id(Owner, name=record["username"]),
+                                  snapshot_id, filesystem_id)
 
-            commit()
+        if XFS_USAGE_DELTA:
+            deltas.flush()
+        else:
+            usage.flush()
+        commit()
 
         return "", 204
 
+    @staticmethod
+    def daily_usage(resolver, messages):
+        """Rows of quota maxima and total usage of filesystems in messages for daily rollups."""
+        rows = []
+        for message in messages:
+            data = message["data"]
+            host_id = resolver.id(Host, name=data["hostname"])
+            for entry in data["filesystems"]:
+                if not entry["quota"]:
+                    continue
+                rows.append({"ts": data["timestamp"],
+                             "filesystem_id": resolver.id(Filesystem, name=entry["filesystem"], host_id=host_id),
+                             "soft": max(record["soft"] for record in entry["quota"]),
+                             "hard": max(record["hard"] for record in entry["quota"]),
+                             "usage": sum(record["used"] for record in entry["quota"])})
+        return rows
+
+    @staticmethod
+    def record_deltas(deltas, resolver, messages):
+        """Add usage of a batch of messages to deltas in time order."""
+        deltas.ingesting(resolver.id(Snapshot, ts=message["data"]["timestamp"],
+                                     host_id=resolver.id(Host, name=message["data"]["hostname"]),
+                                     message=message["id"])
+                         for message in messages)
+        for message in sorted(messages, key=lambda message: message["data"]["timestamp"]):
+            data = message["data"]
+            host_id = resolver.id(Host, name=data["hostname"])
+            usages = {}
+            for entry in data["filesystems"]:
+                filesystem_id = resolver.id(Filesystem, name=entry["filesystem"], host_id=host_id)
+                for record in entry["quota"]:
+                    usages[(resolver.id(Owner, name=record["username"]), filesystem_id)] = \
+                        (record["soft"], record["hard"], record["used"])
+            deltas.add(host_id, data["timestamp"], usages)
+
 
 class UsageSummary(RangeQuery):
     def _get(self, **kwargs):
@@ -110,6 +211,11 @@ class FilesystemList(RangeQuery):
                                start_ts=kwargs['start'],
                                end_ts=kwargs['end'])
 
+    def _stream(self, id='', **kwargs):
+        return instance_method(Filesystem, 'iter_list', id,
+                               start_ts=kwargs['start'],
+                               end_ts=kwargs['end'])
+
 
 class OwnerSummary(RangeQuery):
     def _get(self, id='', **kwargs):
@@ -126,6 +232,11 @@ class OwnerList(RangeQuery):
                                start_ts=kwargs['start'],
                                end_ts=kwargs['end'])
 
+    def _stream(self, id='', **kwargs):
+        return instance_method(Owner, 'iter_list', id,
+                               start_ts=kwargs['start'],
+                               end_ts=kwargs['end'])
+
 
 def setup():
     """Let's roll."""
@@ -140,6 +251,7 @@ def setup():
         "/owner/<id>/list": OwnerList,
         "/usage": UsageResource,
         "/usage/summary": UsageSummary,
+        "/usage/delta": UsageDeltaResource,
         "/ingest": IngestResource
     }
 
@@ -1,13 +1,42 @@
 import re
+import uuid
 
-from sqlalchemy.sql import text
+from sqlalchemy import union_all
+from sqlalchemy.sql import text, func
 from sqlalchemy.orm import load_only
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, insert
 
 from .. import app, db
 
 STRIP_ID = re.compile("_id$")
 
+# Seconds of a day, rollups are of UTC days
+DAY = 86400
+
+# Maintain daily rollups in ingestion, then backfill them by
+# bin/ersa-reporting-daily-rollups before reading them with DAILY_ROLLUP
+DAILY_ROLLUP_RECORD = False
+if "DAILY_ROLLUP_RECORD" in app.config:
+    DAILY_ROLLUP_RECORD = app.config["DAILY_ROLLUP_RECORD"]
+
+# Read daily rollups in summaries, they are maintained by ingestion too
+DAILY_ROLLUP = False
+if "DAILY_ROLLUP" in app.config:
+    DAILY_ROLLUP = app.config["DAILY_ROLLUP"]
+DAILY_ROLLUP_RECORD = DAILY_ROLLUP_RECORD or DAILY_ROLLUP
+
+# Aggregates of rollups: in Python, in a query and of two values in SQL
+AGGREGATES = {"max": (max, func.max, func.greatest), "min": (min, func.min, func.least)}
+
+# Number of rows fetched in one round trip when results are streamed
+YIELD_PER = 1000
+
+# Ids of rows are uuid4 generated on the client instead of the database, and
+# ids of ingested dimensions are uuid5 of their keys, see apis.dimension_id
+CLIENT_GENERATED_IDS = False
+if "CLIENT_GENERATED_IDS" in app.config:
+    CLIENT_GENERATED_IDS = app.config["CLIENT_GENERATED_IDS"]
+
 
 def to_dict(object, fields):
     """Generate dictionary with specified fields."""
@@ -19,9 +48,20 @@ def to_dict(object, fields):
     return output
 
 
+def new_id():
+    """Generate a random id on the client."""
+    return str(uuid.uuid4())
+
+
 def id_column():
-    """Generate a UUID column."""
+    """Generate a UUID column.
+
+    With CLIENT_GENERATED_IDS, ids are generated on the client so rows
+    inserted by ORM or Core are not read back for them, the server default
+    remains for other inserts.
+    """
     return db.Column(UUID,
+                     default=new_id if CLIENT_GENERATED_IDS else None,
                      server_default=text("uuid_generate_v4()"),
                      primary_key=True)
 
@@ -46,6 +86,16 @@ class Input(db.Model):
         return {"id": self.id, "name": self.name}
 
 
+class IngestJob(db.Model):
+    """Spooled ingestion job, recorded in the transaction of its ingestion"""
+    id = db.Column(UUID, primary_key=True)
+    name = db.Column(db.String(256), nullable=False)
+
+    def json(self):
+        """Jsonify"""
+        return {"id": self.id, "name": self.name}
+
+
 class SnapshotMothods(object):
     """Mixin for Snapshot"""
     @classmethod
@@ -73,3 +123,87 @@ class SnapshotMothods(object):
         if end_ts > 0:
             btw_query = btw_query.filter(cls.ts < end_ts)
         return btw_query.options(load_only("id", "ts")).subquery()
+
+
+class DailyRollupMethods(object):
+    """Mixin for daily rollups of usage
+
+    A rollup has a row of aggregates of values of an entity in snapshots of
+    a day. KEYS are columns identifying an entity, unique together with day.
+    VALUES are pairs of a column and its aggregate, max or min.
+    """
+    KEYS = ()
+    VALUES = ()
+
+    @classmethod
+    def record(cls, rows):
+        """Merge rows, dicts of ts, keys and values of snapshots, into rollups."""
+        days = {}
+        for row in rows:
+            key = (row["ts"] // DAY, ) + tuple(row[column] for column in cls.KEYS)
+            merged = days.get(key)
+            if merged is None:
+                days[key] = {column: row[column] for column, _ in cls.VALUES}
+                continue
+            # NULL is ignored as by aggregates in SQL
+            for column, aggregate in cls.VALUES:
+                if merged[column] is None:
+                    merged[column] = row[column]
+                elif row[column] is not None:
+                    merged[column] = AGGREGATES[aggregate][0](merged[column], row[column])
+        if not days:
+            return
+
+        table = cls.__table__
+        statement = insert(table).values([dict(zip(("day", ) + cls.KEYS, key), **values)
+                                          for key, values in days.items()])
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=["day"] + list(cls.KEYS),
+            set_={column: AGGREGATES[aggregate][2](table.c[column], statement.excluded[column])
+                  for column, aggregate in cls.VALUES}), mapper=cls)
+
+    @classmethod
+    def backfill(cls, snapshot_values):
+        """Rebuild rollups from snapshot_values, a query of ts, keys and values of all snapshots."""
+        snapshots = snapshot_values.subquery()
+        columns = ["day"] + list(cls.KEYS) + [column for column, _ in cls.VALUES]
+        day = (snapshots.c.ts / DAY).label("day")
+        keys = [snapshots.c[column] for column in cls.KEYS]
+        values = db.session.query(day, *keys).group_by(day, *keys).add_columns(
+            *[AGGREGATES[aggregate][1](snapshots.c[column]) for column, aggregate in cls.VALUES])
+        cls.query.delete()
+        # ids of rows are left to the server default
+        db.session.execute(insert(cls.__table__).from_select(columns, values.statement, include_defaults=False),
+                           mapper=cls)
+
+    @classmethod
+    def summarise(cls, raw, start_ts=0, end_ts=0):
+        """Query keys and aggregates of values between start_ts and end_ts.
+
+        raw(start_ts, end_ts) queries them from snapshots. With DAILY_ROLLUP,
+        days entirely in the range are read from rollups and raw is only
+        queried for the rest of the range at its edges.
+        """
+        first = -(-start_ts // DAY)
+        last = end_ts // DAY if end_ts > 0 else None
+        if not DAILY_ROLLUP or (last is not None and first >= last):
+            return raw(start_ts, end_ts)
+
+        keys = [getattr(cls, column) for column in cls.KEYS]
+        rollups = cls.query.filter(cls.day >= first)
+        if last is not None:
+            rollups = rollups.filter(cls.day < last)
+        parts = [rollups.group_by(*keys).with_entities(
+            *keys + [AGGREGATES[aggregate][1](getattr(cls, column)).label(column)
+                     for column, aggregate in cls.VALUES])]
+        if start_ts < first * DAY:
+            parts.append(raw(start_ts, first * DAY))
+        if last is not None and end_ts > last * DAY:
+            parts.append(raw(last * DAY, end_ts))
+
+        union = union_all(*[part.statement for part in parts]).alias()
+        columns = list(union.c)
+        keys = columns[:len(cls.KEYS)]
+        return db.session.query(*keys).group_by(*keys).add_columns(
+            *[AGGREGATES[aggregate][1](column)
+              for column, (_, aggregate) in zip(columns[len(cls.KEYS):], cls.VALUES)])
@@ -1,5 +1,7 @@
 from sqlalchemy.sql import func
-from . import db, id_column, to_dict, SnapshotMothods
+from sqlalchemy import UniqueConstraint
+
+from . import db, id_column, to_dict, SnapshotMothods, DailyRollupMethods, YIELD_PER
 
 
 class Allocation(db.Model):
@@ -84,14 +86,11 @@ class Tenant(db.Model):
             rslt.append(dict(zip(fields, mappings)))
         return rslt
 
-    def list(self, start_ts=0, end_ts=0):
-        """"Gets a list of usages of a tenant between start_ts and end_ts.
-        """
+    def _list_query(self, start_ts=0, end_ts=0):
         snapshots = Snapshot.between(start_ts, end_ts)
-        namespaces = self._get_namespaces()
-        namespace_ids = namespaces.keys()
+        namespace_ids = self._get_namespaces().keys()
 
-        query = Usage.query.join(snapshots).\
+        return Usage.query.join(snapshots).\
             filter(Usage.namespace_id.in_(namespace_ids)).\
             order_by(Usage.namespace_id, snapshots.c.ts).\
             with_entities(Usage.namespace_id,
@@ -109,19 +108,41 @@ class Tenant(db.Model):
                           Usage.tiered_objects,
                           Usage.tiered_bytes)
 
+    def list(self, start_ts=0, end_ts=0):
+        """"Gets a list of usages of a tenant between start_ts and end_ts.
+        """
+        namespaces = self._get_namespaces()
+
         fields = ['ts', 'ingested_bytes', 'raw_bytes', 'reads',
                   'writes', 'deletes', 'objects', 'bytes_in', 'bytes_out',
                   'metadata_only_objects', 'metadata_only_bytes',
                   'tiered_objects', 'tiered_bytes']
         rslt = {}
 
-        for q in query.all():
+        for q in self._list_query(start_ts, end_ts).all():
             ns = namespaces[q[0]]
             if ns not in rslt:
                 rslt[ns] = []
             rslt[ns].append(dict(zip(fields, q[1:])))
         return rslt
 
+    def iter_list(self, start_ts=0, end_ts=0):
+        """"Generates usages of a tenant between start_ts and end_ts.
+
+        Same as list but flat: each usage has its namespace.
+        """
+        namespaces = self._get_namespaces()
+
+        fields = ['namespace', 'ts', 'ingested_bytes', 'raw_bytes', 'reads',
+                  'writes', 'deletes', 'objects', 'bytes_in', 'bytes_out',
+                  'metadata_only_objects', 'metadata_only_bytes',
+                  'tiered_objects', 'tiered_bytes']
+
+        for q in self._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            mappings = [namespaces[q[0]]]
+            mappings.extend(q[1:])
+            yield dict(zip(fields, mappings))
+
 
 class Namespace(db.Model):
     """HCP Namespace"""
@@ -138,12 +159,10 @@ class Namespace(db.Model):
         """JSON"""
         return to_dict(self, ["name", "tenant_id", "allocation_id"])
 
-    def list(self, start_ts=0, end_ts=0):
-        """"Gets a list of usages of a namespace between start_ts and end_ts.
-        """
+    def _list_query(self, start_ts=0, end_ts=0):
         snapshots = Snapshot.between(start_ts, end_ts)
 
-        query = Usage.query.join(snapshots).\
+        return Usage.query.join(snapshots).\
             filter(Usage.namespace_id == self.id).\
             order_by(snapshots.c.ts).\
             with_entities(snapshots.c.ts,
@@ -160,16 +179,30 @@ class Namespace(db.Model):
                           Usage.tiered_objects,
                           Usage.tiered_bytes)
 
+    def list(self, start_ts=0, end_ts=0):
+        """"Gets a list of usages of a namespace between start_ts and end_ts.
+        """
         fields = ['ts', 'ingested_bytes', 'raw_bytes', 'reads',
                   'writes', 'deletes', 'objects', 'bytes_in', 'bytes_out',
                   'metadata_only_objects', 'metadata_only_bytes',
                   'tiered_objects', 'tiered_bytes']
         rslt = []
 
-        for q in query.all():
+        for q in self._list_query(start_ts, end_ts).all():
             rslt.append(dict(zip(fields, q)))
         return rslt
 
+    def iter_list(self, start_ts=0, end_ts=0):
+        """"Generates usages of a namespace between start_ts and end_ts.
+        """
+        fields = ['ts', 'ingested_bytes', 'raw_bytes', 'reads',
+                  'writes', 'deletes', 'objects', 'bytes_in', 'bytes_out',
+                  'metadata_only_objects', 'metadata_only_bytes',
+                  'tiered_objects', 'tiered_bytes']
+
+        for q in self._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            yield dict(zip(fields, q))
+
 
 class Usage(db.Model):
     """HCP Usage"""
@@ -215,9 +248,28 @@ class Usage(db.Model):
 
         Maximal usage of the period is returned.
         """
+        query = DailyUsage.summarise(cls.maxima, start_ts, end_ts)
+
+        namespaces = dict(Namespace.query.with_entities(Namespace.id, Namespace.name).all())
+
+        fields = ['namespace', 'ingested_bytes', 'raw_bytes', 'reads',
+                  'writes', 'deletes', 'objects', 'bytes_in', 'bytes_out',
+                  'metadata_only_objects', 'metadata_only_bytes',
+                  'tiered_objects', 'tiered_bytes']
+        rslt = []
+
+        for q in query.all():
+            mappings = [namespaces[q[0]]]
+            mappings.extend(q[1:])
+            rslt.append(dict(zip(fields, mappings)))
+        return rslt
+
+    @classmethod
+    def maxima(cls, start_ts=0, end_ts=0):
+        """Query namespace ids and maxima of usage in snapshots of a range."""
         id_query = Snapshot.id_between(start_ts, end_ts)
 
-        query = cls.query.filter(cls.snapshot_id.in_(id_query)).\
+        return cls.query.filter(cls.snapshot_id.in_(id_query)).\
             group_by(cls.namespace_id).\
             with_entities(cls.namespace_id,
                           func.max(cls.ingested_bytes),
@@ -233,16 +285,41 @@ class Usage(db.Model):
                           func.max(cls.tiered_objects),
                           func.max(cls.tiered_bytes))
 
-        namespaces = dict(Namespace.query.with_entities(Namespace.id, Namespace.name).all())
 
-        fields = ['namespace', 'ingested_bytes', 'raw_bytes', 'reads',
-                  'writes', 'deletes', 'objects', 'bytes_in', 'bytes_out',
-                  'metadata_only_objects', 'metadata_only_bytes',
-                  'tiered_objects', 'tiered_bytes']
-        rslt = []
+class DailyUsage(db.Model, DailyRollupMethods):
+    """Maxima of usage of a namespace in snapshots of a day"""
+    id = id_column()
+    day = db.Column(db.Integer, nullable=False, index=True)
+    namespace_id = db.Column(None,
+                             db.ForeignKey("namespace.id"),
+                             index=True,
+                             nullable=False)
+    ingested_bytes = db.Column(db.BigInteger, nullable=False)
+    raw_bytes = db.Column(db.BigInteger, nullable=False)
+    reads = db.Column(db.BigInteger, nullable=False)
+    writes = db.Column(db.BigInteger, nullable=False)
+    deletes = db.Column(db.BigInteger, nullable=False)
+    objects = db.Column(db.BigInteger, nullable=False)
+    bytes_in = db.Column(db.BigInteger, nullable=False)
+    bytes_out = db.Column(db.BigInteger, nullable=False)
+    metadata_only_objects = db.Column(db.BigInteger, nullable=False)
+    metadata_only_bytes = db.Column(db.BigInteger, nullable=False)
+    tiered_objects = db.Column(db.BigInteger, nullable=False)
+    tiered_bytes = db.Column(db.BigInteger, nullable=False)
+    __table_args__ = (UniqueConstraint("day", "namespace_id"), )
 
-        for q in query.all():
-            mappings = [namespaces[q[0]]]
-            mappings.extend(q[1:])
-            rslt.append(dict(zip(fields, mappings)))
-        return rslt
+    KEYS = ("namespace_id", )
+    VALUES = tuple((column, "max") for column in (
+        "ingested_bytes", "raw_bytes", "reads", "writes", "deletes", "objects", "bytes_in",
+        "bytes_out", "metadata_only_objects", "metadata_only_bytes", "tiered_objects", "tiered_bytes"))
+
+    def json(self):
+        """JSON"""
+        return to_dict(self, ["day", "namespace_id"] + [column for column, _ in self.VALUES])
+
+    @classmethod
+    def snapshot_values(cls):
+        """Query snapshot ts, namespace ids and usage of all snapshots."""
+        return Usage.query.join(Snapshot).\
+            with_entities(Snapshot.ts, Usage.namespace_id,
+                          *[getattr(Usage, column) for column, _ in cls.VALUES])
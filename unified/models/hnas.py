@@ -1,5 +1,7 @@
 from sqlalchemy.sql import func
-from . import db, id_column, to_dict, SnapshotMothods
+from sqlalchemy import UniqueConstraint
+
+from . import db, id_column, to_dict, SnapshotMothods, DailyRollupMethods, YIELD_PER
 
 
 class Owner(db.Model):
@@ -62,11 +64,9 @@ class Filesystem(db.Model):
             fields = ['capacity', 'free', 'live_usage', 'snapshot_usage']
             return dict(zip(fields, values))
 
-    def list(self, start_ts=0, end_ts=0):
-        """"Gets a list of usages of a filesystem between start_ts and end_ts.
-        """
+    def _list_query(self, start_ts=0, end_ts=0):
         snapshots = Snapshot.between(start_ts, end_ts)
-        query = FilesystemUsage.query.join(snapshots).\
+        return FilesystemUsage.query.join(snapshots).\
             filter(FilesystemUsage.filesystem_id == self.id).\
             order_by(snapshots.c.ts).\
             with_entities(snapshots.c.ts,
@@ -75,13 +75,23 @@ class Filesystem(db.Model):
                           FilesystemUsage.live_usage,
                           FilesystemUsage.snapshot_usage)
 
+    def list(self, start_ts=0, end_ts=0):
+        """"Gets a list of usages of a filesystem between start_ts and end_ts.
+        """
         fields = ['ts', 'capacity', 'free', 'live_usage', 'snapshot_usage']
         rslt = []
 
-        for q in query.all():
+        for q in self._list_query(start_ts, end_ts).all():
             rslt.append(dict(zip(fields, q)))
         return rslt
 
+    def iter_list(self, start_ts=0, end_ts=0):
+        """"Generates usages of a filesystem between start_ts and end_ts.
+        """
+        fields = ['ts', 'capacity', 'free', 'live_usage', 'snapshot_usage']
+        for q in self._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            yield dict(zip(fields, q))
+
 
 class FilesystemUsage(db.Model):
     """Filesystem Usage"""
@@ -110,15 +120,7 @@ class FilesystemUsage(db.Model):
 
         Maximal usage of the period is returned.
         """
-        id_query = Snapshot.id_between(start_ts, end_ts)
-
-        query = cls.query.filter(cls.snapshot_id.in_(id_query)).\
-            group_by(cls.filesystem_id).\
-            with_entities(cls.filesystem_id,
-                          func.max(cls.capacity).label('capacity'),
-                          func.min(cls.free).label('free'),
-                          func.max(cls.live_usage).label('live_usage'),
-                          func.max(cls.snapshot_usage).label('snapshot_usage'))
+        query = DailyFilesystemUsage.summarise(cls.maxima, start_ts, end_ts)
 
         file_systems = dict(Filesystem.query.with_entities(Filesystem.id, Filesystem.name).all())
 
@@ -130,6 +132,52 @@ class FilesystemUsage(db.Model):
             rslt.append(dict(zip(fields, mappings)))
         return rslt
 
+    @classmethod
+    def maxima(cls, start_ts=0, end_ts=0):
+        """Query filesystem ids and maxima of usage, minimum of free, in snapshots of a range."""
+        id_query = Snapshot.id_between(start_ts, end_ts)
+        return cls.query.filter(cls.snapshot_id.in_(id_query)).\
+            group_by(cls.filesystem_id).\
+            with_entities(cls.filesystem_id,
+                          func.max(cls.capacity).label('capacity'),
+                          func.min(cls.free).label('free'),
+                          func.max(cls.live_usage).label('live_usage'),
+                          func.max(cls.snapshot_usage).label('snapshot_usage'))
+
+
+class DailyFilesystemUsage(db.Model, DailyRollupMethods):
+    """Maxima of usage, minimum of free, of a filesystem in snapshots of a day"""
+    id = id_column()
+    day = db.Column(db.Integer, nullable=False, index=True)
+    filesystem_id = db.Column(None,
+                              db.ForeignKey("filesystem.id"),
+                              index=True,
+                              nullable=False)
+    capacity = db.Column(db.BigInteger, nullable=False)
+    free = db.Column(db.BigInteger, nullable=False)
+    live_usage = db.Column(db.BigInteger, nullable=False)
+    snapshot_usage = db.Column(db.BigInteger, nullable=False)
+    __table_args__ = (UniqueConstraint("day", "filesystem_id"), )
+
+    KEYS = ("filesystem_id", )
+    VALUES = (("capacity", "max"), ("free", "min"), ("live_usage", "max"), ("snapshot_usage", "max"))
+
+    def json(self):
+        """JSON"""
+        return to_dict(self, ["day", "filesystem_id", "capacity", "free", "live_usage",
+                              "snapshot_usage"])
+
+    @classmethod
+    def snapshot_values(cls):
+        """Query snapshot ts, filesystem ids and usage of all snapshots."""
+        return FilesystemUsage.query.join(Snapshot).\
+            with_entities(Snapshot.ts,
+                          FilesystemUsage.filesystem_id,
+                          FilesystemUsage.capacity,
+                          FilesystemUsage.free,
+                          FilesystemUsage.live_usage,
+                          FilesystemUsage.snapshot_usage)
+
 
 class VirtualVolume(db.Model):
     """Virtual Volume"""
@@ -1,5 +1,5 @@
 from sqlalchemy.sql import func
-from . import db, id_column
+from . import db, id_column, YIELD_PER
 
 
 class Owner(db.Model):
@@ -116,9 +116,7 @@ class Job(db.Model):
         return id_query.with_entities(cls.id).subquery()
 
     @classmethod
-    def list(cls, start_ts=0, end_ts=0):
-        """"Gets jobs finished between start_ts and end_ts.
-        """
+    def _list_query(cls, start_ts=0, end_ts=0):
         query = cls.query.join(Owner).join(Queue).\
             with_entities(Job.job_id, Job.name,
                           Queue.name, Owner.name,
@@ -129,9 +127,24 @@ class Job(db.Model):
             query = query.filter(Job.end >= start_ts)
         if end_ts > 0:
             query = query.filter(Job.end < end_ts)
+        return query
+
+    @classmethod
+    def list(cls, start_ts=0, end_ts=0):
+        """"Gets jobs finished between start_ts and end_ts.
+        """
         fields = ['job_id', 'name', 'queue', 'owner', 'start',
                   'end', 'cores', 'cpu_seconds']
-        return [dict(zip(fields, q)) for q in query.all()]
+        return [dict(zip(fields, q)) for q in cls._list_query(start_ts, end_ts).all()]
+
+    @classmethod
+    def iter_list(cls, start_ts=0, end_ts=0):
+        """"Generates jobs finished between start_ts and end_ts.
+        """
+        fields = ['job_id', 'name', 'queue', 'owner', 'start',
+                  'end', 'cores', 'cpu_seconds']
+        for q in cls._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            yield dict(zip(fields, q))
 
     @classmethod
     def summarise(cls, start_ts=0, end_ts=0):
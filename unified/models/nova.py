@@ -1,12 +1,30 @@
 from flask_sqlalchemy import BaseQuery
-from sqlalchemy.dialects.postgresql import INET, MACADDR
-from sqlalchemy import distinct, desc
+from sqlalchemy.dialects.postgresql import INET, MACADDR, UUID, insert
+from sqlalchemy import distinct, desc, or_, text, case, union_all, select, Text
 from sqlalchemy.sql import func
 
-from . import db, id_column, get_db_binding
+from . import app, db, id_column, get_db_binding
 
 DB_BINDING = get_db_binding(__name__)
 
+# Maintain instance_lifespan in ingestion, then backfill it by
+# bin/ersa-reporting-nova-lifespans before reading it with NOVA_LIFESPAN
+NOVA_LIFESPAN_RECORD = False
+if "NOVA_LIFESPAN_RECORD" in app.config:
+    NOVA_LIFESPAN_RECORD = app.config["NOVA_LIFESPAN_RECORD"]
+
+# Read instance_lifespan for range queries, it is maintained by ingestion too
+NOVA_LIFESPAN = False
+if "NOVA_LIFESPAN" in app.config:
+    NOVA_LIFESPAN = app.config["NOVA_LIFESPAN"]
+NOVA_LIFESPAN_RECORD = NOVA_LIFESPAN_RECORD or NOVA_LIFESPAN
+
+# Store address mappings as intervals of snapshots instead of a row per
+# snapshot, convert existing mappings by bin/ersa-reporting-nova-address-intervals
+NOVA_ADDRESS_INTERVALS = False
+if "NOVA_ADDRESS_INTERVALS" in app.config:
+    NOVA_ADDRESS_INTERVALS = app.config["NOVA_ADDRESS_INTERVALS"]
+
 
 class Account(db.Model):
     """OpenStack Account"""
@@ -80,6 +98,8 @@ class Instance(db.Model):
             Account.openstack_id (account), Tenant.openstack_id (tenant).
         """
         state = InstanceState.latest(self.id, start_ts, end_ts)
+        if state is None:
+            return {}
 
         state["instance_id"] = self.id
         state["server_id"] = self.openstack_id
@@ -91,6 +111,71 @@ class Instance(db.Model):
 
         return state
 
+    @classmethod
+    def latest_states(cls, start_ts=0, end_ts=0, instance_ids=None):
+        """ Get full information of the latest states of instances in the query date range
+
+            It returns what latest_state returns for every instance having
+            states in the range, or those of them in instance_ids which can
+            be a list or a query of ids, in one query.
+        """
+        query = db.session.query(
+            InstanceState.instance_id, InstanceState.name,
+            InstanceState.image_id, InstanceState.hypervisor_id, Snapshot.ts,
+            func.min(Snapshot.ts).over(partition_by=InstanceState.instance_id).label("first_ts")).\
+            join(Snapshot, InstanceState.snapshot_id == Snapshot.id)
+        if start_ts > 0:
+            query = query.filter(Snapshot.ts >= start_ts)
+        if end_ts > 0:
+            query = query.filter(Snapshot.ts < end_ts)
+        if isinstance(instance_ids, BaseQuery):
+            # a query of states is not to be correlated with the states here
+            ids = instance_ids.subquery()
+            instance_ids = db.session.query(list(ids.c)[0])
+        if instance_ids is not None:
+            query = query.filter(InstanceState.instance_id.in_(instance_ids))
+
+        if NOVA_LIFESPAN:
+            # instances living only in the range are taken from their lifespans,
+            # states of only those living across the range edges are scanned
+            lifespans = InstanceLifespan.within(start_ts, end_ts)
+            if instance_ids is not None:
+                lifespans = lifespans.filter(InstanceLifespan.instance_id.in_(instance_ids))
+            lifespans = lifespans.with_entities(
+                InstanceLifespan.instance_id, InstanceLifespan.name, InstanceLifespan.image_id,
+                InstanceLifespan.hypervisor_id,
+                (InstanceLifespan.last_seen_ts - InstanceLifespan.first_seen_ts).label("span"))
+
+            across = InstanceLifespan.across(start_ts, end_ts).with_entities(InstanceLifespan.instance_id)
+            query = query.filter(InstanceState.instance_id.in_(across))
+
+        # window is evaluated before DISTINCT ON keeps the latest state
+        scanned = query.distinct(InstanceState.instance_id).\
+            order_by(InstanceState.instance_id, desc(Snapshot.ts)).subquery()
+        latest = db.session.query(
+            scanned.c.instance_id, scanned.c.name, scanned.c.image_id, scanned.c.hypervisor_id,
+            (scanned.c.ts - scanned.c.first_ts).label("span"))
+        if NOVA_LIFESPAN:
+            latest = union_all(latest.statement, lifespans.statement).alias()
+        else:
+            latest = latest.subquery()
+
+        query = db.session.query(
+            cls.id, cls.openstack_id, latest.c.name, latest.c.span,
+            Image.openstack_id, Hypervisor.name, Account.openstack_id,
+            Tenant.openstack_id, Flavor.openstack_id, AvailabilityZone.name).\
+            join(latest, latest.c.instance_id == cls.id).\
+            join(Image, Image.id == latest.c.image_id).\
+            join(Hypervisor, Hypervisor.id == latest.c.hypervisor_id).\
+            join(Account, Account.id == cls.account_id).\
+            join(Tenant, Tenant.id == cls.tenant_id).\
+            join(Flavor, Flavor.id == cls.flavor_id).\
+            join(AvailabilityZone, AvailabilityZone.id == cls.availability_zone_id)
+
+        fields = ("instance_id", "server_id", "server", "span", "image", "hypervisor",
+                  "account", "tenant", "flavor", "az")
+        return [dict(zip(fields, row)) for row in query.all()]
+
     def json(self):
         """Jsonify"""
         return {
@@ -234,6 +319,8 @@ class InstanceState(db.Model):
                               nullable=False)
 
     name = db.Column(db.String(128), index=True, nullable=False)
+    # states of an instance are found by index only
+    __table_args__ = (db.Index("ix_instance_state_instance_id_snapshot_id", "instance_id", "snapshot_id"), )
 
     def json(self):
         """Jsonify"""
@@ -254,32 +341,58 @@ class InstanceState(db.Model):
              During the life time of an instance, image or hypervisor can be
              changed, only report back the latest one.
         """
-        # This retrieves all InstanceState.id and Snapshot.ts in order
-        # to get the latest state and calculate span at once.
-        # This sacrifices memory usage to avoid multiple database hit.
-        query = db.session.query(InstanceState).join(Snapshot).\
-            filter(InstanceState.snapshot_id == Snapshot.id).\
-            filter(InstanceState.instance_id == instance_id).\
-            order_by(desc(Snapshot.ts))
+        if NOVA_LIFESPAN:
+            lifespan = InstanceLifespan.within(start_ts, end_ts).\
+                filter(InstanceLifespan.instance_id == instance_id).\
+                join(Image, InstanceLifespan.image_id == Image.id).\
+                join(Hypervisor, InstanceLifespan.hypervisor_id == Hypervisor.id).\
+                with_entities(InstanceLifespan.name, Image.openstack_id, Hypervisor.name,
+                              InstanceLifespan.last_seen_ts, InstanceLifespan.first_seen_ts).first()
+            if lifespan is not None:
+                name, image, hypervisor, last_ts, first_ts = lifespan
+                return {"server": name, "span": last_ts - first_ts,
+                        "image": image, "hypervisor": hypervisor}
+
+        # The latest state with its image and hypervisor, and the earliest
+        # timestamp by a window over all states in the range, in one row
+        query = db.session.query(
+            InstanceState.name, Image.openstack_id, Hypervisor.name, Snapshot.ts,
+            func.min(Snapshot.ts).over()).\
+            join(Snapshot, InstanceState.snapshot_id == Snapshot.id).\
+            join(Image, InstanceState.image_id == Image.id).\
+            join(Hypervisor, InstanceState.hypervisor_id == Hypervisor.id).\
+            filter(InstanceState.instance_id == instance_id)
 
         if start_ts > 0:
             query = query.filter(Snapshot.ts >= start_ts)
         if end_ts > 0:
             query = query.filter(Snapshot.ts < end_ts)
 
-        timely_states = query.with_entities(InstanceState.id, Snapshot.ts)
-        latest_state = InstanceState.query.get(timely_states[0][0])
-        state = {"server": latest_state.name}
+        latest = query.order_by(desc(Snapshot.ts)).first()
+        if latest is None:
+            return None
+        name, image, hypervisor, last_ts, first_ts = latest
+        state = {"server": name}
         # state["span"] is the difference between mapped snapshots
         # The accuracy depends on snapshot resolution
-        state["span"] = timely_states[0][1] - timely_states[-1][1]
-        state["image"] = latest_state.image.openstack_id
-        state["hypervisor"] = Hypervisor.query.filter_by(id=latest_state.hypervisor_id).value("name")
+        state["span"] = last_ts - first_ts
+        state["image"] = image
+        state["hypervisor"] = hypervisor
 
         return state
 
 
-class IPAddressMapping(db.Model):
+class AddressMappingMethods(object):
+    """Mixin for point-in-time address mappings"""
+    @classmethod
+    def at(cls, ts):
+        """Query mappings of the latest snapshot at or before ts."""
+        snapshot_id = Snapshot.query.filter(Snapshot.ts <= ts).\
+            order_by(Snapshot.ts.desc()).limit(1).with_entities(Snapshot.id).subquery()
+        return cls.query.filter(cls.snapshot_id == snapshot_id.c.id)
+
+
+class IPAddressMapping(db.Model, AddressMappingMethods):
     """Point-in-time IP-Instance Mapping"""
     __bind_key__ = DB_BINDING
     id = id_column()
@@ -306,7 +419,7 @@ class IPAddressMapping(db.Model):
         }
 
 
-class MACAddressMapping(db.Model):
+class MACAddressMapping(db.Model, AddressMappingMethods):
     """Point-in-time MAC-Instance Mapping"""
     __bind_key__ = DB_BINDING
     id = id_column()
@@ -333,12 +446,281 @@ class MACAddressMapping(db.Model):
         }
 
 
+class AddressIntervalMethods(object):
+    """Mixin for address intervals
+
+    An interval holds an address of an instance in consecutive snapshots
+    from from_ts to to_ts. A snapshot ingested after later ones splits the
+    intervals covering it of addresses it has not, so intervals hold exactly
+    the mappings seen in their snapshots whatever order they are ingested in.
+    """
+    # Extend intervals ending at the previous snapshot, or covering ts
+    EXTEND = """
+        UPDATE {table} AS t SET to_ts = greatest(t.to_ts, :ts)
+          FROM unnest(CAST(:instance_ids AS UUID[]), CAST(:address_ids AS UUID[]))
+               AS k(instance_id, address_id)
+         WHERE t.instance_id = k.instance_id AND t.address_id = k.address_id
+           AND t.to_ts >= :previous_ts AND t.from_ts <= :ts
+        RETURNING t.instance_id, t.address_id
+    """
+
+    # Split intervals covering ts, between snapshots at previous_ts and next_ts,
+    # of pairs not seen at ts into one ending at previous_ts and one from next_ts
+    SPLIT = """
+        WITH covering AS (
+            SELECT t.id, t.instance_id, t.address_id, t.to_ts
+              FROM {table} AS t
+             WHERE t.from_ts < :ts AND t.to_ts > :ts
+               AND NOT EXISTS (
+                   SELECT 1
+                     FROM unnest(CAST(:instance_ids AS UUID[]), CAST(:address_ids AS UUID[]))
+                          AS k(instance_id, address_id)
+                    WHERE k.instance_id = t.instance_id AND k.address_id = t.address_id)
+        ), cut AS (
+            UPDATE {table} AS t SET to_ts = :previous_ts
+              FROM covering AS c
+             WHERE t.id = c.id
+        )
+        INSERT INTO {table} (instance_id, address_id, from_ts, to_ts)
+        SELECT instance_id, address_id, :next_ts, to_ts FROM covering
+    """
+
+    # Merge runs of point mappings in consecutive snapshots into intervals
+    CONVERT = """
+        INSERT INTO {table} (instance_id, address_id, from_ts, to_ts)
+        SELECT instance_id, address_id, min(ts), max(ts)
+          FROM (SELECT m.instance_id, m.address_id, s.ts,
+                       s.position - row_number() OVER (
+                           PARTITION BY m.instance_id, m.address_id ORDER BY s.position) AS run
+                  FROM {mappings} AS m
+                  JOIN (SELECT id, ts, row_number() OVER (ORDER BY ts) AS position
+                          FROM snapshot) AS s ON m.snapshot_id = s.id) AS points
+         GROUP BY instance_id, address_id, run
+    """
+
+    def json(self):
+        """Jsonify"""
+        return {
+            "id": self.id,
+            "instance": self.instance_id,
+            "address": self.address_id,
+            "from_ts": self.from_ts,
+            "to_ts": self.to_ts
+        }
+
+    @classmethod
+    def extend(cls, ts, pairs):
+        """Record (instance_id, address_id) pairs seen in the snapshot at ts, which may be none."""
+        previous_ts = db.session.query(func.max(Snapshot.ts)).filter(Snapshot.ts < ts).scalar()
+        next_ts = db.session.query(func.min(Snapshot.ts)).filter(Snapshot.ts > ts).scalar()
+        instance_ids, address_ids = zip(*pairs) if pairs else ((), ())
+        if previous_ts is not None and next_ts is not None:
+            # ingested after a later snapshot
+            statement = text(cls.SPLIT.format(table=cls.__tablename__)).bindparams(
+                ts=ts, previous_ts=previous_ts, next_ts=next_ts,
+                instance_ids=list(instance_ids), address_ids=list(address_ids))
+            db.session.execute(statement, mapper=cls)
+        if not pairs:
+            return
+
+        statement = text(cls.EXTEND.format(table=cls.__tablename__)).bindparams(
+            ts=ts, previous_ts=ts if previous_ts is None else previous_ts,
+            instance_ids=list(instance_ids), address_ids=list(address_ids))
+        extended = set((str(instance_id), str(address_id))
+                       for instance_id, address_id in db.session.execute(statement, mapper=cls))
+        started = [{"instance_id": instance_id, "address_id": address_id, "from_ts": ts, "to_ts": ts}
+                   for instance_id, address_id in pairs
+                   if (str(instance_id), str(address_id)) not in extended]
+        if started:
+            db.session.execute(insert(cls.__table__).values(started), mapper=cls)
+
+    @classmethod
+    def convert(cls, mapping_model):
+        """Build intervals from point mappings of mapping_model."""
+        db.session.execute(text(cls.CONVERT.format(table=cls.__tablename__,
+                                                   mappings=mapping_model.__tablename__)),
+                           mapper=cls)
+
+    @classmethod
+    def at(cls, ts):
+        """Query intervals covering the latest snapshot at or before ts."""
+        snapshot_ts = db.session.query(func.max(Snapshot.ts)).filter(Snapshot.ts <= ts).as_scalar()
+        return cls.query.filter(snapshot_ts.between(cls.from_ts, cls.to_ts))
+
+
+def interval_mappings(interval_model, name):
+    """Select point mappings of all snapshots in intervals, as rows of a mapping table.
+
+    A row is identified by its interval and snapshot ts, which are indexed,
+    its id is computed from them.
+    """
+    table = interval_model.__table__
+    snapshot = Snapshot.__table__
+    return select([
+        func.md5(table.c.id.cast(Text) + snapshot.c.id.cast(Text)).cast(UUID).label("id"),
+        table.c.instance_id, table.c.address_id, snapshot.c.id.label("snapshot_id"),
+        table.c.id.label("interval_id"), snapshot.c.ts.label("ts")
+    ]).where(snapshot.c.ts.between(table.c.from_ts, table.c.to_ts)).alias(name)
+
+
+class IPAddressInterval(db.Model, AddressIntervalMethods):
+    """IP-Instance Mapping in consecutive snapshots"""
+    __bind_key__ = DB_BINDING
+    __table_args__ = (db.Index("ix_ip_address_interval_instance_id_address_id_to_ts",
+                               "instance_id", "address_id", "to_ts"), )
+    id = id_column()
+    instance_id = db.Column(None,
+                            db.ForeignKey("instance.id"),
+                            nullable=False)
+    address_id = db.Column(None,
+                           db.ForeignKey("ip_address.id"),
+                           index=True,
+                           nullable=False)
+    from_ts = db.Column(db.Integer, index=True, nullable=False)
+    to_ts = db.Column(db.Integer, index=True, nullable=False)
+
+
+class MACAddressInterval(db.Model, AddressIntervalMethods):
+    """MAC-Instance Mapping in consecutive snapshots"""
+    __bind_key__ = DB_BINDING
+    __table_args__ = (db.Index("ix_mac_address_interval_instance_id_address_id_to_ts",
+                               "instance_id", "address_id", "to_ts"), )
+    id = id_column()
+    instance_id = db.Column(None,
+                            db.ForeignKey("instance.id"),
+                            nullable=False)
+    address_id = db.Column(None,
+                           db.ForeignKey("mac_address.id"),
+                           index=True,
+                           nullable=False)
+    from_ts = db.Column(db.Integer, index=True, nullable=False)
+    to_ts = db.Column(db.Integer, index=True, nullable=False)
+
+
+class IPAddressIntervalMapping(db.Model):
+    """Point-in-time IP-Instance Mapping expanded from intervals"""
+    __bind_key__ = DB_BINDING
+    __table__ = interval_mappings(IPAddressInterval, "ip_address_interval_mapping")
+    __mapper_args__ = {"primary_key": [__table__.c.interval_id, __table__.c.ts]}
+    json = IPAddressMapping.json
+
+
+class MACAddressIntervalMapping(db.Model):
+    """Point-in-time MAC-Instance Mapping expanded from intervals"""
+    __bind_key__ = DB_BINDING
+    __table__ = interval_mappings(MACAddressInterval, "mac_address_interval_mapping")
+    __mapper_args__ = {"primary_key": [__table__.c.interval_id, __table__.c.ts]}
+    json = MACAddressMapping.json
+
+
+class InstanceLifespan(db.Model):
+    """When an instance was first and last seen with its last known state"""
+    __bind_key__ = DB_BINDING
+    instance_id = db.Column(None, db.ForeignKey("instance.id"), primary_key=True)
+    first_seen_ts = db.Column(db.Integer, index=True, nullable=False)
+    last_seen_ts = db.Column(db.Integer, index=True, nullable=False)
+    name = db.Column(db.String(128), nullable=False)
+    image_id = db.Column(None, db.ForeignKey("image.id"), nullable=False)
+    status_id = db.Column(None, db.ForeignKey("instance_status.id"), nullable=False)
+    hypervisor_id = db.Column(None, db.ForeignKey("hypervisor.id"), nullable=False)
+
+    STATE_COLUMNS = ("name", "image_id", "status_id", "hypervisor_id")
+
+    BACKFILL = text("""
+        INSERT INTO instance_lifespan (instance_id, first_seen_ts, last_seen_ts,
+                                       name, image_id, status_id, hypervisor_id)
+        SELECT DISTINCT ON (instance_state.instance_id)
+               instance_state.instance_id,
+               min(snapshot.ts) OVER (PARTITION BY instance_state.instance_id),
+               snapshot.ts, instance_state.name, instance_state.image_id,
+               instance_state.status_id, instance_state.hypervisor_id
+          FROM instance_state JOIN snapshot ON instance_state.snapshot_id = snapshot.id
+         ORDER BY instance_state.instance_id, snapshot.ts DESC
+        ON CONFLICT (instance_id) DO UPDATE SET
+               first_seen_ts = excluded.first_seen_ts,
+               last_seen_ts = excluded.last_seen_ts,
+               name = excluded.name,
+               image_id = excluded.image_id,
+               status_id = excluded.status_id,
+               hypervisor_id = excluded.hypervisor_id
+    """)
+
+    def json(self):
+        """Jsonify"""
+        return {
+            "instance": self.instance_id,
+            "first_seen_ts": self.first_seen_ts,
+            "last_seen_ts": self.last_seen_ts,
+            "name": self.name,
+            "image": self.image_id,
+            "status": self.status_id,
+            "hypervisor": self.hypervisor_id
+        }
+
+    @classmethod
+    def record(cls, lifespans):
+        """Extend lifespans by those seen, dicts of values of all columns.
+
+        The state is replaced when it is seen later than the recorded one.
+        """
+        if not lifespans:
+            return
+        statement = insert(cls.__table__).values(lifespans)
+        table = cls.__table__.c
+        newer = statement.excluded.last_seen_ts >= table.last_seen_ts
+        updates = {
+            "first_seen_ts": func.least(table.first_seen_ts, statement.excluded.first_seen_ts),
+            "last_seen_ts": func.greatest(table.last_seen_ts, statement.excluded.last_seen_ts)
+        }
+        for column in cls.STATE_COLUMNS:
+            updates[column] = case([(newer, statement.excluded[column])], else_=table[column])
+        db.session.execute(statement.on_conflict_do_update(index_elements=["instance_id"], set_=updates),
+                           mapper=cls)
+
+    @classmethod
+    def backfill(cls):
+        """Rebuild lifespans of all instances from their states."""
+        db.session.execute(cls.BACKFILL, mapper=cls)
+
+    @classmethod
+    def within(cls, start_ts=0, end_ts=0):
+        """Query lifespans entirely in a range, whose states in the range are all states."""
+        query = cls.query
+        if start_ts > 0:
+            query = query.filter(cls.first_seen_ts >= start_ts)
+        if end_ts > 0:
+            query = query.filter(cls.last_seen_ts < end_ts)
+        return query
+
+    @classmethod
+    def overlapping(cls, start_ts=0, end_ts=0):
+        """Query lifespans overlapping a range."""
+        query = cls.query
+        if start_ts > 0:
+            query = query.filter(cls.last_seen_ts >= start_ts)
+        if end_ts > 0:
+            query = query.filter(cls.first_seen_ts < end_ts)
+        return query
+
+    @classmethod
+    def across(cls, start_ts=0, end_ts=0):
+        """Query lifespans overlapping a range across its edges, whose states have to be scanned."""
+        return cls.overlapping(start_ts, end_ts).filter(or_(
+            cls.first_seen_ts < start_ts,
+            cls.last_seen_ts >= end_ts if end_ts > 0 else False))
+
+
 class Summary():
     """list distinct instance on sa node between start_ts and end_ts """
     query = None
 
     def __init__(self, start_ts, end_ts):
-        """Build a query to get a distinct list of instance_id bewteen sart and end ts."""
+        """Build a query to get a distinct list of instance_id bewteen sart and end ts.
+
+        With NOVA_LIFESPAN, instances living entirely in the range are taken
+        from lifespans by the hypervisor of their last state, states are only
+        scanned for instances living across the range edges.
+        """
         az_query = db.session.query(Hypervisor).join(AvailabilityZone).\
             filter(Hypervisor.availability_zone_id == AvailabilityZone.id).\
             filter(AvailabilityZone.name.like("sa%")).\
@@ -348,8 +730,16 @@ class Summary():
             filter(Snapshot.ts >= start_ts, Snapshot.ts < end_ts).\
             filter(InstanceState.snapshot_id == Snapshot.id).\
             with_entities(InstanceState.instance_id).\
-            distinct(InstanceState.instance_id).\
             filter(InstanceState.hypervisor_id.in_(az_query))
+        if NOVA_LIFESPAN:
+            across = InstanceLifespan.across(start_ts, end_ts).with_entities(InstanceLifespan.instance_id)
+            within = InstanceLifespan.within(start_ts, end_ts).\
+                filter(InstanceLifespan.hypervisor_id.in_(az_query)).\
+                with_entities(InstanceLifespan.instance_id)
+            # UNION removes duplicates
+            self.query = within.union(self.query.filter(InstanceState.instance_id.in_(across)))
+        else:
+            self.query = self.query.distinct(InstanceState.instance_id)
 
     def value(self):
         return [item[0] for item in self.query.all()]
@@ -1,6 +1,6 @@
 from sqlalchemy import UniqueConstraint, distinct
 from sqlalchemy.sql import func
-from . import db
+from . import db, YIELD_PER
 
 
 class Job(db.Model):
@@ -29,22 +29,33 @@ class Job(db.Model):
         }
 
     @classmethod
-    def list(cls, start_ts=0, end_ts=0):
-        """"Gets jobs finished between start_ts and end_ts.
-        """
+    def _list_query(cls, start_ts=0, end_ts=0):
         query = cls.query
 
         if start_ts > 0:
             query = query.filter(Job.end >= start_ts)
         if end_ts > 0:
             query = query.filter(Job.end < end_ts)
+        return query.with_entities(Job.job_id,
+                                   Job.user,
+                                   Job.partition,
+                                   Job.start,
+                                   Job.end)
+
+    @classmethod
+    def list(cls, start_ts=0, end_ts=0):
+        """"Gets jobs finished between start_ts and end_ts.
+        """
+        fields = ['job_id', 'owner', 'partition', 'start', 'end', 'cpu_seconds']
+        return [dict(zip(fields, q)) for q in cls._list_query(start_ts, end_ts)]
+
+    @classmethod
+    def iter_list(cls, start_ts=0, end_ts=0):
+        """"Generates jobs finished between start_ts and end_ts.
+        """
         fields = ['job_id', 'owner', 'partition', 'start', 'end', 'cpu_seconds']
-        return [dict(zip(fields, q)) for q in query.
-                with_entities(Job.job_id,
-                              Job.user,
-                              Job.partition,
-                              Job.start,
-                              Job.end)]
+        for q in cls._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            yield dict(zip(fields, q))
 
     @classmethod
     def summarise(cls, start_ts=0, end_ts=0):
@@ -1,5 +1,7 @@
 from sqlalchemy.sql import func
-from . import db, id_column, to_dict, SnapshotMothods
+from sqlalchemy import UniqueConstraint
+
+from . import db, id_column, to_dict, SnapshotMothods, DailyRollupMethods
 
 
 class Account(db.Model):
@@ -42,9 +44,22 @@ class Usage(db.Model):
 
         Maximal usage of the period is returned.
         """
-        id_query = Snapshot.id_between(start_ts, end_ts)
+        query = DailyUsage.summarise(cls.maxima, start_ts, end_ts)
+
+        accounts = dict(Account.query.with_entities(Account.id, Account.openstack_id).all())
 
-        query = cls.query.filter(cls.snapshot_id.in_(id_query)).\
+        fields = ['openstack_id', 'quota', 'bytes', 'containers', 'objects']
+        rslt = []
+
+        for q in query.all():
+            rslt.append(dict(zip(fields, (accounts[q[0]], q[1], q[2], q[3], q[4]))))
+        return rslt
+
+    @classmethod
+    def maxima(cls, start_ts=0, end_ts=0):
+        """Query account ids and maxima of usage in snapshots of a range."""
+        id_query = Snapshot.id_between(start_ts, end_ts)
+        return cls.query.filter(cls.snapshot_id.in_(id_query)).\
             group_by(cls.account_id).\
             with_entities(cls.account_id,
                           func.max(cls.quota),
@@ -52,11 +67,32 @@ class Usage(db.Model):
                           func.max(cls.containers),
                           func.max(cls.objects))
 
-        accounts = dict(Account.query.with_entities(Account.id, Account.openstack_id).all())
 
-        fields = ['openstack_id', 'quota', 'bytes', 'containers', 'objects']
-        rslt = []
+class DailyUsage(db.Model, DailyRollupMethods):
+    """Maxima of usage of an account in snapshots of a day"""
+    id = id_column()
+    day = db.Column(db.Integer, nullable=False, index=True)
+    account_id = db.Column(None, db.ForeignKey("account.id"), index=True, nullable=False)
+    quota = db.Column(db.BigInteger)
+    bytes = db.Column(db.BigInteger, nullable=False)
+    containers = db.Column(db.Integer, nullable=False)
+    objects = db.Column(db.Integer, nullable=False)
+    __table_args__ = (UniqueConstraint("day", "account_id"), )
 
-        for q in query.all():
-            rslt.append(dict(zip(fields, (accounts[q[0]], q[1], q[2], q[3], q[4]))))
-        return rslt
+    KEYS = ("account_id", )
+    VALUES = (("quota", "max"), ("bytes", "max"), ("containers", "max"), ("objects", "max"))
+
+    def json(self):
+        """JSON"""
+        return to_dict(self, ["day", "account_id", "quota", "bytes", "containers", "objects"])
+
+    @classmethod
+    def snapshot_values(cls):
+        """Query snapshot ts, account ids and usage of all snapshots."""
+        return Usage.query.join(Snapshot).\
+            with_entities(Snapshot.ts,
+                          Usage.account_id,
+                          Usage.quota,
+                          Usage.bytes,
+                          Usage.containers,
+                          Usage.objects)
@@ -1,15 +1,21 @@
 from datetime import timedelta
 from sqlalchemy.sql import func
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, and_, or_, text, bindparam
 from sqlalchemy.dialects.postgresql import UUID
 
-from . import db, id_column, SnapshotMothods
+from . import app, db, id_column, SnapshotMothods, DailyRollupMethods, YIELD_PER
 
 # Days between start_ts and end_ts to switch from filtering owner locally
 # to remotely in Owner.summarise. This is very ad-hoc and tested with
 # usage table of 28,054,534 rows
 CUT_OFF = 3
 
+# Store usage as changes with validity intervals in usage_delta instead of
+# a row per snapshot, convert existing usage by bin/ersa-reporting-xfs-usage-deltas
+XFS_USAGE_DELTA = False
+if "XFS_USAGE_DELTA" in app.config:
+    XFS_USAGE_DELTA = app.config["XFS_USAGE_DELTA"]
+
 
 class Owner(db.Model):
     """Storage Owner"""
@@ -44,6 +50,9 @@ class Owner(db.Model):
                           func.max(Usage.hard).label('hard'),
                           func.max(Usage.usage).label('usage'))
 
+        return self._by_filesystem(query)
+
+    def _by_filesystem(self, query):
         fields = ['host', 'filesystem', 'soft', 'hard', 'usage']
         file_systems = self._get_file_systems()
         rslt = []
@@ -54,6 +63,16 @@ class Owner(db.Model):
             rslt.append(dict(zip(fields, mappings)))
         return rslt
 
+    def _delta_filter(self, start_ts, end_ts):
+        query = UsageDelta.in_range(start_ts, end_ts).\
+            filter(UsageDelta.owner_id == self.id).\
+            group_by(UsageDelta.filesystem_id).\
+            with_entities(UsageDelta.filesystem_id,
+                          func.max(UsageDelta.soft).label('soft'),
+                          func.max(UsageDelta.hard).label('hard'),
+                          func.max(UsageDelta.usage).label('usage'))
+        return self._by_filesystem(query)
+
     def _local_filter(self, id_query):
         # Do local owner filter because planer chooses to use bitmapAnd when
         # fewer snapshots involved which is slow
@@ -81,6 +100,9 @@ class Owner(db.Model):
 
         Maximal usage of the period is returned. Grouped by filesystem
         """
+        if XFS_USAGE_DELTA:
+            return self._delta_filter(start_ts, end_ts)
+
         id_query = Snapshot.id_between(start_ts, end_ts)
         date_window = timedelta(seconds=(end_ts - start_ts))
 
@@ -89,11 +111,19 @@ class Owner(db.Model):
         else:
             return self._local_filter(id_query)
 
-    def list(self, start_ts=0, end_ts=0):
-        """"Gets a list of usages between start_ts and end_ts.
-        """
+    def _list_query(self, start_ts=0, end_ts=0):
+        if XFS_USAGE_DELTA:
+            query, snapshots = UsageDelta.expand(start_ts, end_ts)
+            return query.filter(UsageDelta.owner_id == self.id).\
+                order_by(UsageDelta.filesystem_id, snapshots.c.ts).\
+                with_entities(UsageDelta.filesystem_id,
+                              snapshots.c.ts,
+                              UsageDelta.soft,
+                              UsageDelta.hard,
+                              UsageDelta.usage)
+
         snapshots = Snapshot.between(start_ts, end_ts)
-        query = Usage.query.join(snapshots).\
+        return Usage.query.join(snapshots).\
             filter(Usage.owner_id == self.id).\
             order_by(Usage.filesystem_id, snapshots.c.ts).\
             with_entities(Usage.filesystem_id,
@@ -102,11 +132,14 @@ class Owner(db.Model):
                           Usage.hard,
                           Usage.usage)
 
+    def list(self, start_ts=0, end_ts=0):
+        """"Gets a list of usages between start_ts and end_ts.
+        """
         fields = ['ts', 'host', 'soft', 'hard', 'usage']
         file_systems = self._get_file_systems()
         rslt = {}
 
-        for q in query.all():
+        for q in self._list_query(start_ts, end_ts).all():
             hn, fn = file_systems[q[0]]
             mappings = (q[1], hn, q[2], q[3], q[4])
             if fn not in rslt:
@@ -114,6 +147,18 @@ class Owner(db.Model):
             rslt[fn].append(dict(zip(fields, mappings)))
         return rslt
 
+    def iter_list(self, start_ts=0, end_ts=0):
+        """"Generates usages between start_ts and end_ts.
+
+        Same as list but flat: each usage has its filesystem.
+        """
+        fields = ['filesystem', 'ts', 'host', 'soft', 'hard', 'usage']
+        file_systems = self._get_file_systems()
+
+        for q in self._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            hn, fn = file_systems[q[0]]
+            yield dict(zip(fields, (fn, q[1], hn, q[2], q[3], q[4])))
+
 
 class Host(db.Model):
     """Storage Host"""
@@ -145,6 +190,18 @@ class Filesystem(db.Model):
 
         Maximal usage of the period is returned.
         """
+        if XFS_USAGE_DELTA:
+            query = UsageDelta.in_range(start_ts, end_ts).\
+                join(Owner).\
+                filter(UsageDelta.filesystem_id == self.id).\
+                group_by(Owner.name).\
+                with_entities(Owner.name,
+                              func.max(UsageDelta.soft).label('soft'),
+                              func.max(UsageDelta.hard).label('hard'),
+                              func.max(UsageDelta.usage).label('usage'))
+            fields = ['owner', 'soft', 'hard', 'usage']
+            return [dict(zip(fields, q)) for q in query.all()]
+
         snapshot_ids = Snapshot.id_between(start_ts, end_ts)
         query = Usage.query.join(Owner).\
             filter(Usage.filesystem_id == self.id).\
@@ -158,11 +215,20 @@ class Filesystem(db.Model):
         fields = ['owner', 'soft', 'hard', 'usage']
         return [dict(zip(fields, q)) for q in query.all()]
 
-    def list(self, start_ts=0, end_ts=0):
-        """"Gets usages between start_ts and end_ts.
-        """
+    def _list_query(self, start_ts=0, end_ts=0):
+        if XFS_USAGE_DELTA:
+            query, snapshots = UsageDelta.expand(start_ts, end_ts)
+            return query.filter(UsageDelta.filesystem_id == self.id).\
+                join(Owner).\
+                order_by(snapshots.c.ts).\
+                with_entities(snapshots.c.ts,
+                              Owner.name,
+                              UsageDelta.soft,
+                              UsageDelta.hard,
+                              UsageDelta.usage)
+
         snapshots = Snapshot.between(start_ts, end_ts)
-        query = Usage.query.join(snapshots).\
+        return Usage.query.join(snapshots).\
             filter(Usage.filesystem_id == self.id).\
             join(Owner).\
             order_by(snapshots.c.ts).\
@@ -172,8 +238,18 @@ class Filesystem(db.Model):
                           Usage.hard,
                           Usage.usage)
 
+    def list(self, start_ts=0, end_ts=0):
+        """"Gets usages between start_ts and end_ts.
+        """
         fields = ['ts', 'owner', 'soft', 'hard', 'usage']
-        return [dict(zip(fields, q)) for q in query.all()]
+        return [dict(zip(fields, q)) for q in self._list_query(start_ts, end_ts).all()]
+
+    def iter_list(self, start_ts=0, end_ts=0):
+        """"Generates usages between start_ts and end_ts.
+        """
+        fields = ['ts', 'owner', 'soft', 'hard', 'usage']
+        for q in self._list_query(start_ts, end_ts).yield_per(YIELD_PER):
+            yield dict(zip(fields, q))
 
 
 class Usage(db.Model):
@@ -214,6 +290,14 @@ class Usage(db.Model):
 
         Snapshots filtered by start_ts and end_ts and maxima of matrix are returned.
         """
+        return cls._by_filesystem(DailyUsage.summarise(cls.maxima, start_ts, end_ts))
+
+    @classmethod
+    def maxima(cls, start_ts=0, end_ts=0):
+        """Query filesystem ids and maxima of quotas and total usage in snapshots of a range."""
+        if XFS_USAGE_DELTA:
+            return UsageDelta.filesystem_maxima(start_ts, end_ts)
+
         id_query = Snapshot.id_between(start_ts, end_ts)
 
         # link them in code to avoid expand usage rows whose number is very very high
@@ -235,7 +319,10 @@ class Usage(db.Model):
                           func.max(snapshot_query.c.soft).label('soft'),
                           func.max(snapshot_query.c.hard).label('hard'),
                           func.max(snapshot_query.c.usage).label('usage'))
+        return query
 
+    @staticmethod
+    def _by_filesystem(query):
         fq = Filesystem.query.join(Host).\
             with_entities(Filesystem.id, Host.name, Filesystem.name).all()
         file_systems = {}
@@ -245,13 +332,215 @@ class Usage(db.Model):
         fields = ['host', 'filesystem', 'soft', 'hard', 'usage']
         rslt = []
 
-        for q in query.all():
+        for q in query:
             hn, fn = file_systems[q[0]]
             mappings = (hn, fn, int(q[1]), int(q[2]), int(q[3]))
             rslt.append(dict(zip(fields, mappings)))
         return rslt
 
 
+class UsageDelta(db.Model):
+    """Quota and Usage of an owner on a filesystem unchanged in snapshots
+
+    Values hold in all snapshots of the host of the filesystem from from_ts
+    to to_ts, to_ts is NULL while they hold in the latest snapshot.
+    """
+    id = id_column()
+    soft = db.Column(db.BigInteger, nullable=False)
+    hard = db.Column(db.BigInteger, nullable=False)
+    usage = db.Column(db.BigInteger, nullable=False)
+    owner_id = db.Column(None,
+                         db.ForeignKey("owner.id"),
+                         nullable=False,
+                         index=True)
+    filesystem_id = db.Column(None,
+                              db.ForeignKey("filesystem.id"),
+                              nullable=False,
+                              index=True)
+    from_ts = db.Column(db.Integer, nullable=False, index=True)
+    to_ts = db.Column(db.Integer, index=True)
+    # one open row of an owner on a filesystem
+    __table_args__ = (db.Index("ix_usage_delta_open", "filesystem_id", "owner_id", unique=True,
+                               postgresql_where=text("to_ts IS NULL")), )
+
+    # Merge runs of unchanged usage in consecutive snapshots of hosts
+    CONVERT = text("""
+        INSERT INTO usage_delta (owner_id, filesystem_id, soft, hard, usage, from_ts, to_ts)
+        SELECT owner_id, filesystem_id, soft, hard, usage, min(ts), nullif(max(ts), max(latest_ts))
+          FROM (SELECT *, position - row_number() OVER (
+                           PARTITION BY owner_id, filesystem_id, soft, hard, usage
+                           ORDER BY position) AS run
+                  FROM (SELECT DISTINCT u.owner_id, u.filesystem_id, u.soft, u.hard, u.usage,
+                                        s.ts, s.latest_ts, s.position
+                          FROM usage AS u
+                          JOIN (SELECT id, ts, max(ts) OVER (PARTITION BY host_id) AS latest_ts,
+                                       dense_rank() OVER (PARTITION BY host_id ORDER BY ts) AS position
+                                  FROM snapshot) AS s ON u.snapshot_id = s.id) AS points) AS runs
+         GROUP BY owner_id, filesystem_id, soft, hard, usage, run
+    """)
+
+    # Close rows by id at the timestamps
+    CLOSE = text("""
+        UPDATE usage_delta SET to_ts = closed.to_ts
+          FROM unnest(CAST(:ids AS UUID[]), CAST(:to_ts AS INTEGER[])) AS closed(id, to_ts)
+         WHERE usage_delta.id = closed.id
+    """)
+
+    # Totals of filesystems change only in snapshots where a row of their
+    # host starts or after one ends, and in the first snapshot of the range
+    FILESYSTEM_MAXIMA = text("""
+        SELECT filesystem_id, max(soft) AS soft, max(hard) AS hard, max(usage) AS usage
+          FROM (SELECT d.filesystem_id, e.ts, max(d.soft) AS soft, max(d.hard) AS hard,
+                       sum(d.usage) AS usage
+                  FROM (SELECT DISTINCT host_id, ts
+                          FROM (SELECT host_id, ts,
+                                       lag(ts) OVER (PARTITION BY host_id ORDER BY ts) AS previous_ts
+                                  FROM snapshot WHERE ts < :end_ts) AS s
+                         WHERE ts >= :start_ts
+                           AND (previous_ts IS NULL OR previous_ts < :start_ts OR EXISTS (
+                                SELECT 1 FROM usage_delta AS c JOIN filesystem AS cf ON c.filesystem_id = cf.id
+                                 WHERE cf.host_id = s.host_id
+                                   AND (c.from_ts = s.ts OR c.to_ts = s.previous_ts)))) AS e
+                  JOIN filesystem AS f ON f.host_id = e.host_id
+                  JOIN usage_delta AS d ON d.filesystem_id = f.id AND d.from_ts <= e.ts
+                                       AND (d.to_ts IS NULL OR d.to_ts >= e.ts)
+                 GROUP BY d.filesystem_id, e.ts) AS totals
+         GROUP BY filesystem_id
+    """)
+
+    def json(self):
+        """Jsonify"""
+
+        return {
+            "owner": self.owner_id,
+            "filesystem": self.filesystem_id,
+            "soft": self.soft,
+            "hard": self.hard,
+            "usage": self.usage,
+            "from_ts": self.from_ts,
+            "to_ts": self.to_ts
+        }
+
+    @classmethod
+    def open_rows(cls, host_id):
+        """Query rows holding in the latest snapshot of a host."""
+        return cls.query.join(Filesystem).\
+            filter(Filesystem.host_id == host_id, cls.to_ts.is_(None))
+
+    @classmethod
+    def close(cls, closed):
+        """Set to_ts of rows, a dict of to_ts by id."""
+        if closed:
+            db.session.execute(cls.CLOSE.bindparams(ids=list(closed), to_ts=list(closed.values())),
+                               mapper=cls)
+
+    @classmethod
+    def convert(cls):
+        """Build rows from all usage."""
+        db.session.execute(cls.CONVERT, mapper=cls)
+
+    @classmethod
+    def in_range(cls, start_ts=0, end_ts=0):
+        """Query rows holding in at least one snapshot between start_ts and end_ts."""
+        first = db.session.query(Snapshot.host_id, func.min(Snapshot.ts).label("ts"))
+        if start_ts > 0:
+            first = first.filter(Snapshot.ts >= start_ts)
+        if end_ts > 0:
+            first = first.filter(Snapshot.ts < end_ts)
+        first = first.group_by(Snapshot.host_id).subquery()
+
+        # the first snapshot of a row in the range
+        since = func.greatest(cls.from_ts, first.c.ts)
+        query = cls.query.join(Filesystem, Filesystem.id == cls.filesystem_id).\
+            join(first, first.c.host_id == Filesystem.host_id).\
+            filter(or_(cls.to_ts.is_(None), cls.to_ts >= since))
+        if end_ts > 0:
+            query = query.filter(since < end_ts)
+        return query
+
+    @classmethod
+    def expand(cls, start_ts=0, end_ts=0):
+        """Query rows joined with each snapshot between start_ts and end_ts they hold in.
+
+        Returns the query and the subquery of snapshots.
+        """
+        snapshots = Snapshot.query
+        if start_ts > 0:
+            snapshots = snapshots.filter(Snapshot.ts >= start_ts)
+        if end_ts > 0:
+            snapshots = snapshots.filter(Snapshot.ts < end_ts)
+        snapshots = snapshots.with_entities(Snapshot.id, Snapshot.ts, Snapshot.host_id).subquery()
+
+        query = cls.query.join(Filesystem, Filesystem.id == cls.filesystem_id).\
+            join(snapshots, and_(snapshots.c.host_id == Filesystem.host_id,
+                                 snapshots.c.ts >= cls.from_ts,
+                                 or_(cls.to_ts.is_(None), snapshots.c.ts <= cls.to_ts)))
+        return query, snapshots
+
+    @classmethod
+    def filesystem_maxima(cls, start_ts=0, end_ts=0):
+        """Query filesystem ids and maxima of quotas and total usage in snapshots of a range."""
+        # a query can have maxima of several ranges
+        maxima = cls.FILESYSTEM_MAXIMA.bindparams(
+            bindparam("start_ts", start_ts, unique=True),
+            bindparam("end_ts", end_ts if end_ts > 0 else 2 ** 31 - 1, unique=True)).\
+            columns(filesystem_id=UUID, soft=db.BigInteger, hard=db.BigInteger, usage=db.Numeric).\
+            alias("maxima")
+        return db.session.query(*maxima.c)
+
+    @classmethod
+    def snapshot_values(cls):
+        """Query snapshot ts, filesystem ids, maxima of quotas and total usage of all snapshots."""
+        query, snapshots = cls.expand()
+        return query.group_by(snapshots.c.id, snapshots.c.ts, cls.filesystem_id).\
+            with_entities(snapshots.c.ts,
+                          cls.filesystem_id,
+                          func.max(cls.soft).label('soft'),
+                          func.max(cls.hard).label('hard'),
+                          func.sum(cls.usage).label('usage'))
+
+
+class DailyUsage(db.Model, DailyRollupMethods):
+    """Maxima of quotas and total usage of a filesystem in snapshots of a day"""
+    id = id_column()
+    day = db.Column(db.Integer, nullable=False, index=True)
+    filesystem_id = db.Column(None,
+                              db.ForeignKey("filesystem.id"),
+                              nullable=False,
+                              index=True)
+    soft = db.Column(db.BigInteger, nullable=False)
+    hard = db.Column(db.BigInteger, nullable=False)
+    usage = db.Column(db.BigInteger, nullable=False)
+    __table_args__ = (UniqueConstraint("day", "filesystem_id"), )
+
+    KEYS = ("filesystem_id", )
+    VALUES = (("soft", "max"), ("hard", "max"), ("usage", "max"))
+
+    def json(self):
+        """Jsonify"""
+
+        return {
+            "day": self.day,
+            "filesystem": self.filesystem_id,
+            "soft": self.soft,
+            "hard": self.hard,
+            "usage": self.usage
+        }
+
+    @classmethod
+    def snapshot_values(cls):
+        """Query snapshot ts, filesystem ids, maxima of quotas and total usage of all snapshots."""
+        if XFS_USAGE_DELTA:
+            return UsageDelta.snapshot_values()
+        return Usage.query.join(Snapshot).\
+            group_by(Snapshot.id, Snapshot.ts, Usage.filesystem_id).\
+            with_entities(Snapshot.ts,
+                          Usage.filesystem_id,
+                          func.max(Usage.soft).label('soft'),
+                          func.max(Usage.hard).label('hard'),
+                          func.sum(Usage.usage).label('usage'))
+
+
 class Snapshot(db.Model, SnapshotMothods):
     """Storage Snapshot"""
     id = id_column()
@@ -0,0 +1,181 @@
+import os
+import time
+import shutil
+import threading
+import tempfile
+import unittest
+
+from ..apis.cache import TTLCache, MemoryBackend, DiskBackend, ResultCache, SingleFlight
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def test_get_set(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertFalse('a' in cache)
+
+    def test_expire(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set('a', 1, ttl=0.01)
+        cache.set('b', frozenset())
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), frozenset())
+
+    def test_least_recently_used_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def backends(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return [MemoryBackend(maxsize=10), DiskBackend(path)]
+
+    def test_key(self):
+        self.assertEqual(ResultCache.key('/job', {'start': 1, 'end': 2}),
+                         ResultCache.key('/job', {'end': 2, 'start': 1}))
+        self.assertNotEqual(ResultCache.key('/job', {'start': 1}),
+                            ResultCache.key('/owner', {'start': 1}))
+
+    def test_get_set(self):
+        for backend in self.backends():
+            cache = ResultCache(backend, ttl=60)
+            self.assertIsNone(cache.get('a', 10, 20))
+            cache.set('a', 10, 20, [{'id': 1}])
+            self.assertEqual(cache.get('a', 10, 20), [{'id': 1}])
+
+    def test_expire(self):
+        now = int(time.time())
+        for backend in self.backends():
+            cache = ResultCache(backend, ttl=0, past_ttl=60)
+            cache.set('past', 10, 20, [1])
+            cache.set('open', now - 10, 0, [2])
+            self.assertEqual(cache.get('past', 10, 20), [1])
+            self.assertIsNone(cache.get('open', now - 10, 0))
+
+    def test_evict(self):
+        for backend in self.backends():
+            cache = ResultCache(backend, ttl=60)
+            cache.set('a', 10, 20, [1])
+            cache.set('b', 20, 30, [2])
+            cache.set('c', 0, 0, [3])
+            cache.evict([25])
+            self.assertEqual(cache.get('a', 10, 20), [1])
+            self.assertIsNone(cache.get('b', 20, 30))
+            self.assertIsNone(cache.get('c', 0, 0))
+            cache.evict()
+            self.assertIsNone(cache.get('a', 10, 20))
+
+    def test_generation(self):
+        """A result computed while an ingest runs is not kept."""
+        for backend in self.backends():
+            cache = ResultCache(backend, ttl=60)
+            generation = cache.generation()
+            cache.evict([15])
+            self.assertFalse(cache.set('a', 10, 20, [1], generation))
+            self.assertIsNone(cache.get('a', 10, 20))
+
+            generation = cache.generation()
+            self.assertTrue(cache.set('a', 10, 20, [1], generation))
+            self.assertEqual(cache.get('a', 10, 20), [1])
+
+    def test_generation_during_set(self):
+        for backend in self.backends():
+            cache = ResultCache(backend, ttl=60)
+            generation = cache.generation()
+            write = backend.set
+
+            def evicting_set(*args):
+                write(*args)
+                cache.evict([5])
+
+            backend.set = evicting_set
+            self.assertFalse(cache.set('a', 10, 20, [1], generation))
+            self.assertIsNone(cache.get('a', 10, 20))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def run_concurrently(self, targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_coalesce(self):
+        flight = SingleFlight()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 42
+
+        self.run_concurrently([lambda: results.append(flight.do('a', compute))] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(flight.do('a', lambda: 43), 43)
+
+    def test_error_shared(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fail():
+            time.sleep(0.1)
+            raise ValueError('failed')
+
+        def call():
+            try:
+                flight.do('a', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        self.run_concurrently([call] * 3)
+        self.assertEqual(len(errors), 3)
+
+    def test_lock_dir(self):
+        """Flights in different processes are serialised by lock files."""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store, calls = {}, []
+
+        def compute():
+            if 'a' not in store:
+                calls.append(1)
+                time.sleep(0.1)
+                store['a'] = 42
+            return store['a']
+
+        flights = [SingleFlight(path), SingleFlight(path)]
+        self.run_concurrently([lambda f=f: f.do('a', compute) for f in flights])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(os.listdir(path), [])
+
+    def test_lock_files_serialise(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        running, overlaps = [], []
+
+        def compute():
+            if running:
+                overlaps.append(1)
+            running.append(1)
+            time.sleep(0.01)
+            running.pop()
+
+        flights = [SingleFlight(path) for _ in range(4)]
+        self.run_concurrently([lambda f=f: [f.do('a', compute) for _ in range(10)] for f in flights])
+        self.assertEqual(overlaps, [])
+        self.assertEqual(os.listdir(path), [])
@@ -0,0 +1,52 @@
+import uuid
+import unittest
+from unittest import mock
+
+from .. import db
+from ..apis.loader import CopyLoader, copy_value
+from ..models.xfs import Usage
+
+
+class FakeCursor(object):
+    def __init__(self, copies):
+        self.copies = copies
+
+    def copy_expert(self, statement, f):
+        self.copies.append((statement, f.read()))
+
+    def close(self):
+        pass
+
+
+class CopyLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.copies = []
+        session = mock.Mock()
+        session.connection.return_value.connection.cursor.side_effect = lambda: FakeCursor(self.copies)
+        patcher = mock.patch.object(db, "session", session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_copy_value(self):
+        self.assertEqual(copy_value(None), "\\N")
+        self.assertEqual(copy_value(True), "t")
+        self.assertEqual(copy_value(12), "12")
+        self.assertEqual(copy_value("a\tb\\c\nd\re"), "a\\tb\\\\c\\nd\\re")
+
+    def test_chunks(self):
+        loader = CopyLoader(Usage, ("soft", "hard"), chunk_size=2)
+        for i in range(5):
+            loader.add(i, None)
+        self.assertEqual(len(self.copies), 2)
+        loader.flush()
+        loader.flush()
+        self.assertEqual(len(self.copies), 3)
+        self.assertEqual(loader.count, 5)
+
+        statement, content = self.copies[0]
+        self.assertEqual(statement, 'COPY usage (id, soft, hard) FROM STDIN')
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 2)
+        id, soft, hard = lines[1].split("\t")
+        uuid.UUID(id)
+        self.assertEqual((soft, hard), ("1", "\\N"))
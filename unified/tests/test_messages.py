@@ -0,0 +1,45 @@
+import io
+import json
+import lzma
+import unittest
+
+from .. import app
+from ..apis import iter_messages, text_stream, BaseIngestResource
+
+MESSAGES = [
+    {"schema": "a", "data": {"timestamp": 1, "text": "x, ] {" * 50}},
+    {"schema": "b", "data": {"timestamp": 2}},
+    {"schema": "a", "data": {"timestamp": 3, "list": [1, 2, 3]}},
+]
+
+
+class IterMessagesTestCase(unittest.TestCase):
+    def parse(self, text, chunk_size=3, **kwargs):
+        return list(iter_messages(io.StringIO(text), chunk_size=chunk_size, **kwargs))
+
+    def test_chunks(self):
+        for chunk_size in (1, 3, 7, 1000):
+            self.assertEqual(self.parse(json.dumps(MESSAGES, indent=2), chunk_size), MESSAGES)
+        self.assertEqual(self.parse(" [ ] "), [])
+
+    def test_schemas(self):
+        self.assertEqual(self.parse(json.dumps(MESSAGES), schemas=("b", )), [MESSAGES[1]])
+
+    def test_invalid(self):
+        for text in ('', '{"schema": "a"}', '[{"schema": "a"}', '[{"schema": "a"} {}]', '[1]', '[{"a": }]'):
+            with self.assertRaises(ValueError):
+                self.parse(text)
+
+    def test_compressed(self):
+        stream = text_stream(io.BytesIO(lzma.compress(json.dumps(MESSAGES).encode())), "xz")
+        self.assertEqual(list(iter_messages(stream)), MESSAGES)
+
+    def test_resource_records_snapshots(self):
+        class Resource(BaseIngestResource):
+            schemas = ("a", )
+
+        with app.test_request_context("/ingest", method="PUT", data=json.dumps(MESSAGES)):
+            resource = Resource()
+            self.assertEqual([message["data"]["timestamp"] for message in resource.messages()], [1, 3])
+            self.assertEqual(resource.snapshots(), {1, 3})
+            self.assertEqual(resource.tally, {"a": 2})
@@ -0,0 +1,23 @@
+import unittest
+
+from .. import app
+from ..apis import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def sample(self, name, **labels):
+        return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_observe_ingest(self):
+        labels = {"resource": "none", "schema": "hpc.slurm"}
+        before = self.sample("ersa_ingest_messages_total", **labels)
+        with app.test_request_context("/"):
+            app.preprocess_request()
+            metrics.observe_ingest({"hpc.slurm": 3}, 0.5)
+        self.assertEqual(self.sample("ersa_ingest_messages_total", **labels), before + 3)
+        self.assertEqual(self.sample("ersa_ingest_duration_seconds_count", **labels), 1)
+
+    def test_generate(self):
+        with app.test_request_context("/"):
+            response = metrics.generate()
+        self.assertIn(b"ersa_requests_total", response.data)
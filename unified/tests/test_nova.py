@@ -1,8 +1,11 @@
 import unittest
+from unittest import mock
 from flask import json
+from sqlalchemy.dialects import postgresql
 
-from ..apis.nova import app
-from . import client_get
+from ..apis.nova import app, AddressIntervals
+from ..models import nova
+from . import client_get, now, now_minus_24hrs
 
 get = client_get(app)
 
@@ -17,7 +20,8 @@ class NovaTestCase(unittest.TestCase):
             rule = route.rule
             # top objects' have pattern of /blar
             # ingest only accept PUT and OPTIONS
-            if rule not in ('/static/<path:filename>', '/ingest', '/instance', '/summary', '/instance/<id>/latest'):
+            if rule not in ('/static/<path:filename>', '/ingest', '/instance', '/summary', '/instance/<id>/latest', '/instance/latest',
+                            '/ip/mapping/at', '/mac/mapping/at'):
                 print('Testing %s' % rule)
                 resp = get('%s?count=10' % rule)
                 data = json.loads(resp.data)
@@ -51,3 +55,75 @@ class NovaTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         resp_data = json.loads(resp.data)
         self.assertEqual(resp_data['instance_id'], instance_id)
+
+    def test_latest_states(self):
+        resp = get('/instance/latest?start=%s&end=%s' % (now_minus_24hrs, now))
+        self.assertEqual(resp.status_code, 200)
+        resp_data = json.loads(resp.data)
+        self.assertTrue(isinstance(resp_data, list))
+        for state in resp_data:
+            single = json.loads(get('/instance/%s/latest?start=%s&end=%s' %
+                                    (state['instance_id'], now_minus_24hrs, now)).data)
+            self.assertEqual(state, single)
+            break
+
+    def test_address_mapping_at(self):
+        resp = get('/ip/mapping/at')
+        self.assertEqual(resp.status_code, 400)
+
+        snapshot = json.loads(get('/snapshot?count=1&order=-ts').data)[0]
+        for kind in ('ip', 'mac'):
+            resp = get('/%s/mapping/at?ts=%s' % (kind, snapshot['ts']))
+            self.assertEqual(resp.status_code, 200)
+            mappings = json.loads(get('/%s/mapping?count=100000&filter=snapshot_id.eq.%s' %
+                                      (kind, snapshot['id'])).data)
+            self.assertEqual(sorted((m['instance'], m['address']) for m in json.loads(resp.data)),
+                             sorted((m['instance'], m['address']) for m in mappings))
+
+
+class SummaryTestCase(unittest.TestCase):
+    def test_lifespans(self):
+        with mock.patch.object(nova, "NOVA_LIFESPAN", True):
+            sql = str(nova.Summary(100, 200).query.statement.compile(dialect=postgresql.dialect()))
+        # states are only scanned for instances living across the range edges
+        self.assertIn("FROM instance_lifespan", sql)
+        self.assertIn(" UNION ", sql)
+        self.assertIn("instance_state.instance_id IN (SELECT instance_lifespan.instance_id", sql)
+
+
+class AddressIntervalsTestCase(unittest.TestCase):
+    def extend(self, previous_ts, next_ts, pairs):
+        session = mock.Mock()
+        session.query.return_value.filter.return_value.scalar.side_effect = [previous_ts, next_ts]
+        session.execute.return_value = []
+        with mock.patch.object(nova.db, "session", session):
+            nova.IPAddressInterval.extend(200, pairs)
+        return [call[0][0] for call in session.execute.call_args_list]
+
+    def test_in_order(self):
+        statements = self.extend(100, None, {("i", "a")})
+        self.assertFalse(any("covering" in getattr(statement, "text", "") for statement in statements))
+        self.assertEqual(len(statements), 2)
+
+    def test_out_of_order(self):
+        # intervals of pairs not in a late snapshot are split around it
+        statements = self.extend(100, 300, {("i", "a")})
+        split = statements[0]
+        self.assertIn("SET to_ts = :previous_ts", str(split))
+        self.assertIn("SELECT instance_id, address_id, :next_ts, to_ts FROM covering", str(split))
+        params = split.compile().params
+        self.assertEqual((params["ts"], params["previous_ts"], params["next_ts"]), (200, 100, 300))
+        self.assertEqual((params["instance_ids"], params["address_ids"]), (["i"], ["a"]))
+
+        # even a late snapshot without addresses
+        statements = self.extend(100, 300, set())
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(statements[0].compile().params["instance_ids"], [])
+
+    def test_snapshots_without_addresses(self):
+        model = mock.Mock()
+        intervals = AddressIntervals(model)
+        intervals.seen(300)
+        intervals.add(100, "i", "a")
+        intervals.flush()
+        self.assertEqual(model.extend.call_args_list, [mock.call(100, {("i", "a")}), mock.call(300, set())])
@@ -0,0 +1,30 @@
+import unittest
+
+from sqlalchemy import create_engine
+
+from .. import app
+from ..apis.profiling import Profile, SLOWEST, current_profile
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def test_slowest(self):
+        profile = Profile()
+        for i in range(SLOWEST + 3):
+            profile.add_statement("select %d" % i, i / 1000)
+        self.assertEqual(profile.statements, SLOWEST + 3)
+        self.assertEqual(sorted(profile.slowest)[0][1], "select 3")
+        self.assertTrue(profile.server_timing(1).startswith('db;dur=28.0;desc="8 statements"'))
+
+    def test_statements_counted_in_request(self):
+        engine = create_engine("sqlite://")
+        with app.test_request_context("/"):
+            app.preprocess_request()
+            engine.execute("select 1")
+            with self.assertRaises(Exception):
+                engine.execute("select missing from nowhere")
+            engine.execute("select 2")
+            self.assertEqual(current_profile().statements, 2)
+
+    def test_server_timing_header(self):
+        response = app.test_client().get("/ping")
+        self.assertIn("total;dur=", response.headers["Server-Timing"])
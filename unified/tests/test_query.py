@@ -0,0 +1,99 @@
+import unittest
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+from .. import apis
+from ..apis import encode_cursor, decode_cursor, seek_filter, order_columns, projection, serialise_rows
+from ..apis import build_query
+from ..apis import CursorError, FieldError, SerialisationError
+from ..apis.xfs import app
+from ..models import to_dict
+from ..models.xfs import Host, Filesystem
+
+TOKEN = "aeb7cf1c-a842-4592-82e9-55d2dad00150"
+
+
+def sql(clause):
+    return str(clause.compile(dialect=postgresql.dialect()))
+
+
+class CursorTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        values = [1, "a", None]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_malformed(self):
+        for cursor in ("!!!", "bm90IGpzb24=", encode_cursor([1])[:-4], "NDI="):
+            with self.assertRaises(CursorError):
+                decode_cursor(cursor)
+
+    def test_bad_request(self):
+        app.testing = True
+        client = app.test_client()
+        with mock.patch.object(apis, "AUTH_TOKEN", TOKEN):
+            for query in ("after=!!!", "after=!!!&format=ndjson", "after=%s" % encode_cursor([1, 2, 3]),
+                          "fields=nothing", "fields=nothing&format=ndjson"):
+                rv = client.get("/input?" + query, headers={"x-ersa-auth-token": TOKEN})
+                self.assertEqual(rv.status_code, 400, query)
+
+
+class SeekFilterTestCase(unittest.TestCase):
+    def test_same_direction(self):
+        self.assertEqual(sql(seek_filter(order_columns(Filesystem, "name"), ["a", "x"])),
+                         "(filesystem.name, filesystem.id) > (%(param_1)s, %(param_2)s)")
+        self.assertIn(") < (", sql(seek_filter(order_columns(Filesystem, "-name,-id"), ["a", "x"])))
+
+    def test_mixed_directions(self):
+        clause = sql(seek_filter(order_columns(Filesystem, "-name,host"), ["a", "h", "x"]))
+        self.assertEqual(clause.count(" OR "), 2)
+        self.assertIn("filesystem.name < ", clause)
+        self.assertIn("filesystem.host_id > ", clause)
+
+    def test_default_order(self):
+        _, order = build_query(Filesystem, {"filter": None, "order": None}, "name")
+        self.assertEqual([column.key for column, _ in order], ["name", "id"])
+        _, order = build_query(Filesystem, {"filter": None, "order": "-host"}, "name")
+        self.assertEqual([(column.key, desc) for column, desc in order], [("host_id", True), ("id", False)])
+
+    def test_mismatch(self):
+        with self.assertRaises(CursorError):
+            seek_filter(order_columns(Filesystem, "name"), ["a"])
+
+
+class ProjectionTestCase(unittest.TestCase):
+    def test_fields(self):
+        columns, serialise = projection(Filesystem, "name,host")
+        self.assertEqual(columns, [Filesystem.name, Filesystem.host_id])
+        self.assertEqual(serialise(("home", "h")), {"name": "home", "host": "h"})
+        with self.assertRaises(FieldError):
+            projection(Filesystem, "name,size")
+
+    def test_row(self):
+        columns, serialise = projection(Filesystem)
+        values = [getattr(Filesystem(id="f", name="home", host_id="h"), c.key) for c in columns]
+        self.assertEqual(serialise(values), {"id": "f", "name": "home", "host": "h"})
+
+    def test_class_attributes(self):
+        def json(self):
+            return to_dict(self, self.fields())
+
+        with mock.patch.object(Filesystem, "FIELDS", ("name", ), create=True), \
+                mock.patch.object(Filesystem, "fields", classmethod(lambda cls: list(cls.FIELDS)), create=True), \
+                mock.patch.object(Filesystem, "json", json):
+            columns, serialise = projection(Filesystem)
+            self.assertIsNot(columns[0], Filesystem)
+            self.assertEqual(serialise(["f", "home", "h"]), {"id": "f", "name": "home"})
+
+    def test_relationships(self):
+        with mock.patch.object(Host, "json", lambda self: {"filesystems": len(self.filesystems)}):
+            columns, serialise = projection(Host)
+            self.assertEqual(columns, [Host])
+            self.assertEqual(serialise((Host(filesystems=[Filesystem()]), )), {"filesystems": 1})
+
+    def test_serialisation_error(self):
+        def fail(values):
+            raise KeyError(values)
+
+        with self.assertRaises(SerialisationError):
+            serialise_rows(fail, [(1, )])
@@ -0,0 +1,175 @@
+import re
+import unittest
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+from .. import db
+from ..apis.resolver import Resolver, DimensionCache, bulk_insert
+from ..models.xfs import Host, Filesystem, Snapshot
+
+DIALECT = postgresql.dialect()
+KEY_COLUMNS = re.compile(r"AS k\(([^)]*)\)")
+MULTI_PARAM = re.compile(r"^(.*?)(?:_m(\d+))?$")
+
+
+class FakeSession(object):
+    """Session keeping rows of tables in memory"""
+
+    def __init__(self):
+        self.tables = {}
+        self.statements = []
+
+    def execute(self, statement, mapper=None):
+        compiled = statement.compile(dialect=DIALECT)
+        sql = str(compiled)
+        self.statements.append(sql)
+        rows = self.tables.setdefault(mapper.__tablename__, [])
+        if sql.startswith("INSERT"):
+            values = {}
+            for name, value in compiled.params.items():
+                column, index = MULTI_PARAM.match(name).groups()
+                values.setdefault(int(index or 0), {})[column] = value
+            returned = []
+            for row in values.values():
+                id = row.pop("id", None) or "%s-%d" % (mapper.__tablename__, len(rows))
+                existing = [r for r in rows if self._matches(r, row) or r["id"] == id]
+                if "ON CONFLICT" in sql and existing:
+                    if "DO UPDATE" in sql:
+                        existing[0].update(row)
+                        returned.append((existing[0]["id"], ))
+                    continue
+                rows.append(dict(row, id=id))
+                returned.append((id, ))
+            return returned if "RETURNING" in sql else []
+        columns = [c.strip('"') for c in KEY_COLUMNS.search(sql).group(1).split(", ")][:-1]
+        nulls = re.findall(r"t\.(\w+) IS NULL", sql)
+        keys = list(zip(*[compiled.params["k%d" % i] for i in range(len(columns))]))
+        found = []
+        for position, key in enumerate(keys, 1):
+            wanted = dict(zip(columns, key), **dict.fromkeys(nulls))
+            found.extend((position, row["id"]) for row in rows if self._matches(row, wanted))
+        return found
+
+    @staticmethod
+    def _matches(row, wanted):
+        return all(row.get(column) == value for column, value in wanted.items())
+
+
+class ResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = FakeSession()
+        patcher = mock.patch.object(db, "session", self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_find_or_create(self):
+        self.session.tables["host"] = [{"id": "old", "name": "a"}]
+        resolver = Resolver()
+        for name in ("a", "b", "a", "c"):
+            resolver.add(Host, name=name)
+        resolver.resolve()
+        self.assertEqual(resolver.id(Host, name="a"), "old")
+        self.assertEqual(len(set(resolver.id(Host, name=name) for name in "abc")), 3)
+        # select, insert of missing ones and select of them
+        self.assertEqual(len(self.session.statements), 3)
+        self.assertIn("CAST(%(k0)s AS VARCHAR(256)[])", self.session.statements[0])
+
+        resolver.add(Host, name="a")
+        resolver.resolve()
+        self.assertEqual(len(self.session.statements), 3)
+
+    def test_foreign_key_type(self):
+        resolver = Resolver()
+        resolver.add(Filesystem, name="home", host_id="host-0")
+        resolver.resolve()
+        self.assertIn("AS UUID[]", self.session.statements[0])
+        self.assertEqual(resolver.id(Filesystem, name="home", host_id="host-0"), "filesystem-0")
+
+    def test_null(self):
+        resolver = Resolver()
+        resolver.add(Filesystem, name="home", host_id=None)
+        resolver.add(Filesystem, name="home", host_id="host-0")
+        resolver.resolve()
+        self.assertNotEqual(resolver.id(Filesystem, name="home", host_id=None),
+                            resolver.id(Filesystem, name="home", host_id="host-0"))
+        self.assertTrue(any("IS NULL" in sql for sql in self.session.statements))
+
+    def test_upsert(self):
+        resolver = Resolver()
+        resolver.add(Snapshot, {"ts": 1, "host_id": "host-0"}, message="m")
+        resolver.add(Snapshot, {"ts": 2, "host_id": "host-0"}, message="m")
+        resolver.resolve()
+        self.assertIn("ON CONFLICT (message) DO UPDATE SET", self.session.statements[0])
+        self.assertIn("ts = excluded.ts", self.session.statements[0])
+        self.assertEqual(self.session.tables["snapshot"][0]["ts"], 2)
+        self.assertEqual(resolver.id(Snapshot, message="m"), "snapshot-0")
+
+    def test_bulk_insert(self):
+        bulk_insert(Host, [{"name": "a"}, {"name": "b", "id": "x"}, {"name": "c"}])
+        self.assertEqual(len(self.session.statements), 2)
+        self.assertEqual(len(self.session.tables["host"]), 3)
+
+    def test_bulk_upsert(self):
+        bulk_insert(Host, [{"name": "a", "id": "x"}, {"name": "b", "id": "y"}, {"name": "a", "id": "z"}],
+                    update_on=("name", ))
+        self.assertEqual(len(self.session.statements), 1)
+        self.assertIn("ON CONFLICT (name) DO UPDATE SET id = excluded.id", self.session.statements[0])
+        # rows of the same key are merged, the last wins
+        self.assertEqual(sorted(row["id"] for row in self.session.tables["host"]), ["y", "z"])
+
+    def test_cache(self):
+        cache = DimensionCache()
+        resolver = Resolver(cache, (Host, ))
+        resolver.add(Host, name="a")
+        resolver.add(Filesystem, name="home", host_id=None)
+        resolver.resolve()
+        self.assertIsNone(cache.get(Host, Resolver.key(name="a")))
+        resolver.publish()
+        self.assertEqual(cache.get(Host, Resolver.key(name="a")), "host-0")
+        self.assertIsNone(cache.get(Filesystem, Resolver.key(name="home", host_id=None)))
+
+        statements = len(self.session.statements)
+        resolver = Resolver(cache, (Host, ))
+        resolver.add(Host, name="a")
+        resolver.resolve()
+        self.assertEqual(len(self.session.statements), statements)
+        self.assertEqual(resolver.id(Host, name="a"), "host-0")
+
+        cache.clear([Host])
+        self.assertIsNone(cache.get(Host, Resolver.key(name="a")))
+
+    def test_identify(self):
+        resolver = Resolver(identify=lambda model, key: "%s:%s" % (model.__tablename__, dict(key)["name"]))
+        resolver.add(Host, name="a")
+        self.assertEqual(resolver.id(Host, name="a"), "host:a")
+        resolver.add(Filesystem, name="home", host_id=resolver.id(Host, name="a"))
+        resolver.resolve()
+        # only inserts, nothing is read back
+        self.assertEqual(len(self.session.statements), 2)
+        self.assertTrue(all(sql.startswith("INSERT") for sql in self.session.statements))
+        self.assertEqual(self.session.tables["host"][0]["name"], "a")
+        self.assertEqual(resolver.id(Filesystem, name="home", host_id="host:a"), "filesystem:home")
+
+        resolver.add(Host, name="a")
+        resolver.resolve()
+        self.assertEqual(len(self.session.statements), 2)
+
+    def test_identify_existing(self):
+        # created before ids were generated on the client
+        self.session.tables["host"] = [{"name": "a", "id": "old-a"}]
+        self.session.tables["filesystem"] = [{"name": "home", "host_id": None, "id": "old-home"}]
+        resolver = Resolver(identify=lambda model, key: "%s:%s" % (model.__tablename__, dict(key)["name"]))
+        resolver.add(Host, name="a")
+        resolver.add(Host, name="b")
+        resolver.add(Filesystem, name="home", host_id=None)
+        resolver.resolve()
+        self.assertEqual(resolver.id(Host, name="a"), "old-a")
+        self.assertEqual(resolver.id(Host, name="b"), "host:b")
+        # a key with NULL is never a conflict, it is looked up first
+        self.assertEqual(resolver.id(Filesystem, name="home", host_id=None), "old-home")
+        self.assertEqual(len(self.session.tables["filesystem"]), 1)
+
+        resolver.add(Host, {"name": "a"}, name="a")
+        resolver.resolve()
+        self.assertEqual(resolver.id(Host, name="a"), "old-a")
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from .. import app, apis
+from ..apis import run_ingest_job
+from ..apis.spool import Spool, PENDING, RUNNING, DONE, FAILED
+from ..models import db, Input, IngestJob
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.bodies = []
+
+    def handler(self, status, body):
+        if body == b"bad":
+            raise ValueError("bad body")
+        self.bodies.append((status["name"], body))
+
+    def drain(self, spool):
+        while True:
+            job, f = spool._claim()
+            if job is None:
+                return
+            spool.run(job, f)
+
+    def test_run_in_order(self):
+        spool = Spool(self.path, self.handler)
+        first = spool.submit(b"[1]", name="a")
+        self.assertEqual(spool.status(first["job"])["status"], PENDING)
+        second = spool.submit(b"bad", name="b")
+        os.utime(spool._body(PENDING, second["job"]), (1, 1))
+        spool.submit(b"[3]", name="c")
+        self.drain(spool)
+        self.assertEqual(self.bodies, [("a", b"[1]"), ("c", b"[3]")])
+        self.assertEqual(spool.status(first["job"])["status"], DONE)
+        status = spool.status(second["job"])
+        self.assertEqual(status["status"], FAILED)
+        self.assertEqual(status["error"], "bad body")
+        self.assertIsNone(spool.status("unknown"))
+
+    def test_recover(self):
+        spool = Spool(self.path, self.handler)
+        status = spool.submit(b"[1]", name="a")
+        job, f = spool._claim()
+        spool.recover()
+        self.assertTrue(os.path.exists(spool._body(RUNNING, job)))
+        f.close()   # the process claimed it died
+        spool.recover()
+        self.drain(spool)
+        self.assertEqual(spool.status(status["job"])["status"], DONE)
+        self.assertTrue(spool.status(status["job"])["recovered"])
+        self.assertEqual(self.bodies, [("a", b"[1]")])
+
+    def test_start_once(self):
+        spool = Spool(self.path, self.handler, workers=2)
+        with mock.patch("threading.Thread.start") as start:
+            spool.start()
+            spool.start()
+        self.assertEqual(start.call_count, 2)
+
+
+class RunIngestJobTestCase(unittest.TestCase):
+    def run_job(self, recorded, ingested, recovered=True):
+        query = mock.Mock()
+        query.filter_by.return_value.first.return_value = recorded
+        jobs = mock.Mock()
+        jobs.get.return_value = ingested
+        session = mock.Mock()
+        view = mock.Mock()
+        view.view_class.return_value.run.return_value = ("", 204)
+        status = {"job": "j", "name": "a", "path": "/ingest", "endpoint": "job", "recovered": recovered}
+        with mock.patch.object(Input, "query", query), mock.patch.object(IngestJob, "query", jobs), \
+                mock.patch.object(db, "session", session), mock.patch.object(apis, "rollback"), \
+                mock.patch.dict(app.view_functions, {"job": view}):
+            run_ingest_job(status, b"[]")
+        return view.view_class.return_value.run.called, session
+
+    def test_recorded(self):
+        ran, session = self.run_job(Input(name="a"), None, recovered=False)
+        self.assertTrue(ran)
+        job = session.add.call_args[0][0]
+        self.assertEqual((job.id, job.name), ("j", "a"))
+
+    def test_recovered(self):
+        self.assertTrue(self.run_job(Input(name="a"), None)[0])
+        self.assertFalse(self.run_job(Input(name="a"), IngestJob(id="j", name="a"))[0])
+        self.assertFalse(self.run_job(None, None)[0])
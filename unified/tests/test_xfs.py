@@ -1,7 +1,13 @@
 import unittest
+from unittest import mock
+from types import SimpleNamespace
 from flask import json
+from sqlalchemy.dialects import postgresql
 
-from ..apis.xfs import app
+from ..apis import IngestRejected
+from ..apis.xfs import app, UsageDeltas, IngestResource
+from ..models import db
+from ..models.xfs import Snapshot, UsageDelta, DailyUsage
 from . import client_get, now, now_minus_24hrs
 
 get = client_get(app)
@@ -64,3 +70,86 @@ class XFSTestCase(unittest.TestCase):
                 print(data)
                 self.assertTrue(isinstance(data, list) or isinstance(data, dict))
                 self.assertGreater(len(data), 0)
+
+
+class UsageDeltasTestCase(unittest.TestCase):
+    def setUp(self):
+        self.closed = {}
+        self.inserted = []
+        open_rows = [SimpleNamespace(id="old", owner_id="o1", filesystem_id="f", soft=1, hard=2, usage=3),
+                     SimpleNamespace(id="gone", owner_id="o2", filesystem_id="f", soft=1, hard=2, usage=3)]
+        snapshots = mock.Mock()
+        snapshots.filter.return_value.with_entities.return_value.scalar.return_value = 100
+        for patcher in (mock.patch.object(UsageDelta, "open_rows", return_value=open_rows),
+                        mock.patch.object(UsageDelta, "close", side_effect=self.closed.update),
+                        mock.patch.object(Snapshot, "query", snapshots),
+                        mock.patch("unified.apis.xfs.bulk_insert",
+                                   side_effect=lambda model, rows: self.inserted.extend(rows))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_changes(self):
+        deltas = UsageDeltas()
+        deltas.ingesting(["s1", "s2", "s3"])
+        deltas.add("h", 200, {("o1", "f"): (1, 2, 3), ("o3", "f"): (5, 5, 5)})
+        deltas.add("h", 300, {("o1", "f"): (1, 2, 4), ("o3", "f"): (5, 5, 5)})
+        deltas.flush()
+
+        # o2 is gone in 200, o1 changes in 300
+        self.assertEqual(self.closed, {"gone": 100, "old": 200})
+        rows = sorted((row["owner_id"], row["usage"], row["from_ts"], row["to_ts"]) for row in self.inserted)
+        self.assertEqual(rows, [("o1", 4, 300, None), ("o3", 5, 200, None)])
+
+        deltas.add("h", 400, {("o1", "f"): (1, 2, 4)})
+        deltas.flush()
+        o3 = next(row["id"] for row in self.inserted if row["owner_id"] == "o3")
+        self.assertEqual(self.closed[o3], 300)
+
+    def test_late(self):
+        deltas = UsageDeltas()
+        deltas.add("h", 300, {("o1", "f"): (1, 2, 4)})
+        with self.assertRaises(IngestRejected):
+            deltas.add("h", 250, {("o1", "f"): (0, 0, 0)})
+        with self.assertRaises(IngestRejected):
+            UsageDeltas().add("h", 100, {})
+
+    def test_ingest_out_of_order(self):
+        resolver = mock.Mock()
+        resolver.id.side_effect = lambda model, **keys: keys.get("name", model.__name__)
+        messages = [{"id": ts, "data": {"hostname": "h", "timestamp": ts, "filesystems": [
+            {"filesystem": "f", "quota": [{"username": "o1", "soft": 1, "hard": 2, "used": ts}]}]}}
+            for ts in (300, 50, 200)]
+        resource = IngestResource()
+        resource.resolver = lambda: resolver
+        resource.message_batches = lambda: iter([messages])
+
+        # 50 is not later than 100 recorded, nothing of the ingestion is kept
+        with app.test_request_context("/ingest?name=late", method="PUT"), \
+                mock.patch("unified.apis.xfs.XFS_USAGE_DELTA", True), \
+                mock.patch("unified.apis.rollback") as rollback, \
+                mock.patch("unified.apis.xfs.commit") as commit:
+            data, code = resource.run()
+        self.assertEqual(code, 422)
+        self.assertIn("not later than 100", data["message"])
+        rollback.assert_called_once_with()
+        commit.assert_not_called()
+        self.assertEqual((self.closed, self.inserted), ({}, []))
+
+
+class DailyUsageTestCase(unittest.TestCase):
+    def test_record(self):
+        session = mock.Mock()
+        with mock.patch.object(db, "session", session):
+            DailyUsage.record([
+                {"ts": 86400 + 10, "filesystem_id": "f", "soft": 1, "hard": 5, "usage": 3},
+                {"ts": 86400 + 20, "filesystem_id": "f", "soft": 2, "hard": 4, "usage": 1},
+                {"ts": 86400 * 2, "filesystem_id": "f", "soft": 1, "hard": 1, "usage": 1}])
+            DailyUsage.record([])
+
+        # one upsert of a row per day and filesystem
+        self.assertEqual(session.execute.call_count, 1)
+        compiled = session.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+        self.assertIn("ON CONFLICT (day, filesystem_id)", str(compiled))
+        rows = sorted(tuple(compiled.params["%s_m%d" % (column, i)]
+                            for column in ("day", "soft", "hard", "usage")) for i in range(2))
+        self.assertEqual(rows, [(1, 2, 5, 3), (2, 1, 1, 1)])
@@ -1,7 +1,6 @@
 import json
 import logging
 import requests
-import concurrent.futures
 from urllib.parse import urlencode
 from abc import ABCMeta, abstractmethod
 
@@ -197,28 +196,17 @@ class NovaUsage(Usage):
     """Calculates Nova usage (states) in a time period."""
 
     def __init__(self, start, end, crm_client, workers=1):
+        # workers is only accepted for callers, latest states are queried at once
         super().__init__(start, end)
         self.crm_client = crm_client
         # usage_meta is a dict which has OpenstackID as key and all other information of a product (Nectar Allocation)
         self.usage_meta = array_to_dict(self.crm_client.get('/v2/contract/nectarcloudvm/'), 'OpenstackID')
-        self.concurrent_workers = workers
-
-    def _get_state(self, instance_id):
-        instance = nova.Instance.query.get(instance_id)
-        return instance.latest_state(self.start_timestamp, self.end_timestamp)
 
     def prepare(self):
         q = nova.Summary(self.start_timestamp, self.end_timestamp)
-        ids = q.value()
-        logger.debug("Total number of instances = %d" % len(ids))
-
-        if len(ids):
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrent_workers) as executor:
-                fs = {executor.submit(self._get_state, instance_id):
-                      instance_id for instance_id in ids}
-                return [fu.result() for fu in concurrent.futures.as_completed(fs)], 'tenant'
-        else:
-            return [], 'tenant'
+        states = nova.Instance.latest_states(self.start_timestamp, self.end_timestamp, q.query)
+        logger.debug("Total number of instances = %d" % len(states))
+        return states, 'tenant'
 
 
 class HpcUsage(Usage):